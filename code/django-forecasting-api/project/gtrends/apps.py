@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class GtrendsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'gtrends'
+
+    def ready(self):
+        from gtrends.database import set_journal_mode
+
+        connection_created.connect(set_journal_mode)
@@ -0,0 +1,76 @@
+"""Database routing of the read-only requests, and connection setup.
+
+The read-only API actions run within `replica_reads`, which sends their
+queries to the DATABASE_REPLICA_ALIAS database, if configured. Everything
+else, writes included, goes to the default database. Replicas may lag
+behind: e.g. a model version trained a moment ago may not be served yet.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+from django.conf import settings
+from django.db import connections
+
+# Whether the reads of the current request may go to the replica.
+_replica_reads = ContextVar("replica_reads", default=False)
+
+
+@contextmanager
+def replica_reads():
+    """Send the reads to the replica, also usable as a view decorator."""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def in_current_context(iterator: Iterator) -> Iterator:
+    """Iterate with the routing of the caller, e.g. to stream a response.
+
+    Streamed responses are consumed after the view returned, outside of its
+    `replica_reads` block.
+    """
+    return _iterate(iterator, _replica_reads.get())
+
+
+def _iterate(iterator: Iterator, use_replica: bool) -> Iterator:
+    token = _replica_reads.set(use_replica)
+    try:
+        yield from iterator
+    finally:
+        _replica_reads.reset(token)
+
+
+class ReadReplicaRouter:
+    """Route the reads within `replica_reads` to the replica, if any."""
+
+    def db_for_read(self, model, **hints):
+        alias = settings.DATABASE_REPLICA_ALIAS
+        if _replica_reads.get() and alias in connections:
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the default database.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
+
+
+def set_journal_mode(sender, connection, **kwargs):
+    """Apply SQLITE_JOURNAL_MODE to the new SQLite connections.
+
+    Connected to the `connection_created` signal by the app config.
+    """
+    if connection.vendor == "sqlite" and settings.SQLITE_JOURNAL_MODE:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}"
+            )
@@ -0,0 +1,84 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from gtrends.services.benchmarks import SCALES, compare, run_suite
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the pipeline stages and API actions on synthetic data, at "
+        "several scales: wall time, peak memory and number of queries. The "
+        "synthetic data is rolled back at the end. Results can be saved to "
+        "JSON, and compared with a baseline saved by a previous run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scales",
+            nargs="+",
+            choices=list(SCALES),
+            default=["small", "medium"],
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=3,
+            help="Number of timed runs of each stage, the best one is kept.",
+        )
+        parser.add_argument("--output", help="Save the results to this file.")
+        parser.add_argument(
+            "--compare",
+            metavar="BASELINE",
+            help="Compare with the results saved in this file, and fail if "
+            "any metric regressed.",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="Relative increase of a timing or peak memory considered "
+            "a regression.",
+        )
+
+    def handle(self, *args, scales, repeat, output, compare, tolerance, **opts):
+        if repeat < 1:
+            raise CommandError("--repeat must be at least 1.")
+        baseline = None
+        if compare:
+            with open(compare) as f:
+                baseline = json.load(f)
+
+        results = run_suite({name: SCALES[name] for name in scales}, repeat)
+        if output:
+            with open(output, "w") as f:
+                json.dump(results, f, indent=2)
+
+        self.stdout.write(
+            f"{'scale':<8}{'stage':<26}{'time (ms)':>12}{'peak (MB)':>12}"
+            f"{'queries':>10}"
+        )
+        for scale, stages in results["results"].items():
+            for stage, metrics in stages.items():
+                self.stdout.write(
+                    f"{scale:<8}{stage:<26}{metrics['seconds'] * 1e3:>12.1f}"
+                    f"{metrics['peak_memory'] / 2**20:>12.1f}"
+                    f"{metrics['queries']:>10}"
+                )
+
+        if baseline is not None:
+            self._compare(baseline, results, tolerance)
+
+    def _compare(self, baseline, results, tolerance):
+        rows = compare(baseline, results, tolerance)
+        regressions = [row for row in rows if row["regressed"]]
+        for row in regressions:
+            ratio = f"x{row['ratio']:.2f}" if row["ratio"] else "new"
+            self.stderr.write(
+                f"Regression: {row['scale']} {row['stage']} {row['metric']} "
+                f"{row['baseline']:.4g} -> {row['current']:.4g} ({ratio})."
+            )
+        if regressions:
+            raise CommandError(
+                f"{len(regressions)} regressions against the baseline."
+            )
+        self.stdout.write(f"No regression over {len(rows)} metrics.")
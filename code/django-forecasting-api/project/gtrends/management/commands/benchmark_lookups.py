@@ -0,0 +1,158 @@
+import time
+
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from gtrends import models
+
+# Composite indexes serving the lookups, dropped to measure their absence.
+INDEXED_MODELS = [models.TSVersion, models.TSValue, models.MLModelVersion]
+
+
+class Command(BaseCommand):
+    help = (
+        "Time latest-version lookups and ordered value scans, with and "
+        "without the composite indexes. The synthetic data (and the dropped "
+        "indexes) are rolled back at the end, which requires a database with "
+        "transactional DDL, e.g. SQLite or PostgreSQL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--timeseries", type=int, default=50)
+        parser.add_argument("--versions", type=int, default=20)
+        parser.add_argument(
+            "--values",
+            type=int,
+            default=500,
+            help="Number of values of each version.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Number of runs of each lookup, the best one is kept.",
+        )
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            help="Print the query plan of each lookup.",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            timeseries = self._create_data(**options)
+            lookups = self._lookups(timeseries)
+            with_indexes = self._run(lookups, "indexed", **options)
+            # Not entered as a context manager, which SQLite forbids in a
+            # transaction: only used to render the DROP INDEX statements.
+            editor = connection.schema_editor()
+            with connection.cursor() as cursor:
+                for model in INDEXED_MODELS:
+                    for index in model._meta.indexes:
+                        cursor.execute(str(index.remove_sql(model, editor)))
+            without_indexes = self._run(lookups, "no index", **options)
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            f"{'lookup':<32}{'no index (ms)':>16}{'indexed (ms)':>16}"
+        )
+        for name in lookups:
+            self.stdout.write(
+                f"{name:<32}{without_indexes[name] * 1e3:>16.2f}"
+                f"{with_indexes[name] * 1e3:>16.2f}"
+            )
+
+    def _create_data(self, timeseries, versions, values, **options):
+        times = pd.date_range("2000-01-01", periods=values, freq="D", tz="UTC")
+        rng = np.random.default_rng(0)
+        ml_config = models.MLConfig.objects.create(params={})
+        data_config = models.DataConfig.objects.create(name="benchmark")
+        preprocess_config = models.PreprocessingConfig.objects.create(
+            name="benchmark", params={}
+        )
+        created = []
+        for i in range(timeseries):
+            ts = models.TimeSeries.objects.create(name=f"benchmark_{i}")
+            ts_versions = models.TSVersion.objects.bulk_create(
+                models.TSVersion(timeseries=ts) for _ in range(versions)
+            )
+            for version in ts_versions:
+                models.TSValue.objects.bulk_create(
+                    models.TSValue(version=version, time=t, value=v)
+                    for t, v in zip(
+                        times.to_pydatetime(), rng.random(values).tolist()
+                    )
+                )
+            ts.current_version = ts_versions[-1]
+            ts.save()
+
+            ml_model = models.MLModel.objects.create(
+                name=f"benchmark_{i}",
+                ml_config=ml_config,
+                data_config=data_config,
+                preprocess_config=preprocess_config,
+            )
+            ml_versions = models.MLModelVersion.objects.bulk_create(
+                models.MLModelVersion(
+                    ml_model=ml_model, ml_file="benchmark.txt", metadata={}
+                )
+                for _ in range(versions)
+            )
+            ml_model.current_version = ml_versions[-1]
+            ml_model.save()
+            created.append((ts, ml_model))
+        return created
+
+    def _lookups(self, created):
+        """Querysets of the lookups, on a series in the middle of the table."""
+        ts, ml_model = created[len(created) // 2]
+        return {
+            "tsversion_set.last()": (
+                ts.tsversion_set.order_by("-created_at")[:1]
+            ),
+            "TimeSeries.current_version": (
+                models.TimeSeries.objects.filter(id=ts.id).select_related(
+                    "current_version"
+                )
+            ),
+            "mlmodelversion_set.last()": (
+                ml_model.mlmodelversion_set.order_by("-created_at")[:1]
+            ),
+            "MLModel.current_version": (
+                models.MLModel.objects.filter(id=ml_model.id).select_related(
+                    "current_version"
+                )
+            ),
+            "ordered values scan": (
+                models.TSValue.objects.filter(version_id=ts.current_version_id)
+                .order_by("time")
+                .values_list("time", "value")
+            ),
+        }
+
+    def _run(self, lookups, label, repeat, explain, **options):
+        timings = {}
+        for name, queryset in lookups.items():
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                # A fresh clone, not to hit the queryset result cache.
+                list(queryset.all())
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+            if explain:
+                self.stdout.write(f"{name} ({label}):")
+                self.stdout.write(self._explain(queryset, label))
+        return timings
+
+    def _explain(self, queryset, label):
+        sql, params = queryset.query.sql_with_params()
+        # Make the statement unique: SQLite would otherwise reuse a cached
+        # plan, made before the indexes were dropped.
+        sql = f"{connection.ops.explain_query_prefix()} {sql} /* {label} */"
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return "\n".join(
+                " ".join(str(col) for col in row) for row in cursor.fetchall()
+            )
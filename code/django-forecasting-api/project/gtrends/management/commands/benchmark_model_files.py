@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import time
+from uuid import uuid4
+
+import lightgbm
+import numpy as np
+import pandas as pd
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+from gtrends.services.ml import COMPRESSIONS, dump_engine, load_engine
+from lightgbm import LGBMRegressor
+
+
+class Command(BaseCommand):
+    help = (
+        "Time saving and loading a model file, through a temporary file (as "
+        "models used to be saved) and in memory with each compression, and "
+        "report the file sizes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--n-estimators", type=int, default=500)
+        parser.add_argument("--num-leaves", type=int, default=31)
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=3,
+            help="Number of runs of each step, the best one is kept.",
+        )
+
+    def handle(self, *args, n_estimators, num_leaves, repeat, **options):
+        rng = np.random.default_rng(0)
+        # Fitted on frames, as in `train_pipeline`.
+        x = pd.DataFrame(rng.random((10_000, 20)))
+        y = pd.Series(x.to_numpy() @ rng.random(20) + rng.normal(size=len(x)))
+        model = LGBMRegressor(
+            n_estimators=n_estimators, num_leaves=num_leaves, verbose=-1
+        ).fit(x, y)
+
+        location = tempfile.mkdtemp()
+        try:
+            storage = FileSystemStorage(location=location)
+            methods = {"tmp file": self._tmp_file_methods(model, storage)}
+            for compression in [None, *COMPRESSIONS]:
+                methods[f"in memory, {compression or 'no'} compression"] = (
+                    self._in_memory_methods(model, storage, compression)
+                )
+
+            self.stdout.write(
+                f"{'method':<32}{'save (ms)':>12}{'load (ms)':>12}"
+                f"{'size (kB)':>12}"
+            )
+            for name, (save, load) in methods.items():
+                save_time, file_name = _best_of(repeat, save)
+                load_time, _ = _best_of(repeat, lambda: load(file_name))
+                size = storage.size(file_name) / 1024
+                self.stdout.write(
+                    f"{name:<32}{save_time * 1e3:>12.1f}"
+                    f"{load_time * 1e3:>12.1f}{size:>12.1f}"
+                )
+        finally:
+            shutil.rmtree(location)
+
+    def _tmp_file_methods(self, model, storage):
+        def save():
+            tmp_path = os.path.join(tempfile.gettempdir(), uuid4().hex)
+            model.booster_.save_model(tmp_path)
+            with open(tmp_path, "r") as f:
+                name = storage.save(uuid4().hex + ".txt", File(f))
+            os.remove(tmp_path)
+            return name
+
+        def load(name):
+            return lightgbm.Booster(model_file=storage.path(name))
+
+        return save, load
+
+    def _in_memory_methods(self, model, storage, compression):
+        def save():
+            content, suffix = dump_engine(model, compression)
+            return storage.save(uuid4().hex + suffix, ContentFile(content))
+
+        def load(name):
+            with storage.open(name) as ml_file:
+                return load_engine(ml_file)
+
+        return save, load
+
+
+def _best_of(repeat, fn):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
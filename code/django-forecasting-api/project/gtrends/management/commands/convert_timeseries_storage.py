@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from gtrends.models import TSStorage, TSVersion
+from gtrends.services import storage
+
+
+class Command(BaseCommand):
+    help = "Move the values of timeseries versions to another storage."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "target",
+            choices=TSStorage.values,
+            help="Target storage of the values.",
+        )
+        parser.add_argument(
+            "--timeseries",
+            nargs="*",
+            help="Names of the timeseries to convert, all by default.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.TSVALUE_BATCH_SIZE,
+            help="Number of values per insert query or chunk.",
+        )
+
+    def handle(self, *args, target, timeseries, batch_size, **options):
+        versions = TSVersion.objects.exclude(storage=target)
+        if timeseries:
+            versions = versions.filter(timeseries__name__in=timeseries)
+
+        for version in versions.select_related("timeseries").iterator():
+            # One transaction per version: readers never see it half converted.
+            with transaction.atomic():
+                storage.convert_storage(version, target, batch_size)
+            self.stdout.write(
+                f"Converted version {version.id} of "
+                f"{version.timeseries.name} to {target}."
+            )
@@ -0,0 +1,98 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from gtrends.services.jobs import (
+    claim_next_job,
+    fail_job,
+    requeue_job,
+    run_job,
+)
+
+
+def _init_process():
+    # Never share the parent DB connections with the forked processes.
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Run pending background jobs (training, timeseries updates)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=2,
+            help="Number of jobs run in parallel.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait before polling again for new jobs.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once there are no more pending jobs.",
+        )
+
+    def handle(self, *args, processes, poll_interval, once, **options):
+        connections.close_all()
+        running = {}
+        pool = ProcessPoolExecutor(processes, initializer=_init_process)
+        try:
+            while True:
+                # Fill the pool with pending jobs.
+                while len(running) < processes:
+                    job = claim_next_job()
+                    if job is None:
+                        break
+                    try:
+                        future = pool.submit(run_job, job.id)
+                    except BrokenProcessPool:
+                        # The job did not start, run it in a new pool.
+                        requeue_job(job.id)
+                        pool = self._restart_pool(pool, running, processes)
+                        continue
+                    self.stdout.write(f"Job {job.id} ({job.kind}) started.")
+                    running[future] = job
+
+                if not running:
+                    if once:
+                        return
+                    time.sleep(poll_interval)
+                    continue
+
+                done, _ = wait(
+                    running, timeout=poll_interval, return_when=FIRST_COMPLETED
+                )
+                broken = False
+                for future in done:
+                    broken |= isinstance(future.exception(), BrokenProcessPool)
+                    self._finish(future, running.pop(future))
+                if broken:
+                    pool = self._restart_pool(pool, running, processes)
+        finally:
+            pool.shutdown()
+
+    def _finish(self, future, job):
+        try:
+            status = future.result()
+        except Exception as e:
+            # The process running the job died.
+            status = fail_job(job.id, repr(e))
+        self.stdout.write(f"Job {job.id} ({job.kind}) {status}.")
+
+    def _restart_pool(self, pool, running, processes):
+        """Replace a pool whose process died, which fails all of its jobs.
+
+        New jobs cannot be submitted to a broken pool anymore.
+        """
+        self.stderr.write("A worker process died, restarting the pool.")
+        pool.shutdown()
+        for future in list(running):
+            self._finish(future, running.pop(future))
+        return ProcessPoolExecutor(processes, initializer=_init_process)
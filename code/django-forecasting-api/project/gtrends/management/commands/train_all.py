@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from gtrends.models import MLModel
+from gtrends.services.pipelines import train_all_pipeline
+
+
+class Command(BaseCommand):
+    help = "Train a new version of many models in parallel."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--models",
+            nargs="*",
+            help="Names of the models to train, all by default.",
+        )
+        parser.add_argument(
+            "--cpu-budget",
+            type=int,
+            help="Number of cores to use, defaults to TRAIN_CPU_BUDGET.",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            help="Number of models trained in parallel.",
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Refit all the models from scratch, instead of warm starting "
+            "them from their latest version when possible.",
+        )
+
+    def handle(self, *args, models, cpu_budget, processes, full, **options):
+        ml_models = MLModel.objects.select_related(
+            "ml_config", "preprocess_config"
+        ).prefetch_related("data_config__targets", "data_config__features")
+        if models:
+            ml_models = ml_models.filter(name__in=models)
+            unknown = set(models) - {m.name for m in ml_models}
+            if unknown:
+                raise CommandError(f"Unknown models: {sorted(unknown)}")
+
+        trained, failed = train_all_pipeline(
+            ml_models,
+            cpu_budget,
+            processes,
+            incremental=False if full else None,
+        )
+
+        for name, result in trained.items():
+            self.stdout.write(
+                f"{name}: version {result['ml_model_version']} trained "
+                f"({result['mode']}) in {result['seconds']:.2f}s."
+            )
+        for name, error in failed.items():
+            self.stderr.write(f"{name}: failed, {error!r}.")
@@ -0,0 +1,126 @@
+import cProfile
+import io
+import pstats
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+from gtrends.services import metrics
+
+# Request header turning the profiler on, see `ProfilingMiddleware`.
+PROFILE_HEADER = "HTTP_X_PROFILE"
+
+
+class MetricsMiddleware:
+    """Record the duration, status and SQL queries of each request.
+
+    Streamed responses are recorded once their content is sent, as they
+    query the database while streaming.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = _QueryTimer()
+        start = time.perf_counter()
+        with queries.timing():
+            response = self.get_response(request)
+        if response.streaming:
+            response.streaming_content = self._stream(
+                response.streaming_content, request, response, queries, start
+            )
+        else:
+            self._record(request, response, queries, start)
+        return response
+
+    def _stream(self, content, request, response, queries, start):
+        try:
+            with queries.timing():
+                yield from content
+        finally:
+            self._record(request, response, queries, start)
+
+    def _record(self, request, response, queries, start):
+        seconds = time.perf_counter() - start
+        # Known once the url is resolved.
+        match = request.resolver_match
+        view = match.view_name if match is not None else "unmatched"
+        metrics.REQUEST_SECONDS.observe(
+            seconds, view=view, method=request.method
+        )
+        metrics.REQUESTS.inc(
+            view=view, method=request.method, status=response.status_code
+        )
+        metrics.REQUEST_QUERIES.inc(queries.count, view=view)
+        metrics.REQUEST_QUERY_SECONDS.inc(queries.seconds, view=view)
+
+
+class ProfilingMiddleware:
+    """Profile the requests sending an "X-Profile" header, if enabled.
+
+    With PROFILE_REQUESTS, a request with "X-Profile: cprofile" (or
+    "pyinstrument", if installed) gets the profile of its handling as a
+    text response, instead of the view response.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profiler = request.META.get(PROFILE_HEADER, "").lower()
+        if not settings.PROFILE_REQUESTS or not profiler:
+            return self.get_response(request)
+
+        if profiler == "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                return HttpResponse(
+                    "pyinstrument is not installed.", status=501
+                )
+            with Profiler() as profile:
+                response = self.get_response(request)
+            report = profile.output_text()
+        elif profiler == "cprofile":
+            with cProfile.Profile() as profile:
+                response = self.get_response(request)
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats(
+                "cumulative"
+            ).print_stats(settings.PROFILE_MAX_LINES)
+            report = out.getvalue()
+        else:
+            return HttpResponse(
+                "X-Profile must be 'cprofile' or 'pyinstrument'.", status=400
+            )
+
+        profiled = HttpResponse(report, content_type="text/plain")
+        profiled["X-Profiled-Status"] = response.status_code
+        return profiled
+
+
+class _QueryTimer:
+    """Database execute wrapper counting and timing the queries."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    @contextmanager
+    def timing(self):
+        """Count and time the queries of all the connections within."""
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self))
+            yield
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
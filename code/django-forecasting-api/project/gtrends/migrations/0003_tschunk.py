@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gtrends", "0002_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tsversion",
+            name="storage",
+            field=models.CharField(
+                choices=[("ROWS", "Rows"), ("CHUNKS", "Chunks")],
+                default="ROWS",
+                max_length=16,
+            ),
+        ),
+        migrations.CreateModel(
+            name="TSChunk",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("start_time", models.DateTimeField()),
+                ("end_time", models.DateTimeField()),
+                ("n_values", models.IntegerField()),
+                ("times", models.BinaryField()),
+                ("values", models.BinaryField()),
+                (
+                    "version",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="gtrends.tsversion",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery
+
+
+def set_current_versions(apps, schema_editor):
+    for model, version_model, fk in [
+        ("TimeSeries", "TSVersion", "timeseries"),
+        ("MLModel", "MLModelVersion", "ml_model"),
+    ]:
+        latest = (
+            apps.get_model("gtrends", version_model)
+            .objects.filter(**{fk: OuterRef("id")})
+            .order_by("-created_at", "-id")
+            .values("id")[:1]
+        )
+        apps.get_model("gtrends", model).objects.update(
+            current_version=Subquery(latest)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gtrends", "0003_tschunk"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mlmodel",
+            name="current_version",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="gtrends.mlmodelversion",
+            ),
+        ),
+        migrations.AddField(
+            model_name="timeseries",
+            name="current_version",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="gtrends.tsversion",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="mlmodelversion",
+            index=models.Index(
+                fields=["ml_model", "created_at"],
+                name="gtrends_mlm_ml_mode_3396c5_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="tschunk",
+            index=models.Index(
+                fields=["version", "start_time"],
+                name="gtrends_tsc_version_037c26_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="tsvalue",
+            index=models.Index(
+                fields=["version", "time"],
+                name="gtrends_tsv_version_8565dc_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="tsversion",
+            index=models.Index(
+                fields=["timeseries", "created_at"],
+                name="gtrends_tsv_timeser_ac2585_idx",
+            ),
+        ),
+        migrations.RunPython(set_current_versions, migrations.RunPython.noop),
+    ]
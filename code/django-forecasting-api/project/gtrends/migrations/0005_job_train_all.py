@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gtrends", "0004_current_version"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="job",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("TRAIN", "Train"),
+                    ("TRAIN_ALL", "Train All"),
+                    ("UPDATE_ALL_TIMESERIES", "Update All Timeseries"),
+                ],
+                max_length=32,
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gtrends", "0005_job_train_all"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="timeseries",
+            name="source",
+            field=models.CharField(
+                choices=[
+                    ("GOOGLE_TRENDS", "Google Trends"),
+                    ("LOCAL_FILE", "Local File"),
+                ],
+                max_length=32,
+            ),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("gtrends", "0006_local_file_source"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="job",
+            name="kind",
+            field=models.CharField(
+                choices=[
+                    ("BACKTEST", "Backtest"),
+                    ("TRAIN", "Train"),
+                    ("TRAIN_ALL", "Train All"),
+                    ("UPDATE_ALL_TIMESERIES", "Update All Timeseries"),
+                ],
+                max_length=32,
+            ),
+        ),
+    ]
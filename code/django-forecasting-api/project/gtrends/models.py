@@ -1,20 +1,38 @@
 from django.db import models
-from django.db.models import CASCADE, PROTECT
+from django.db.models import CASCADE, PROTECT, SET_NULL
 
 
 class DataSource(models.TextChoices):
     GOOGLE_TRENDS = "GOOGLE_TRENDS"
+    LOCAL_FILE = "LOCAL_FILE"
 
 
 class TimeSeries(models.Model):
     name = models.CharField(unique=True, max_length=64)
     source = models.CharField(max_length=32, choices=DataSource.choices)
+    # Latest version, kept up to date by `update_timeseries`.
+    current_version = models.ForeignKey(
+        "TSVersion", null=True, on_delete=SET_NULL, related_name="+"
+    )
+
+
+class TSStorage(models.TextChoices):
+    # One TSValue row per value.
+    ROWS = "ROWS"
+    # Contiguous arrays of values in TSChunk blobs.
+    CHUNKS = "CHUNKS"
 
 
 class TSVersion(models.Model):
     timeseries = models.ForeignKey(TimeSeries, on_delete=CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     expired = models.BooleanField(default=False)
+    storage = models.CharField(
+        max_length=16, choices=TSStorage.choices, default=TSStorage.ROWS
+    )
+
+    class Meta:
+        indexes = [models.Index(fields=["timeseries", "created_at"])]
 
 
 class TSValue(models.Model):
@@ -22,6 +40,27 @@ class TSValue(models.Model):
     time = models.DateTimeField()
     value = models.FloatField()
 
+    class Meta:
+        indexes = [models.Index(fields=["version", "time"])]
+
+
+class TSChunk(models.Model):
+    """A block of values of a TSVersion, stored as little endian arrays.
+
+    `times` holds int64 UTC timestamps in nanoseconds, sorted, and `values`
+    the matching float64 values.
+    """
+
+    version = models.ForeignKey(TSVersion, on_delete=CASCADE)
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    n_values = models.IntegerField()
+    times = models.BinaryField()
+    values = models.BinaryField()
+
+    class Meta:
+        indexes = [models.Index(fields=["version", "start_time"])]
+
 
 class MLConfig(models.Model):
     params = models.JSONField()
@@ -57,6 +96,10 @@ class MLModel(models.Model):
     preprocess_config = models.ForeignKey(
         PreprocessingConfig, on_delete=PROTECT
     )
+    # Latest version, kept up to date by `save_mlmodelversion`.
+    current_version = models.ForeignKey(
+        "MLModelVersion", null=True, on_delete=SET_NULL, related_name="+"
+    )
 
 
 class MLModelVersion(models.Model):
@@ -64,3 +107,33 @@ class MLModelVersion(models.Model):
     ml_file = models.FileField(upload_to="ml_models")
     created_at = models.DateTimeField(auto_now_add=True)
     metadata = models.JSONField()
+
+    class Meta:
+        indexes = [models.Index(fields=["ml_model", "created_at"])]
+
+
+class JobKind(models.TextChoices):
+    BACKTEST = "BACKTEST"
+    TRAIN = "TRAIN"
+    TRAIN_ALL = "TRAIN_ALL"
+    UPDATE_ALL_TIMESERIES = "UPDATE_ALL_TIMESERIES"
+
+
+class JobStatus(models.TextChoices):
+    PENDING = "PENDING"
+    RUNNING = "RUNNING"
+    SUCCEEDED = "SUCCEEDED"
+    FAILED = "FAILED"
+
+
+class Job(models.Model):
+    kind = models.CharField(max_length=32, choices=JobKind.choices)
+    params = models.JSONField(default=dict)
+    status = models.CharField(
+        max_length=16, choices=JobStatus.choices, default=JobStatus.PENDING
+    )
+    result = models.JSONField(null=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
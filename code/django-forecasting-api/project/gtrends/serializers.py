@@ -1,13 +1,33 @@
+from django.conf import settings
 from gtrends import models
+from gtrends.services.data_sources import DATASOURCE_MAP
+from gtrends.services.ml import NON_CROSSING
+from gtrends.services.streaming import STREAM_FORMATS
 from gtrends.services.tasks import update_timeseries
+from gtrends.services.tasks.backtest import WINDOWS
+from gtrends.services.tasks.train import (
+    INCREMENTAL_PARAMS,
+    PARTITION_PARAMS,
+    PARTITIONINGS,
+    QUANTILE_PARAMS,
+)
 from lightgbm import LGBMRegressor
 from rest_framework import serializers
 
 
 class TimeSeriesSerializer(serializers.ModelSerializer):
+    # Any registered data source, including plugins.
+    source = serializers.CharField(max_length=32)
+
     class Meta:
         model = models.TimeSeries
         fields = "__all__"
+        read_only_fields = ["current_version"]
+
+    def validate_source(self, value):
+        if value not in DATASOURCE_MAP:
+            raise serializers.ValidationError(f"Unknown source: {value}")
+        return value
 
     def create(self, validated_data):
         ts = super().create(validated_data)
@@ -30,11 +50,82 @@ class MLConfigSerializer(serializers.ModelSerializer):
     def validate_params(self, value):
         # At the moment we only support LightGBM model.
         valid_params = LGBMRegressor().get_params()
-        invalid_params = [k for k in value if k not in valid_params]
+        invalid_params = [
+            k
+            for k in value
+            if k not in valid_params
+            and k not in QUANTILE_PARAMS + PARTITION_PARAMS + INCREMENTAL_PARAMS
+        ]
         if invalid_params:
             raise serializers.ValidationError(f"Invalid: {invalid_params}")
+        self._validate_quantiles(value)
+        self._validate_partitioning(value)
+        self._validate_incremental_window(value)
         return value
 
+    def _validate_quantiles(self, value):
+        if "quantiles" not in value:
+            if "non_crossing" in value:
+                raise serializers.ValidationError(
+                    "non_crossing requires quantiles."
+                )
+            return
+        # Quantile set mode, see `train`.
+        quantiles = value["quantiles"]
+        if (
+            not isinstance(quantiles, list)
+            or not quantiles
+            or not all(
+                isinstance(q, (int, float)) and 0 < q < 1 for q in quantiles
+            )
+        ):
+            raise serializers.ValidationError(
+                "Quantiles must be a list of numbers in (0, 1)."
+            )
+        if len(set(quantiles)) != len(quantiles):
+            raise serializers.ValidationError("Duplicate quantiles.")
+        # Set by the quantile set itself.
+        fixed_params = [k for k in ("objective", "alpha") if k in value]
+        if fixed_params:
+            raise serializers.ValidationError(
+                f"Not allowed with quantiles: {fixed_params}"
+            )
+        non_crossing = value.get("non_crossing")
+        if non_crossing is not None and non_crossing not in NON_CROSSING:
+            raise serializers.ValidationError(
+                f"non_crossing must be one of {NON_CROSSING}, or null."
+            )
+        if non_crossing == "normal" and len(quantiles) < 2:
+            raise serializers.ValidationError(
+                "Matching a normal distribution requires two quantiles."
+            )
+
+    def _validate_partitioning(self, value):
+        partitioning = value.get("partitioning", "global")
+        if partitioning not in PARTITIONINGS:
+            raise serializers.ValidationError(
+                f"partitioning must be one of {PARTITIONINGS}."
+            )
+        n_clusters = value.get("n_clusters")
+        if partitioning != "cluster":
+            if n_clusters is not None:
+                raise serializers.ValidationError(
+                    "n_clusters requires cluster partitioning."
+                )
+        elif not isinstance(n_clusters, int) or n_clusters < 1:
+            raise serializers.ValidationError(
+                "n_clusters must be a positive int."
+            )
+
+    def _validate_incremental_window(self, value):
+        # Rows per target and horizon of incremental trainings, see
+        # `plan_training`.
+        window = value.get("incremental_window")
+        if window is not None and (not isinstance(window, int) or window < 1):
+            raise serializers.ValidationError(
+                "incremental_window must be a positive int."
+            )
+
 
 class DataFeaturesSerializer(serializers.ModelSerializer):
     class Meta:
@@ -91,8 +182,19 @@ class PreprocessingConfigSerializer(serializers.ModelSerializer):
         if set(value.keys()) != expected_keys:
             raise serializers.ValidationError(f"Expected keys: {expected_keys}")
 
-        if not isinstance(value["horizon"], int):
-            raise serializers.ValidationError("Horizon must be an int.")
+        horizon = value["horizon"]
+        if isinstance(horizon, list):
+            # Multi-horizon mode, see `Preprocessor`.
+            if not horizon or not all(isinstance(h, int) for h in horizon):
+                raise serializers.ValidationError(
+                    "Horizon must be an int or a list[int]."
+                )
+            if len(set(horizon)) != len(horizon):
+                raise serializers.ValidationError("Duplicate horizons.")
+        elif not isinstance(horizon, int):
+            raise serializers.ValidationError(
+                "Horizon must be an int or a list[int]."
+            )
 
         for key in ["target_lags", "feature_lags"]:
             if not isinstance(value[key], list) or not all(
@@ -107,9 +209,56 @@ class MLModelSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.MLModel
         fields = "__all__"
+        read_only_fields = ["current_version"]
 
 
 class MLModelVersionSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.MLModelVersion
         fields = "__all__"
+
+
+class BatchPredictSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False
+    )
+
+
+class TrainQuerySerializer(serializers.Serializer):
+    incremental = serializers.BooleanField(allow_null=True, default=None)
+
+
+class BacktestQuerySerializer(serializers.Serializer):
+    n_folds = serializers.IntegerField(min_value=1, default=5)
+    window = serializers.ChoiceField(choices=WINDOWS, default="expanding")
+    train_size = serializers.IntegerField(
+        min_value=1, allow_null=True, default=None
+    )
+    test_size = serializers.IntegerField(
+        min_value=1, allow_null=True, default=None
+    )
+
+
+class ValuesQuerySerializer(serializers.Serializer):
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+    after = serializers.DateTimeField(required=False)
+    limit = serializers.IntegerField(
+        required=False, min_value=1, max_value=settings.VALUES_MAX_PAGE_SIZE
+    )
+    output = serializers.ChoiceField(
+        choices=["json", *STREAM_FORMATS], default="json"
+    )
+
+    def validate(self, data):
+        if data.get("limit") and data["output"] != "json":
+            raise serializers.ValidationError(
+                "Pagination is only available with json output."
+            )
+        return data
+
+
+class JobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.Job
+        fields = "__all__"
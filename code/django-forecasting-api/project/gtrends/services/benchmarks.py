@@ -0,0 +1,299 @@
+"""Benchmark suite of the ingest, preprocess, train and predict stages.
+
+Each scale creates synthetic timeseries (see `SyntheticSource`), a data
+config and a model, then measures each pipeline stage and API action: the
+best wall time over `repeat` runs, along with the peak Python memory (NumPy
+arrays included) and the number of queries of an extra first run. Caches
+are cleared before each run and the feature store is disabled, so that the
+cold paths are measured. Everything is rolled back at the end.
+"""
+
+import datetime as dt
+import tempfile
+import time
+import tracemalloc
+import zlib
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import override_settings
+from gtrends import models
+from gtrends.services import prediction_cache
+from gtrends.services.data_sources import (
+    DataSource,
+    _as_index_time,
+    register_source,
+)
+from gtrends.services.ml import engine_cache
+from gtrends.services.pipelines import inference_pipeline, train_pipeline
+from gtrends.services.tasks import (
+    load_data,
+    preprocess,
+    update_all_timeseries,
+)
+
+
+class Scale(NamedTuple):
+    n_targets: int
+    # Number of values of each timeseries.
+    periods: int
+    # Number of target lags and of feature lags.
+    n_lags: int
+
+
+SCALES = {
+    "small": Scale(n_targets=5, periods=500, n_lags=4),
+    "medium": Scale(n_targets=20, periods=2000, n_lags=12),
+    "large": Scale(n_targets=100, periods=5000, n_lags=26),
+}
+
+# Number of feature timeseries of every scale.
+N_FEATURES = 2
+# Number of values downloaded by the "update" stage.
+N_APPENDED = 10
+
+# Metrics compared by `compare`, with whether they are noisy: timings and
+# memory may vary between runs, query counts may not.
+METRICS = {"seconds": True, "peak_memory": True, "queries": False}
+
+
+@register_source("SYNTHETIC")
+class SyntheticSource(DataSource):
+    """Daily random walks, seeded by the timeseries name.
+
+    All the timeseries have `periods` values, from 2000-01-01 on.
+    """
+
+    max_batch_size = 10
+    supports_since = True
+    periods = 500
+
+    def download(self, since: Optional[dt.datetime] = None) -> pd.DataFrame:
+        rng = np.random.default_rng(zlib.crc32(self.timeseries.name.encode()))
+        times = pd.date_range(
+            "2000-01-01", periods=self.periods, freq="D", name="time"
+        )
+        values = 50 + rng.normal(size=self.periods).cumsum()
+        data = pd.DataFrame({"value": values}, index=times)
+        if since is not None:
+            data = data[data.index >= _as_index_time(since, data.index)]
+        return data
+
+
+def run_suite(scales: Dict[str, Scale], repeat: int = 3) -> Dict:
+    """Run the benchmarks at each scale.
+
+    Returns:
+        The environment of the run, and the metrics of each stage, by scale
+        name and stage name.
+    """
+    media_root = tempfile.TemporaryDirectory()
+    with media_root, override_settings(
+        MEDIA_ROOT=media_root.name,
+        FEATURE_STORE_DIR="",
+        CACHES={
+            **settings.CACHES,
+            "benchmark": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "benchmark",
+            },
+        },
+        PREDICTION_CACHE_ALIAS="benchmark",
+        # The synthetic source needs no throttling.
+        DATASOURCE_RATE_LIMIT=1e9,
+        ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"],
+    ):
+        results = {
+            name: _run_scale(scale, repeat) for name, scale in scales.items()
+        }
+    return {
+        "environment": {
+            "created": dt.datetime.now(dt.timezone.utc).isoformat(),
+            "database": connection.vendor,
+            "timeseries_storage": settings.TIMESERIES_STORAGE,
+            "repeat": repeat,
+            "scales": {name: scale._asdict() for name, scale in scales.items()},
+        },
+        "results": results,
+    }
+
+
+def compare(
+    baseline: Dict,
+    current: Dict,
+    tolerance: float = 0.2,
+    min_seconds: float = 0.005,
+) -> List[Dict]:
+    """Compare the metrics of two runs of `run_suite`.
+
+    Args:
+        baseline, current: The runs, as returned by `run_suite`.
+        tolerance: Relative increase of a noisy metric (time or memory)
+            flagged as a regression. Any increase of the number of queries
+            is one.
+        min_seconds: Timing differences below this are ignored.
+
+    Returns:
+        The metrics found in both runs: scale, stage, metric, baseline and
+        current values, ratio and whether it regressed.
+    """
+    rows = []
+    for scale, stages in current["results"].items():
+        for stage, metrics in stages.items():
+            previous = baseline["results"].get(scale, {}).get(stage)
+            if previous is None:
+                continue
+            for metric, noisy in METRICS.items():
+                old, new = previous[metric], metrics[metric]
+                regressed = new > old * (1 + tolerance) if noisy else new > old
+                if metric == "seconds" and new - old < min_seconds:
+                    regressed = False
+                rows.append(
+                    {
+                        "scale": scale,
+                        "stage": stage,
+                        "metric": metric,
+                        "baseline": old,
+                        "current": new,
+                        "ratio": new / old if old else None,
+                        "regressed": regressed,
+                    }
+                )
+    return rows
+
+
+def _run_scale(scale: Scale, repeat: int) -> Dict[str, Dict]:
+    with transaction.atomic():
+        SyntheticSource.periods = scale.periods
+        timeseries = [
+            models.TimeSeries.objects.create(
+                name=f"benchmark_{i}", source="SYNTHETIC"
+            )
+            for i in range(scale.n_targets + N_FEATURES)
+        ]
+        data_config = models.DataConfig.objects.create(name="benchmark")
+        models.DataTargets.objects.bulk_create(
+            models.DataTargets(config=data_config, timeseries=ts)
+            for ts in timeseries[: scale.n_targets]
+        )
+        models.DataFeatures.objects.bulk_create(
+            models.DataFeatures(config=data_config, timeseries=ts)
+            for ts in timeseries[scale.n_targets :]
+        )
+        lags = list(range(scale.n_lags))
+        prep_params = {"horizon": 1, "target_lags": lags, "feature_lags": lags}
+        ml_model = models.MLModel.objects.create(
+            name="benchmark",
+            ml_config=models.MLConfig.objects.create(
+                params={"n_estimators": 50, "verbose": -1}
+            ),
+            data_config=data_config,
+            preprocess_config=models.PreprocessingConfig.objects.create(
+                name="benchmark", params=prep_params
+            ),
+        )
+        target_ts = data_config.targets.all()
+        feature_ts = data_config.features.all()
+        client = Client()
+        client.force_login(User.objects.create(username="benchmark"))
+        loaded = {}
+
+        def load():
+            loaded["data"], _ = load_data(target_ts, feature_ts)
+
+        def ingest():
+            # Fetched again: rolled back runs leave the objects outdated.
+            _, failed = update_all_timeseries(
+                models.TimeSeries.objects.filter(
+                    id__in=[ts.id for ts in timeseries]
+                )
+            )
+            if failed:
+                raise RuntimeError(f"Ingestion failed: {failed}")
+
+        def update():
+            SyntheticSource.periods = scale.periods + N_APPENDED
+            ingest()
+
+        def get(url, **params):
+            def request():
+                response = client.get(url, params)
+                if response.status_code >= 300:
+                    raise RuntimeError(f"{url}: {response.status_code}")
+                # Consume streamed responses.
+                b"".join(response)
+
+            return request
+
+        stages = {
+            "ingest": ingest,
+            "update": update,
+            "load_data": load,
+            "build_x_y": lambda: preprocess(loaded["data"], prep_params),
+            "train": lambda: train_pipeline(ml_model, incremental=False),
+            "predict": lambda: inference_pipeline(ml_model),
+            "api: latest-values": get(
+                f"/gtrends/timeseries/{timeseries[0].id}/latest-values/"
+            ),
+            "api: latest-values csv": get(
+                f"/gtrends/timeseries/{timeseries[0].id}/latest-values/",
+                output="csv",
+            ),
+            "api: predict": get(f"/gtrends/model/{ml_model.id}/predict/"),
+            "api: train": get(f"/gtrends/model/{ml_model.id}/train/"),
+        }
+        results = {name: _measure(fn, repeat) for name, fn in stages.items()}
+        transaction.set_rollback(True)
+    return results
+
+
+def _measure(fn: Callable[[], object], repeat: int) -> Dict:
+    """Peak memory and queries of a first run, best time of `repeat` more.
+
+    Every run but the last is rolled back, so that they all start from the
+    same state.
+    """
+    seconds = []
+    for i in range(repeat + 1):
+        engine_cache.clear()
+        prediction_cache.get_cache().clear()
+        savepoint = transaction.savepoint()
+        if i == 0:
+            queries = _QueryCounter()
+            tracemalloc.start()
+            with connection.execute_wrapper(queries):
+                fn()
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            start = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - start)
+        if i < repeat:
+            transaction.savepoint_rollback(savepoint)
+        else:
+            transaction.savepoint_commit(savepoint)
+    return {
+        "seconds": min(seconds),
+        "peak_memory": peak_memory,
+        "queries": queries.count,
+    }
+
+
+class _QueryCounter:
+    """Database execute wrapper counting the queries.
+
+    Unlike `connection.queries`, it is not capped to the last 9000 queries.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
@@ -1,52 +1,244 @@
+"""Data sources, downloading the values of timeseries.
+
+A data source is a `DataSource` subclass registered under the name stored in
+`TimeSeries.source`, with the `register_source` decorator. Besides
+`download`, it declares what it supports:
+    - `max_batch_size`: the number of timeseries a single request can
+      fetch, see `download_many` and `batch_size`;
+    - `supports_since`: whether `download` can only fetch the values from a
+      given time on, instead of the whole history;
+    - `create_session`: a client reused by all the downloads of a thread.
+Raw responses can be cached on disk with `cached`.
+"""
+
 import datetime as dt
+import hashlib
+import json
+import os
+import threading
 from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional
 
 import pandas as pd
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
 from gtrends.models import TimeSeries
+from gtrends.services import metrics
 from pytrends.request import TrendReq
 
 
-def download_data(timeseries: TimeSeries) -> pd.DataFrame:
-    return DATASOURCE_MAP[timeseries.source](timeseries).download()
+@metrics.timed
+def download_data(
+    timeseries: TimeSeries, since: Optional[dt.datetime] = None
+) -> pd.DataFrame:
+    return DATASOURCE_MAP[timeseries.source](timeseries).download(since)
+
+
+DATASOURCE_MAP = {}
+
+
+def register_source(name: str):
+    """Class decorator, registering a data source under `name`."""
+
+    def register(source_cls):
+        DATASOURCE_MAP[name] = source_cls
+        return source_cls
+
+    return register
 
 
 class DataSource(ABC):
+    # Number of timeseries fetched by a single request of `download_many`.
+    max_batch_size = 1
+    # Whether `download` honours its `since` argument.
+    supports_since = False
+
+    # Sessions of each thread, by source class.
+    _local = threading.local()
+
     def __init__(self, timeseries: TimeSeries):
         self.timeseries = timeseries
 
     @abstractmethod
-    def download(self) -> pd.DataFrame:
-        """Returns a dataframe with time as index and value as column."""
+    def download(self, since: Optional[dt.datetime] = None) -> pd.DataFrame:
+        """Returns a dataframe with time as index and value as column.
+
+        Sources supporting it only return values from `since` on, if given.
+        """
+
+    @classmethod
+    def download_many(
+        cls,
+        timeseries: List[TimeSeries],
+        since: Optional[dt.datetime] = None,
+    ) -> Dict[str, pd.DataFrame]:
+        """Download up to `max_batch_size` timeseries, by name.
+
+        Sources able to fetch several timeseries in one request override
+        this, by default they are downloaded one by one.
+        """
+        return {ts.name: cls(ts).download(since) for ts in timeseries}
+
+    @classmethod
+    def batch_size(cls) -> int:
+        """Number of timeseries to download with each `download_many`."""
+        return cls.max_batch_size
+
+    @classmethod
+    def create_session(cls):
+        """Build a client for the source, None if it does not need one."""
+        return None
+
+    @classmethod
+    def get_session(cls):
+        """The session of the current thread, reused across downloads."""
+        sessions = cls._local.__dict__.setdefault("sessions", {})
+        if cls not in sessions:
+            sessions[cls] = cls.create_session()
+        return sessions[cls]
+
+    @classmethod
+    def cached(cls, request: Dict, fetch: Callable[[], object]):
+        """Return the cached response to `request`, or fetch and cache it.
+
+        Responses are stored in the DATASOURCE_CACHE_ALIAS cache (on disk by
+        default), under a hash of the source and the request, for
+        DATASOURCE_CACHE_TTL seconds.
+        """
+        key = hashlib.sha256(
+            json.dumps(
+                [cls.__name__, request], sort_keys=True, default=str
+            ).encode()
+        ).hexdigest()
+        cache = caches[settings.DATASOURCE_CACHE_ALIAS]
+        response = cache.get(key)
+        if response is None:
+            response = fetch()
+            cache.set(key, response)
+        return response
 
 
+@register_source("GOOGLE_TRENDS")
 class GTrendSource(DataSource):
     START_DATE = "2022-01-01"
+    # Maximum number of terms of a Google Trends payload.
+    max_batch_size = 5
+    # Google Trends scales values to 0-100 over the requested timeframe:
+    # a shorter timeframe would change all the values.
+    supports_since = False
+
+    def download(self, since: Optional[dt.datetime] = None) -> pd.DataFrame:
+        return self.download_many([self.timeseries])[self.timeseries.name]
+
+    @classmethod
+    def download_many(
+        cls,
+        timeseries: List[TimeSeries],
+        since: Optional[dt.datetime] = None,
+    ) -> Dict[str, pd.DataFrame]:
+        """Download up to 5 timeseries with a single payload.
 
-    def download(self) -> pd.DataFrame:
-        # Download data.
-        name = self.timeseries.name
-        data = self.download_interest_over_time(name)
+        Google Trends scales all the terms of a payload together, so that
+        the maximum over all of them is 100. GTRENDS_BATCH_NORMALIZATION
+        sets how the values are stored:
+            - "joint": as returned, on the scale of the whole payload. The
+              values of a term change with the other terms of its batch.
+            - "anchor": the GTRENDS_ANCHOR_TERM is added to every payload
+              (of 4 timeseries then), and values are scaled to its maximum
+              of 100. With an anchor more searched than the timeseries,
+              values do not depend on the other terms of the batch.
+            - "per_term": each timeseries is scaled back to its own
+              maximum of 100, as if downloaded alone, but for a rounding
+              that depends on the other terms of the batch.
+        """
+        names = [ts.name for ts in timeseries]
+        normalization = settings.GTRENDS_BATCH_NORMALIZATION
+        terms = list(names)
+        if normalization == "anchor":
+            anchor = settings.GTRENDS_ANCHOR_TERM
+            if not anchor:
+                raise ValueError("GTRENDS_ANCHOR_TERM is not set.")
+            if anchor not in terms:
+                terms.append(anchor)
+        data = cls.download_interest_over_time(terms)
+        if data.empty:
+            return {}
         # Format new data.
-        data = (
-            data[~data.isPartial]
-            .reset_index()
-            .rename(columns={name: "value", "date": "time"})
-            .set_index("time")
-        )[["value"]]
-        data["value"] = data["value"].astype(float)
-        return data
+        data = data[~data.isPartial].rename_axis("time")[terms].astype(float)
+        if normalization == "anchor":
+            peak = data[anchor].max()
+            if not peak > 0:
+                raise ValueError(f"Anchor term {anchor} has no searches.")
+            data = data / peak * 100
+        elif normalization == "per_term":
+            peaks = data.max()
+            data = data.div(peaks.where(peaks > 0), axis=1).fillna(0) * 100
+        return {
+            name: data[[name]].rename(columns={name: "value"}) for name in names
+        }
 
     @classmethod
-    def download_interest_over_time(cls, search_term: str) -> pd.DataFrame:
+    def batch_size(cls) -> int:
+        if settings.GTRENDS_BATCH_NORMALIZATION == "anchor":
+            # One term of each payload is the anchor.
+            return cls.max_batch_size - 1
+        return cls.max_batch_size
+
+    @classmethod
+    def download_interest_over_time(
+        cls, search_terms: List[str]
+    ) -> pd.DataFrame:
         """Download Google Trends data."""
-        pytrends = TrendReq()
         timeframe = (
             cls.START_DATE + " " + dt.datetime.now().strftime("%Y-%m-%d")
         )
-        pytrends.build_payload([search_term], timeframe=timeframe)
-        return pytrends.interest_over_time()
+
+        def fetch():
+            pytrends = cls.get_session()
+            pytrends.build_payload(search_terms, timeframe=timeframe)
+            return pytrends.interest_over_time()
+
+        return cls.cached(
+            {"kw_list": search_terms, "timeframe": timeframe}, fetch
+        )
+
+    @classmethod
+    def create_session(cls) -> TrendReq:
+        return TrendReq()
+
+
+@register_source("LOCAL_FILE")
+class LocalFileSource(DataSource):
+    """Values read from a CSV or Parquet file of DATASOURCE_LOCAL_DIR.
+
+    The file is named after the timeseries, "<name>.csv" or
+    "<name>.parquet", and has "time" and "value" columns. Parquet files need
+    pyarrow or fastparquet.
+    """
+
+    supports_since = True
+
+    def download(self, since: Optional[dt.datetime] = None) -> pd.DataFrame:
+        path = os.path.join(settings.DATASOURCE_LOCAL_DIR, self.timeseries.name)
+        if os.path.exists(path + ".parquet"):
+            data = pd.read_parquet(path + ".parquet", columns=["time", "value"])
+        else:
+            data = pd.read_csv(path + ".csv", usecols=["time", "value"])
+        data["time"] = pd.to_datetime(data["time"])
+        data = data.set_index("time")[["value"]].astype(float)
+        if since is not None:
+            data = data[data.index >= _as_index_time(since, data.index)]
+        return data
 
 
-DATASOURCE_MAP = {
-    "GOOGLE_TRENDS": GTrendSource,
-}
+def _as_index_time(time: dt.datetime, index: pd.DatetimeIndex) -> pd.Timestamp:
+    """Compare `time` with an index, whether the index has a timezone or not."""
+    time = pd.Timestamp(time)
+    if index.tz is None and time.tz is not None:
+        # Naive times are in the default timezone, see `update_timeseries`.
+        default_tz = timezone.get_default_timezone()
+        return time.tz_convert(default_tz).tz_localize(None)
+    if index.tz is not None and time.tz is None:
+        return time.tz_localize(index.tz)
+    return time
@@ -0,0 +1,177 @@
+"""On-disk store of feature matrices, shared between models and processes.
+
+Models with the same DataConfig and preprocessing params are trained (and
+predict) on the same features: these are built once per data version and
+stored under FEATURE_STORE_DIR, in a directory per matrix holding:
+    - x.npy: the features, column-major so that each column is contiguous;
+    - y.npy: the target, if any;
+    - index.npz: the times, ts_name codes and horizons of the rows;
+    - meta.json: the column and series names, and the build metadata.
+The arrays of x and y are read memory-mapped. The least recently used
+matrices are removed once the store exceeds FEATURE_STORE_MAX_BYTES.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+# Bumped whenever the way features are built or stored changes.
+FORMAT_VERSION = 1
+
+
+class Features(NamedTuple):
+    x: pd.DataFrame
+    y: Optional[pd.Series]
+    # E.g. the data versions the features were built from.
+    metadata: Dict
+
+
+def feature_key(
+    kind: str,
+    data_config_id: int,
+    prep_params: Dict,
+    data_versions: Dict[int, Tuple[int, str, int]],
+) -> str:
+    """Build the key of a feature matrix.
+
+    Args:
+        kind: What the matrix is for, e.g. "train" or "latest".
+        data_config_id: Id of the DataConfig of the input timeseries.
+        prep_params: Params of the PreprocessingConfig.
+        data_versions: Latest TSVersion id, creation time and number of
+            values of each input timeseries, as returned by
+            `load_data_versions`: values appended to a version change the
+            key too, and so does a new database reusing the ids.
+    """
+    content = json.dumps(
+        [FORMAT_VERSION, prep_params, sorted(data_versions.items())],
+        sort_keys=True,
+    )
+    digest = hashlib.sha1(content.encode()).hexdigest()
+    return f"{kind}-{data_config_id}-{digest}"
+
+
+def get(key: str) -> Optional[Features]:
+    """Read a stored matrix, None if missing or if the store is disabled."""
+    if not settings.FEATURE_STORE_DIR:
+        return None
+    path = _path(key)
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        x_values = np.load(os.path.join(path, "x.npy"), mmap_mode="r")
+        y_values = None
+        if meta["y_name"] is not None:
+            y_values = np.load(os.path.join(path, "y.npy"), mmap_mode="r")
+        with np.load(os.path.join(path, "index.npz")) as arrays:
+            index = _read_index(arrays, meta)
+        # Mark as recently used.
+        os.utime(path)
+    except FileNotFoundError:
+        # Never stored, or evicted meanwhile.
+        return None
+
+    x = pd.DataFrame(x_values, index=index, columns=meta["columns"], copy=False)
+    y = None
+    if y_values is not None:
+        y = pd.Series(y_values, index=index, name=meta["y_name"], copy=False)
+    return Features(x, y, meta["metadata"])
+
+
+def put(key: str, x: pd.DataFrame, y: Optional[pd.Series], metadata: Dict):
+    """Store a matrix, then evict the least recently used ones if needed."""
+    if not settings.FEATURE_STORE_DIR:
+        return
+    os.makedirs(settings.FEATURE_STORE_DIR, exist_ok=True)
+    # Written aside then renamed, so that readers never see a partial one.
+    tmp_path = tempfile.mkdtemp(dir=settings.FEATURE_STORE_DIR, prefix=".")
+    try:
+        np.save(
+            os.path.join(tmp_path, "x.npy"),
+            np.asfortranarray(x.to_numpy(dtype=float)),
+        )
+        if y is not None:
+            np.save(os.path.join(tmp_path, "y.npy"), y.to_numpy(dtype=float))
+        meta = _write_index(os.path.join(tmp_path, "index.npz"), x.index)
+        meta.update(
+            columns=list(x.columns),
+            y_name=None if y is None else y.name,
+            metadata=metadata,
+        )
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        os.rename(tmp_path, _path(key))
+    except OSError:
+        # E.g. stored meanwhile by another process, or no space left: the
+        # store is only a cache.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    _evict(settings.FEATURE_STORE_MAX_BYTES)
+
+
+def get_or_build(key: str, build: Callable[[], Features]) -> Features:
+    """Read a stored matrix, or build and store it."""
+    features = get(key)
+    if features is None:
+        features = Features(*build())
+        put(key, *features)
+    return features
+
+
+def _path(key: str) -> str:
+    return os.path.join(settings.FEATURE_STORE_DIR, key)
+
+
+def _write_index(path: str, index: pd.MultiIndex) -> Dict:
+    """Save the levels of a (time, ts_name[, horizon]) index."""
+    times = index.get_level_values("time")
+    codes, names = pd.factorize(index.get_level_values("ts_name"))
+    arrays = {"time": times.asi8, "ts_name": codes}
+    if "horizon" in index.names:
+        arrays["horizon"] = index.get_level_values("horizon").to_numpy()
+    np.savez(path, **arrays)
+    return {
+        "index_names": list(index.names),
+        "tz": None if times.tz is None else str(times.tz),
+        "ts_names": list(names),
+    }
+
+
+def _read_index(arrays, meta: Dict) -> pd.MultiIndex:
+    times = pd.DatetimeIndex(arrays["time"].view("datetime64[ns]"))
+    if meta["tz"] is not None:
+        times = times.tz_localize("UTC").tz_convert(meta["tz"])
+    levels = [
+        times,
+        np.asarray(meta["ts_names"], dtype=object)[arrays["ts_name"]],
+    ]
+    if "horizon" in meta["index_names"]:
+        levels.append(arrays["horizon"])
+    return pd.MultiIndex.from_arrays(levels, names=meta["index_names"])
+
+
+def _evict(max_bytes: int):
+    """Remove the least recently used matrices, down to `max_bytes`."""
+    entries = []
+    with os.scandir(settings.FEATURE_STORE_DIR) as it:
+        for entry in it:
+            if entry.name.startswith("."):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime_ns, size, entry.path))
+            except FileNotFoundError:
+                continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
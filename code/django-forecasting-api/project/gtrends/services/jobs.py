@@ -0,0 +1,112 @@
+import traceback
+from typing import Dict, List, Optional
+
+from django.utils import timezone
+from gtrends.models import Job, JobKind, JobStatus, MLModel
+from gtrends.services.pipelines import (
+    backtest_pipeline,
+    train_all_pipeline,
+    train_pipeline,
+)
+from gtrends.services.tasks import update_all_timeseries
+
+
+def enqueue(kind: JobKind, **params) -> Job:
+    """Create a pending job, to be run by the `run_worker` command."""
+    return Job.objects.create(kind=kind, params=params)
+
+
+def claim_next_job() -> Optional[Job]:
+    """Mark the oldest pending job as running and return it.
+
+    The status is switched with a conditional update, so that a job is
+    claimed by a single worker even if several of them are polling.
+    """
+    while True:
+        job = (
+            Job.objects.filter(status=JobStatus.PENDING)
+            .order_by("created_at", "id")
+            .first()
+        )
+        if job is None:
+            return None
+        claimed = Job.objects.filter(
+            id=job.id, status=JobStatus.PENDING
+        ).update(status=JobStatus.RUNNING, started_at=timezone.now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def run_job(job_id: int) -> str:
+    """Run a claimed job and store its outcome. Return the final status."""
+    job = Job.objects.get(id=job_id)
+    try:
+        job.result = JOB_HANDLERS[job.kind](**job.params)
+        job.status = JobStatus.SUCCEEDED
+    except Exception:
+        job.error = traceback.format_exc()
+        job.status = JobStatus.FAILED
+    job.finished_at = timezone.now()
+    job.save(update_fields=["result", "error", "status", "finished_at"])
+    return job.status
+
+
+def fail_job(job_id: int, error: str) -> str:
+    """Mark a job as failed, e.g. if the process running it crashed."""
+    Job.objects.filter(id=job_id).update(
+        status=JobStatus.FAILED, error=error, finished_at=timezone.now()
+    )
+    return JobStatus.FAILED
+
+
+def requeue_job(job_id: int) -> None:
+    """Put a claimed job back in the queue, e.g. if it could not be started."""
+    Job.objects.filter(id=job_id, status=JobStatus.RUNNING).update(
+        status=JobStatus.PENDING, started_at=None
+    )
+
+
+def _backtest(ml_model_id: int, **params) -> Dict:
+    ml_model = MLModel.objects.get(id=ml_model_id)
+    report = backtest_pipeline(ml_model, **params)
+    return {key: value for key, value in report.items() if key != "data"}
+
+
+def _train(ml_model_id: int, incremental: Optional[bool] = None) -> Dict:
+    ml_model = MLModel.objects.get(id=ml_model_id)
+    ml_model_version = train_pipeline(ml_model, incremental)
+    return {
+        "ml_model_version": ml_model_version.id,
+        "mode": ml_model_version.metadata["training"]["mode"],
+    }
+
+
+def _train_all(ml_model_ids: Optional[List[int]] = None) -> Dict:
+    ml_models = None
+    if ml_model_ids is not None:
+        ml_models = MLModel.objects.filter(id__in=ml_model_ids)
+    trained, failed = train_all_pipeline(ml_models)
+    return {
+        "trained": trained,
+        "failed": {name: str(error) for name, error in failed.items()},
+    }
+
+
+def _update_all_timeseries() -> Dict:
+    updated, failed = update_all_timeseries()
+    return {
+        "updated": {
+            name: {"new_version": new_version, "new_values": how_many}
+            for name, (new_version, how_many) in updated.items()
+        },
+        "failed": {name: str(error) for name, error in failed.items()},
+    }
+
+
+JOB_HANDLERS = {
+    JobKind.BACKTEST: _backtest,
+    JobKind.TRAIN: _train,
+    JobKind.TRAIN_ALL: _train_all,
+    JobKind.UPDATE_ALL_TIMESERIES: _update_all_timeseries,
+}
@@ -0,0 +1,169 @@
+"""In-process metrics, exposed in the Prometheus text format.
+
+Stages (tasks, pipelines, model loading and prediction) are timed with the
+`timed` decorator or the `stage` context manager, requests by
+`gtrends.middleware.MetricsMiddleware`. Metrics are kept per process: with
+several server processes each one is scraped separately, and the stages
+run in a process pool (e.g. by `train_all_pipeline`) are not recorded.
+"""
+
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# All the metrics, in the order they are rendered.
+REGISTRY: List["Counter"] = []
+
+
+class Counter:
+    """A monotonic counter, by label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[Tuple[str, Dict, float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Histogram(Counter):
+    """Observations counted in cumulative `BUCKETS`, with their sum."""
+
+    kind = "histogram"
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # Bucket counts, then the total count and the sum.
+            state = self._values.setdefault(key, [0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                state[i] += value <= bound
+            state[-2] += 1
+            state[-1] += value
+
+    def inc(self, amount: float = 1, **labels):
+        raise TypeError("Histograms are updated with `observe`.")
+
+    def value(self, **labels) -> float:
+        """The number of observations."""
+        state = self._values.get(self._key(labels))
+        return state[-2] if state else 0
+
+    def samples(self) -> Iterator[Tuple[str, Dict, float]]:
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        for key, state in values:
+            labels = dict(zip(self.labelnames, key))
+            for count, bound in zip(state, BUCKETS):
+                yield f"{self.name}_bucket", {**labels, "le": bound}, count
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, state[-2]
+            yield f"{self.name}_count", labels, state[-2]
+            yield f"{self.name}_sum", labels, state[-1]
+
+
+STAGE_SECONDS = Histogram(
+    "gtrends_stage_seconds", "Duration of the pipeline stages.", ("stage",)
+)
+STAGE_ERRORS = Counter(
+    "gtrends_stage_errors_total",
+    "Number of pipeline stages which raised.",
+    ("stage",),
+)
+REQUEST_SECONDS = Histogram(
+    "gtrends_request_seconds", "Duration of the requests.", ("view", "method")
+)
+REQUESTS = Counter(
+    "gtrends_requests_total",
+    "Number of requests, by response status.",
+    ("view", "method", "status"),
+)
+REQUEST_QUERIES = Counter(
+    "gtrends_request_queries_total",
+    "Number of SQL queries run by the requests.",
+    ("view",),
+)
+REQUEST_QUERY_SECONDS = Counter(
+    "gtrends_request_query_seconds_total",
+    "Time spent in the SQL queries of the requests.",
+    ("view",),
+)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block of code as a stage, counting it as failed if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+
+def timed(fn):
+    """Decorator timing each call of a function as a stage of its name."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with stage(fn.__name__):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def render() -> str:
+    """All the metrics, in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            if labels:
+                label_str = ",".join(
+                    f'{key}="{_escape(value)}"' for key, value in labels.items()
+                )
+                name = f"{name}{{{label_str}}}"
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def clear():
+    for metric in REGISTRY:
+        metric.clear()
+
+
+def _escape(value) -> str:
+    return (
+        str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+    )
@@ -1,9 +1,315 @@
+import bz2
+import gzip
+import json
+import lzma
+import threading
+from collections import OrderedDict
+from statistics import NormalDist
+from typing import Dict, List, Optional, Tuple, Union
+
 import lightgbm
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.core.files import File
+from gtrends.services import metrics
+from lightgbm import LGBMRegressor
+
+# Compression of model files, by name: (file suffix, compress, decompress).
+COMPRESSIONS = {
+    "gzip": (".gz", gzip.compress, gzip.decompress),
+    "bz2": (".bz2", bz2.compress, bz2.decompress),
+    "lzma": (".xz", lzma.compress, lzma.decompress),
+}
+
+# Post-processing of the predicted quantiles, making them non-crossing.
+NON_CROSSING = ["sort", "normal"]
+
+
+class QuantileEngine:
+    """A booster per quantile, predicting all of them from the same rows.
+
+    Args:
+        boosters: The boosters, by quantile.
+        non_crossing: How to make the predicted quantiles of each row
+            increasing, None to keep them as predicted:
+                - "sort": sort them (monotone rearrangement);
+                - "normal": replace them with the quantiles of the normal
+                  distribution fitted to them by least squares.
+    """
+
+    def __init__(
+        self,
+        boosters: Dict[float, lightgbm.Booster],
+        non_crossing: Optional[str] = None,
+    ):
+        if non_crossing is not None and non_crossing not in NON_CROSSING:
+            raise ValueError(
+                f"Unknown non_crossing {non_crossing!r}, "
+                f"expected one of {NON_CROSSING}."
+            )
+        self.quantiles = sorted(boosters)
+        self.boosters = boosters
+        self.non_crossing = non_crossing
+
+    def predict(self, x) -> np.ndarray:
+        """The predictions, with a column per quantile, in increasing order."""
+        preds = np.column_stack(
+            [self.boosters[q].predict(x) for q in self.quantiles]
+        )
+        if self.non_crossing == "sort":
+            preds.sort(axis=1)
+        elif self.non_crossing == "normal":
+            preds = _match_normal(self.quantiles, preds)
+        return preds
+
+    def model_to_string(self) -> str:
+        return json.dumps(
+            {
+                "quantiles": self.quantiles,
+                "non_crossing": self.non_crossing,
+                "models": [
+                    self.boosters[q].model_to_string() for q in self.quantiles
+                ],
+            }
+        )
+
+    @classmethod
+    def from_bundle(cls, bundle: Dict) -> "QuantileEngine":
+        boosters = {
+            q: lightgbm.Booster(model_str=model)
+            for q, model in zip(bundle["quantiles"], bundle["models"])
+        }
+        return cls(boosters, bundle["non_crossing"])
+
+
+class PartitionedEngine:
+    """A model per partition of the targets, e.g. per series or cluster.
+
+    Args:
+        engines: The model of each partition, by partition name.
+        routes: The partition of each target, by ts_name.
+    """
+
+    def __init__(
+        self,
+        engines: Dict[str, Union[lightgbm.Booster, QuantileEngine]],
+        routes: Dict[str, str],
+    ):
+        self.engines = engines
+        self.routes = routes
+        self.partitions = list(engines)
+
+    @property
+    def quantiles(self) -> Optional[List[float]]:
+        return engine_quantiles(next(iter(self.engines.values())))
+
+    def predict(self, x: pd.DataFrame) -> np.ndarray:
+        """Predict the rows of each partition with its model.
+
+        Rows are routed by the "ts_name" level of the index, through the
+        codes of the distinct names rather than row by row.
+        """
+        codes, names = pd.factorize(x.index.get_level_values("ts_name"))
+        unknown = [name for name in names if name not in self.routes]
+        if unknown:
+            raise ValueError(f"No partition for the targets: {unknown}")
+        partition_codes = pd.Index(self.partitions).get_indexer(
+            [self.routes[name] for name in names]
+        )
+        row_partitions = partition_codes[codes]
+
+        preds = None
+        for i, partition in enumerate(self.partitions):
+            rows = np.flatnonzero(row_partitions == i)
+            if not len(rows):
+                continue
+            partition_preds = self.engines[partition].predict(x.iloc[rows])
+            if preds is None:
+                preds = np.empty((len(x), *partition_preds.shape[1:]))
+            preds[rows] = partition_preds
+        return preds
+
+    def model_to_string(self) -> str:
+        return json.dumps(
+            {
+                "routes": self.routes,
+                "models": {
+                    partition: engine.model_to_string()
+                    for partition, engine in self.engines.items()
+                },
+            }
+        )
+
+    @classmethod
+    def from_bundle(cls, bundle: Dict) -> "PartitionedEngine":
+        engines = {
+            partition: parse_engine(model)
+            for partition, model in bundle["models"].items()
+        }
+        return cls(engines, bundle["routes"])
+
+
+# A single booster, or a bundle of them.
+Engine = Union[lightgbm.Booster, QuantileEngine, PartitionedEngine]
+
+
+def engine_quantiles(engine: Engine) -> Optional[List[float]]:
+    """The quantiles predicted by a model, None for a point forecast."""
+    if isinstance(engine, (QuantileEngine, PartitionedEngine)):
+        return engine.quantiles
+    return None
+
+
+def dump_engine(
+    model: Union[LGBMRegressor, QuantileEngine, PartitionedEngine],
+    compression: Optional[str] = None,
+) -> Tuple[bytes, str]:
+    """Serialize a fitted model in memory, without going through a file.
+
+    Returns:
+        The model file content, and the suffix of its name (".txt", or
+        ".json" for a bundle of boosters, followed by the suffix of the
+        compression, if any).
+    """
+    if isinstance(model, (QuantileEngine, PartitionedEngine)):
+        content, suffix = model.model_to_string().encode(), ".json"
+    else:
+        content, suffix = model.booster_.model_to_string().encode(), ".txt"
+    if compression is None:
+        return content, suffix
+    compression_suffix, compress, _ = COMPRESSIONS[compression]
+    return compress(content), suffix + compression_suffix
+
+
+def read_model_str(ml_file: File) -> str:
+    """Read a model file, decompressed according to its name suffix."""
+    with ml_file.open("rb") as f:
+        content = f.read()
+    for suffix, _, decompress in COMPRESSIONS.values():
+        if ml_file.name.endswith(suffix):
+            content = decompress(content)
+            break
+    return content.decode()
+
+
+def parse_engine(model_str: str) -> Engine:
+    """Load a booster, or a bundle of them saved as JSON."""
+    if not model_str.startswith("{"):
+        return lightgbm.Booster(model_str=model_str)
+    bundle = json.loads(model_str)
+    if "routes" in bundle:
+        return PartitionedEngine.from_bundle(bundle)
+    return QuantileEngine.from_bundle(bundle)
+
+
+@metrics.timed
+def load_engine(ml_file: File) -> Engine:
+    """Load a booster straight from the model string, without a temp file."""
+    return parse_engine(read_model_str(ml_file))
+
+
+class EngineCache:
+    """In-process LRU cache of boosters, keyed by MLModelVersion id.
+
+    Versions are immutable, so a cached booster never goes stale: a new
+    version simply gets a new key. Older versions of a model are evicted
+    as soon as a new one is saved, to free memory early.
+
+    Args:
+        max_size: Maximum number of boosters kept in memory.
+        max_bytes: Maximum total size of the cached (uncompressed) models.
+    """
+
+    def __init__(self, max_size: int, max_bytes: int):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # version id -> (booster, ml_model id, size in bytes)
+        self._engines = OrderedDict()
+        self._bytes = 0
+
+    def get(self, ml_model_version) -> Engine:
+        key = ml_model_version.id
+        with self._lock:
+            if key in self._engines:
+                self.hits += 1
+                self._engines.move_to_end(key)
+                return self._engines[key][0]
+            self.misses += 1
+
+        # Parse the model outside the lock, it is the slow part.
+        with metrics.stage("load_engine"):
+            model_str = read_model_str(ml_model_version.ml_file)
+            engine = parse_engine(model_str)
+        # The model file may be compressed, count the uncompressed size.
+        size = len(model_str)
+
+        with self._lock:
+            if key not in self._engines:
+                self._engines[key] = (
+                    engine,
+                    ml_model_version.ml_model_id,
+                    size,
+                )
+                self._bytes += size
+                self._evict()
+        return engine
+
+    def evict_model(self, ml_model_id: int):
+        """Drop all the cached versions of a model."""
+        with self._lock:
+            for key, (_, model_id, _) in list(self._engines.items()):
+                if model_id == ml_model_id:
+                    self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._engines):
+                self._pop(key)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._engines),
+                "bytes": self._bytes,
+            }
+
+    def _evict(self):
+        while self._engines and (
+            len(self._engines) > self.max_size or self._bytes > self.max_bytes
+        ):
+            self._pop(next(iter(self._engines)))
+
+    def _pop(self, key):
+        _, _, size = self._engines.pop(key)
+        self._bytes -= size
+        self.evictions += 1
+
 
+def _match_normal(quantiles: List[float], preds: np.ndarray) -> np.ndarray:
+    """Fit a normal distribution to the quantiles of each row.
 
-def save_engine(model, path):
-    model.booster_.save_model(path)
+    The quantile q of N(mu, sigma) is mu + sigma * z_q, with z_q the one of
+    N(0, 1): mu and sigma are a least squares fit of the predictions on z_q,
+    sigma being clipped to 0 so that the quantiles never decrease.
+    """
+    z = np.array([NormalDist().inv_cdf(q) for q in quantiles])
+    z_centered = z - z.mean()
+    mean = preds.mean(axis=1, keepdims=True)
+    sigma = (preds - mean) @ z_centered / (z_centered @ z_centered)
+    sigma = np.clip(sigma, 0, None)[:, np.newaxis]
+    mu = mean - sigma * z.mean()
+    return mu + sigma * z
 
 
-def load_engine(path):
-    return lightgbm.Booster(model_file=path)
+engine_cache = EngineCache(
+    max_size=settings.ENGINE_CACHE_MAX_SIZE,
+    max_bytes=settings.ENGINE_CACHE_MAX_BYTES,
+)
@@ -0,0 +1,57 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+
+def split_cpu_budget(
+    cpu_budget: int, n_tasks: int, processes: Optional[int] = None
+) -> Tuple[int, int]:
+    """Split cores between pool processes and threads per process.
+
+    Args:
+        cpu_budget: Number of cores to use.
+        n_tasks: Number of tasks to run, no more processes are started.
+        processes: Number of processes, as many as the budget allows by
+            default.
+
+    Returns:
+        The number of processes and the number of threads of each of them.
+    """
+    cpu_budget = max(1, cpu_budget)
+    if processes is None:
+        processes = min(max(1, n_tasks), cpu_budget)
+    processes = max(1, min(processes, cpu_budget))
+    return processes, max(1, cpu_budget // processes)
+
+
+def with_n_jobs(model_params: Dict, n_jobs: int) -> Dict:
+    """Set the number of LightGBM threads, unless a smaller one is set."""
+    requested = model_params.get("n_jobs")
+    if isinstance(requested, int) and 0 < requested < n_jobs:
+        n_jobs = requested
+    return {**model_params, "n_jobs": n_jobs}
+
+
+def executor(processes: int):
+    """A process pool, or an inline executor for a single process."""
+    if processes == 1:
+        # Run in this process: no need to copy the arguments around.
+        return _InlineExecutor()
+    return ProcessPoolExecutor(processes)
+
+
+class _InlineExecutor:
+    """Run submitted calls right away, with the `ProcessPoolExecutor` API."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
@@ -1,2 +1,4 @@
-from .inference_pipeline import inference_pipeline
+from .inference_pipeline import batch_inference_pipeline, inference_pipeline
+from .backtest_pipeline import backtest_pipeline
 from .train_pipeline import train_pipeline
+from .train_all_pipeline import train_all_pipeline
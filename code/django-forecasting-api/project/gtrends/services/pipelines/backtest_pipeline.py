@@ -0,0 +1,52 @@
+from typing import Dict, Optional
+
+from gtrends.models import MLModel
+from gtrends.services import metrics
+from gtrends.services.tasks import (
+    backtest,
+    load_training_data,
+    max_horizon,
+)
+
+
+@metrics.timed
+def backtest_pipeline(
+    ml_model: MLModel,
+    n_folds: int = 5,
+    window: str = "expanding",
+    train_size: Optional[int] = None,
+    test_size: Optional[int] = None,
+    cpu_budget: Optional[int] = None,
+) -> Dict:
+    """Backtest the configs of a model, see `backtest` for the arguments.
+
+    The report is stored in the metadata of the current model version,
+    under "backtest", along with the data versions it was computed on.
+    """
+    ml_model.refresh_from_db(fields=["current_version"])
+    ml_model_version = ml_model.current_version
+    if ml_model_version is None:
+        raise ValueError(f"Model {ml_model.name} has not been trained.")
+
+    prep_params = ml_model.preprocess_config.params
+    x, y, metadata = load_training_data(ml_model)
+    report = backtest(
+        x,
+        y,
+        ml_model.ml_config.params,
+        # The targets of all the horizons must be known at the origin.
+        max_horizon(prep_params),
+        n_folds=n_folds,
+        window=window,
+        train_size=train_size,
+        test_size=test_size,
+        cpu_budget=cpu_budget,
+    )
+    report = {**report, "data": metadata}
+
+    ml_model_version.metadata = {
+        **ml_model_version.metadata,
+        "backtest": report,
+    }
+    ml_model_version.save(update_fields=["metadata"])
+    return report
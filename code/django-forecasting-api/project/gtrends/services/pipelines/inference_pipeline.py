@@ -1,25 +1,198 @@
-from typing import Dict
+from typing import Dict, List, Optional, Union
 
-from gtrends.models import MLModel
-from gtrends.services.ml import load_engine
-from gtrends.services.tasks import build_x_latest, load_data
+import numpy as np
+import pandas as pd
+from gtrends.models import MLModel, MLModelVersion
+from gtrends.services import feature_store, metrics, prediction_cache
+from gtrends.services.ml import engine_cache, engine_quantiles
+from gtrends.services.tasks import (
+    build_x_latest,
+    extend_tails,
+    history_size,
+    load_data_versions,
+    load_series,
+    select_data,
+)
 
 
+@metrics.timed
 def inference_pipeline(ml_model: MLModel) -> Dict:
-    if ml_model.mlmodelversion_set.count() == 0:
-        raise ValueError("No model has been trained yet!")
+    return batch_inference_pipeline([ml_model])[ml_model.id]
 
-    target_ts = ml_model.data_config.targets.all()
-    feature_ts = ml_model.data_config.features.all()
-    prep_params = ml_model.preprocess_config.params
 
-    data, _ = load_data(target_ts, feature_ts)
-    x = build_x_latest(data, prep_params)
-    engine = load_engine(ml_model.mlmodelversion_set.last().ml_file.path)
-    y_pred = engine.predict(x)
+@metrics.timed
+def batch_inference_pipeline(ml_models: List[MLModel]) -> Dict[int, Dict]:
+    """Predict with many models, sharing the work between them.
 
-    # Format predictions.
-    horizon = ml_model.preprocess_config.params["horizon"]
+    The latest features are read from the feature store, or built once per
+    DataConfig and preprocessing params, the timeseries needed by all the
+    models being loaded at most once. All the quantiles of a quantile set,
+    and all the partitions of a partitioned model, are predicted from the
+    same features.
+
+    Returns:
+        The predictions of each model, by model id.
+
+    Raises:
+        ValueError: If a model is not trained, or one of its timeseries has
+            no data.
+    """
+    ml_model_versions = _latest_model_versions(ml_models)
+    untrained = [m.name for m in ml_models if m.id not in ml_model_versions]
+    if untrained:
+        raise ValueError(f"No model has been trained yet: {untrained}")
+
+    inputs = {
+        m.id: (m.data_config.targets.all(), m.data_config.features.all())
+        for m in ml_models
+    }
+    data_versions = load_data_versions(
+        [item for target_ts, _ in inputs.values() for item in target_ts],
+        [item for _, feature_ts in inputs.values() for item in feature_ts],
+    )
+
+    # Predictions only change with the model version or the input data.
+    preds, keys, dependencies, missing = {}, {}, {}, []
+    for ml_model in ml_models:
+        target_ts, feature_ts = inputs[ml_model.id]
+        for item in [*target_ts, *feature_ts]:
+            if item.timeseries_id not in data_versions:
+                raise ValueError(
+                    f"Timeseries {item.timeseries.name} has no data."
+                )
+        dependencies[ml_model.id] = {
+            item.timeseries_id: data_versions[item.timeseries_id]
+            for item in [*target_ts, *feature_ts]
+        }
+        keys[ml_model.id] = prediction_cache.prediction_key(
+            ml_model_versions[ml_model.id].id, dependencies[ml_model.id]
+        )
+        cached = prediction_cache.get_predictions(keys[ml_model.id])
+        if cached is None:
+            missing.append(ml_model)
+        else:
+            preds[ml_model.id] = cached
+    if not missing:
+        return preds
+
+    features, series = {}, None
+    for ml_model in missing:
+        prep_params = ml_model.preprocess_config.params
+        key = feature_store.feature_key(
+            "latest",
+            ml_model.data_config_id,
+            prep_params,
+            dependencies[ml_model.id],
+        )
+        if key not in features:
+            features[key] = feature_store.get(key)
+        if features[key] is None:
+            if series is None:
+                # Only the tail of each series is needed to build the
+                # latest features.
+                last_n = max(
+                    history_size(m.preprocess_config.params) for m in missing
+                )
+                series = load_series(
+                    {ts_id for m in missing for ts_id in dependencies[m.id]},
+                    last_n,
+                )
+                series = extend_tails(
+                    series, last_n, _feature_ends(missing, inputs, series)
+                )
+            data, _ = select_data(series, *inputs[ml_model.id])
+            x = build_x_latest(data, prep_params)
+            features[key] = feature_store.Features(
+                x, None, {"last_values": _last_values(data, x)}
+            )
+            feature_store.put(key, *features[key])
+        x, _, metadata = features[key]
+
+        engine = engine_cache.get(ml_model_versions[ml_model.id])
+        with metrics.stage("predict"):
+            y_pred = engine.predict(x)
+        preds[ml_model.id] = _format_predictions(
+            metadata["last_values"],
+            x,
+            y_pred,
+            prep_params["horizon"],
+            engine_quantiles(engine),
+        )
+        prediction_cache.set_predictions(
+            keys[ml_model.id], preds[ml_model.id], dependencies[ml_model.id]
+        )
+
+    return {ml_model.id: preds[ml_model.id] for ml_model in ml_models}
+
+
+def _latest_model_versions(
+    ml_models: List[MLModel],
+) -> Dict[int, MLModelVersion]:
+    """Map each model id to its latest version, in a single query."""
+    # Read the pointers from the DB, the model objects may be outdated.
+    current = MLModel.objects.filter(id__in=[m.id for m in ml_models]).values(
+        "current_version"
+    )
+    versions = MLModelVersion.objects.filter(id__in=current)
+    return {version.ml_model_id: version for version in versions}
+
+
+def _feature_ends(
+    ml_models: List[MLModel], inputs: Dict, series: Dict
+) -> Dict[int, pd.Timestamp]:
+    """The time up to which each feature is read by the latest features.
+
+    That is the earliest last time of the targets of the models using it,
+    features may run ahead of their targets.
+    """
+    ends = {}
+    for ml_model in ml_models:
+        target_ts, feature_ts = inputs[ml_model.id]
+        last_times = [
+            series[item.timeseries_id][2].index.get_level_values("time").max()
+            for item in target_ts
+        ]
+        last_times = [time for time in last_times if not pd.isnull(time)]
+        if not last_times:
+            continue
+        end = min(last_times)
+        for item in feature_ts:
+            ends[item.timeseries_id] = min(
+                ends.get(item.timeseries_id, end), end
+            )
+    return ends
+
+
+def _last_values(data: Dict, x: pd.DataFrame) -> Dict[str, float]:
+    """The value of each target at the time of its latest features."""
+    return {
+        name: data["targets"][name].loc[time]["value"].item()
+        for time, name in zip(
+            x.index.get_level_values("time"),
+            x.index.get_level_values("ts_name"),
+        )
+    }
+
+
+def _format_predictions(
+    last_values: Dict[str, float],
+    x: pd.DataFrame,
+    y_pred,
+    horizon: Union[int, List[int]],
+    quantiles: Optional[List[float]] = None,
+) -> Dict:
+    if isinstance(horizon, list):
+        # A row per target and horizon: the forecast path of each target.
+        y_pred = y_pred.reshape(-1, len(horizon), *y_pred.shape[1:])
+        x = x.xs(horizon[0], level="horizon")
+    if quantiles is not None:
+        # A column per quantile: the prediction of each target by quantile.
+        y_pred = [
+            dict(zip(map(str, quantiles), pred))
+            for pred in np.moveaxis(y_pred, -1, 1).tolist()
+        ]
+    else:
+        y_pred = y_pred.tolist()
     preds = {
         name: {"last_date": time, "prediction": pred, "horizon": horizon}
         for time, name, pred in zip(
@@ -30,8 +203,19 @@ def inference_pipeline(ml_model: MLModel) -> Dict:
     }
 
     for k, v in preds.items():
-        last_value = data["targets"][k].loc[v["last_date"]]["value"].item()
+        last_value = last_values[k]
         preds[k]["last_value"] = last_value
-        preds[k]["predicted_delta"] = v["prediction"] - last_value
+        preds[k]["predicted_delta"] = _delta(v["prediction"], last_value)
+        if quantiles is not None:
+            preds[k]["quantiles"] = quantiles
 
     return preds
+
+
+def _delta(pred, last_value):
+    """Difference of a prediction, path or quantiles with the last value."""
+    if isinstance(pred, dict):
+        return {k: _delta(v, last_value) for k, v in pred.items()}
+    if isinstance(pred, list):
+        return [p - last_value for p in pred]
+    return pred - last_value
@@ -0,0 +1,137 @@
+import time
+from concurrent.futures import as_completed
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from gtrends.models import MLModel
+from gtrends.services import feature_store, metrics
+from gtrends.services.parallel import executor, split_cpu_budget, with_n_jobs
+from gtrends.services.tasks import (
+    load_data_versions,
+    load_series,
+    plan_training,
+    preprocess,
+    save_mlmodelversion,
+    select_data,
+    train,
+)
+
+
+@metrics.timed
+def train_all_pipeline(
+    ml_models: Optional[List[MLModel]] = None,
+    cpu_budget: Optional[int] = None,
+    processes: Optional[int] = None,
+    incremental: Optional[bool] = None,
+) -> Tuple[Dict[str, Dict], Dict[str, Exception]]:
+    """Train many models in parallel, within a CPU budget.
+
+    The training data is read from the feature store, or built once per
+    DataConfig and preprocessing params, the timeseries of all the models
+    being loaded at most once. Models are then fitted in a process pool,
+    the CPU budget being split between the pool processes and the LightGBM
+    threads of each of them.
+
+    Args:
+        ml_models: The models to train, all of them by default.
+        cpu_budget: Number of cores to use, defaults to the
+            TRAIN_CPU_BUDGET setting.
+        processes: Number of models fitted in parallel, by default as many
+            as the budget allows.
+        incremental: Training mode of each model, see `plan_training`.
+
+    Returns:
+        A pair with:
+            - dict: The new version id, the training mode and the training
+                wall time (in seconds) of each trained model, by model name.
+            - dict: The error of each model which failed, by model name.
+    """
+    if ml_models is None:
+        ml_models = MLModel.objects.select_related(
+            "ml_config", "preprocess_config"
+        ).prefetch_related("data_config__targets", "data_config__features")
+    ml_models = list(ml_models)
+    processes, n_jobs = split_cpu_budget(
+        cpu_budget or settings.TRAIN_CPU_BUDGET, len(ml_models), processes
+    )
+
+    inputs = {
+        m.id: (m.data_config.targets.all(), m.data_config.features.all())
+        for m in ml_models
+    }
+    data_versions = load_data_versions(
+        [item for target_ts, _ in inputs.values() for item in target_ts],
+        [item for _, feature_ts in inputs.values() for item in feature_ts],
+    )
+    # Timeseries without data only fail the models which depend on them.
+    ts_ids = set(data_versions)
+
+    trained, failed, training_data, series = {}, {}, {}, None
+    with executor(processes) as pool:
+        futures = {}
+        for ml_model in ml_models:
+            target_ts, feature_ts = inputs[ml_model.id]
+            prep_params = ml_model.preprocess_config.params
+            try:
+                for item in [*target_ts, *feature_ts]:
+                    if item.timeseries_id not in data_versions:
+                        raise ValueError(
+                            f"Timeseries {item.timeseries.name} has no data."
+                        )
+                key = feature_store.feature_key(
+                    "train",
+                    ml_model.data_config_id,
+                    prep_params,
+                    {
+                        item.timeseries_id: data_versions[item.timeseries_id]
+                        for item in [*target_ts, *feature_ts]
+                    },
+                )
+                if key not in training_data:
+                    training_data[key] = feature_store.get(key)
+                if training_data[key] is None:
+                    if series is None:
+                        series = load_series(ts_ids)
+                    data, metadata = select_data(series, target_ts, feature_ts)
+                    training_data[key] = feature_store.Features(
+                        *preprocess(data, prep_params), metadata
+                    )
+                    feature_store.put(key, *training_data[key])
+                x, y, metadata = training_data[key]
+                plan = plan_training(ml_model, metadata, x, y, incremental)
+            except Exception as e:
+                failed[ml_model.name] = e
+                continue
+            model_params = with_n_jobs(ml_model.ml_config.params, n_jobs)
+            future = pool.submit(
+                _timed_train, plan.x, plan.y, model_params, plan.init_model
+            )
+            futures[future] = (
+                ml_model,
+                {**metadata, "training": plan.lineage},
+            )
+
+        # Save the models as they are fitted.
+        for future in as_completed(futures):
+            ml_model, metadata = futures[future]
+            try:
+                engine, seconds = future.result()
+                ml_model_version = save_mlmodelversion(
+                    engine, ml_model, metadata
+                )
+            except Exception as e:
+                failed[ml_model.name] = e
+                continue
+            trained[ml_model.name] = {
+                "ml_model_version": ml_model_version.id,
+                "mode": metadata["training"]["mode"],
+                "seconds": seconds,
+            }
+
+    return trained, failed
+
+
+def _timed_train(x, y, model_params, init_model):
+    start = time.perf_counter()
+    engine = train(x, y, model_params, init_model)
+    return engine, time.perf_counter() - start
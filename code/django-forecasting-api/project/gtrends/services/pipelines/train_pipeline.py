@@ -1,21 +1,38 @@
+from typing import Optional
+
+from django.conf import settings
 from gtrends.models import MLModel, MLModelVersion
+from gtrends.services import metrics
 from gtrends.services.tasks import (
-    load_data,
-    preprocess,
+    load_training_data,
+    plan_training,
     save_mlmodelversion,
     train,
 )
 
 
-def train_pipeline(ml_model: MLModel) -> MLModelVersion:
-    target_ts = ml_model.data_config.targets.all()
-    feature_ts = ml_model.data_config.features.all()
-    prep_params = ml_model.preprocess_config.params
+@metrics.timed
+def train_pipeline(
+    ml_model: MLModel, incremental: Optional[bool] = None
+) -> MLModelVersion:
+    """Train a new model version, see `plan_training` for `incremental`.
+
+    The partitions of a partitioned model are fitted in parallel, within
+    the TRAIN_CPU_BUDGET setting.
+    """
     model_params = ml_model.ml_config.params
 
-    data, metadata = load_data(target_ts, feature_ts)
-    x, y = preprocess(data, prep_params)
-    engine = train(x, y, model_params)
-    ml_model_version = save_mlmodelversion(engine, ml_model, metadata)
+    x, y, metadata = load_training_data(ml_model)
+    plan = plan_training(ml_model, metadata, x, y, incremental)
+    engine = train(
+        plan.x,
+        plan.y,
+        model_params,
+        plan.init_model,
+        cpu_budget=settings.TRAIN_CPU_BUDGET,
+    )
+    ml_model_version = save_mlmodelversion(
+        engine, ml_model, {**metadata, "training": plan.lineage}
+    )
 
     return ml_model_version
@@ -0,0 +1,51 @@
+import hashlib
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def get_cache():
+    return caches[settings.PREDICTION_CACHE_ALIAS]
+
+
+def prediction_key(
+    ml_model_version_id: int, data_versions: Dict[int, Tuple[int, str, int]]
+) -> str:
+    """Build the cache key of the predictions of a model version.
+
+    Args:
+        ml_model_version_id: Id of the MLModelVersion used for inference.
+        data_versions: Latest TSVersion id, creation time and number of
+            values of each input timeseries, as returned by
+            `load_data_versions`.
+    """
+    digest = hashlib.sha1(repr(sorted(data_versions.items())).encode())
+    return f"predictions:{ml_model_version_id}:{digest.hexdigest()}"
+
+
+def get_predictions(key: str) -> Optional[Dict]:
+    return get_cache().get(key)
+
+
+def set_predictions(key: str, predictions: Dict, ts_ids):
+    """Store predictions, and remember which timeseries they depend on."""
+    cache = get_cache()
+    cache.set(key, predictions)
+    ts_keys = [_timeseries_key(ts_id) for ts_id in ts_ids]
+    dependents = cache.get_many(ts_keys)
+    cache.set_many(
+        {ts_key: dependents.get(ts_key, set()) | {key} for ts_key in ts_keys}
+    )
+
+
+def invalidate_timeseries(ts_id: int):
+    """Drop the cached predictions that depend on a timeseries."""
+    cache = get_cache()
+    ts_key = _timeseries_key(ts_id)
+    keys = cache.get(ts_key, set())
+    cache.delete_many([*keys, ts_key])
+
+
+def _timeseries_key(ts_id: int) -> str:
+    return f"predictions:timeseries:{ts_id}"
@@ -1,8 +1,10 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass, replace
+from typing import Dict, List, Tuple, Union
 
+import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
 
 class BasePreprocessor(ABC):
@@ -17,111 +19,251 @@ class BasePreprocessor(ABC):
 
 @dataclass
 class Preprocessor(BasePreprocessor):
-    horizon: int
+    """Build lagged features with NumPy on a dense (series, row) grid.
+
+    Each series is laid out on its own observed rows, so that lags and the
+    horizon count values of the series, like pandas shifts, whatever the
+    timestamps of the other series. The lags of every series are read at
+    once from a strided window view, then the feature lags are joined to
+    the target rows on time.
+
+    With a list of horizons, the rows of all the horizons are stacked, with
+    the horizon as a "horizon" feature and a "horizon" index level, so that
+    a single model forecasts the whole path.
+    """
+
+    horizon: Union[int, List[int]]
     target_lags: List[int]
     feature_lags: List[int]
 
-    def build_x_y(self, data: Dict) -> Tuple[pd.DataFrame, pd.Series]:
-        # Build x and y.
-        x = self.build_x(data)
-        y = self.build_y(data["targets"])
+    @property
+    def horizons(self) -> List[int]:
+        """The forecast horizons, a single one unless `horizon` is a list."""
+        if isinstance(self.horizon, list):
+            return self.horizon
+        return [self.horizon]
 
-        # Align x indexes with y indexes.
-        x = pd.merge(y, x, left_index=True, right_index=True, how="left")
-        x = x.iloc[:, 1:]
+    def build_x_y(self, data: Dict) -> Tuple[pd.DataFrame, pd.Series]:
+        grid = _SeriesGrid.from_data(data)
+        x = self._build_x_values(grid)
+        if isinstance(self.horizon, list):
+            return self._stack_horizons(grid, x)
+        y = self._build_y_values(grid)[:, 0]
 
         # Drop missing values generated by lags/horizon.
-        idx = ~(x.isnull().any(axis=1) | y.isnull())
-        x = x.loc[idx]
-        y = y.loc[idx]
+        idx = ~(np.isnan(x).any(axis=1) | np.isnan(y))
+        x = pd.DataFrame(
+            x[idx], index=grid.index[idx], columns=self._x_columns(grid)
+        )
+        y = pd.Series(y[idx], index=x.index, name=f"horizon_{self.horizon}")
 
         return x, y
 
     def build_x_latest(self, data: Dict) -> pd.DataFrame:
-        x = self.build_x(data)
-        return x[x.index == x.index.max()]
-
-    def build_y(self, target_data: Dict) -> pd.DataFrame:
-        y = {}
-        for name, df in target_data.items():
-            y[name] = (
-                df["value"]
-                .shift(-self.horizon)
-                .rename(f"horizon_{self.horizon}")
+        # Only the latest row of each target is built, so `data` may contain
+        # just the last `history_size` values of each series, up to the last
+        # time of the targets for the features.
+        grid = _SeriesGrid.from_data(data).latest()
+        x = self._build_x_values(grid)
+        if isinstance(self.horizon, list):
+            # A row per target and horizon, horizons of a target together.
+            n_horizons = len(self.horizon)
+            return pd.DataFrame(
+                np.column_stack(
+                    [
+                        np.repeat(x, n_horizons, axis=0),
+                        np.tile(self.horizon, len(x)),
+                    ]
+                ),
+                index=_with_horizons(
+                    grid.index.repeat(n_horizons),
+                    np.tile(self.horizon, len(x)),
+                ),
+                columns=[*self._x_columns(grid), "horizon"],
             )
-        return pd.concat(y.values())
+        return pd.DataFrame(x, index=grid.index, columns=self._x_columns(grid))
+
+    @property
+    def history_size(self) -> int:
+        """Number of past values needed to build the latest row of x."""
+        return max([0, *self.target_lags, *self.feature_lags]) + 1
+
+    def build_y(self, target_data: Dict) -> pd.Series:
+        grid = _SeriesGrid.from_data({"targets": target_data, "features": {}})
+        return pd.Series(
+            self._build_y_values(grid)[:, 0],
+            index=grid.index,
+            name=f"horizon_{self.horizon}",
+        )
 
     def build_x(self, data: Dict) -> pd.DataFrame:
-        target_data = data["targets"]
-        feature_data = data["features"]
+        grid = _SeriesGrid.from_data(data)
+        return pd.DataFrame(
+            self._build_x_values(grid),
+            index=grid.index,
+            columns=self._x_columns(grid),
+        )
+
+    def _x_columns(self, grid: "_SeriesGrid") -> List[str]:
+        columns = [f"target_lag_{lag}" for lag in self.target_lags]
+        for name in grid.feature_names:
+            columns += [f"{name}_lag_{lag}" for lag in self.feature_lags]
+        return columns
 
-        # Build x_target and x_features.
-        x_targ = self._build_x_lags_targets(target_data)
-        x_feat = self._build_x_lags_features(feature_data, target_data)
+    def _build_x_values(self, grid: "_SeriesGrid") -> np.ndarray:
+        x = []
+        if self.target_lags:
+            lags = _build_lag_tensor(grid.targets, self.target_lags)
+            x.append(lags[grid.rows])
+        if self.feature_lags and grid.feature_names:
+            lags = _build_lag_tensor(grid.features, self.feature_lags)
+            # Lags of each feature at the time of each row, NaN if the
+            # feature is not observed at that time.
+            pos = grid.feature_pos
+            lags = lags[np.arange(len(pos))[:, None], pos.clip(0)]
+            lags[pos < 0] = np.nan
+            # (features, rows, lags) -> (rows, features * lags).
+            lags = lags.transpose(1, 0, 2)
+            x.append(lags.reshape(len(lags), -1))
 
-        # Combine x_target and x_features.
-        if x_feat is None and x_targ is None:
+        if not x:
             raise ValueError("Cannot have no target lags and no feature lags.")
-        elif x_feat is None:
-            return x_targ
-        elif x_targ is None:
-            return x_feat
+        return np.hstack(x)
+
+    def _build_y_values(self, grid: "_SeriesGrid") -> np.ndarray:
+        """Targets of each row, shape (rows, horizons)."""
+        leads = _build_lag_tensor(grid.targets, [-h for h in self.horizons])
+        return leads[grid.rows]
+
+    def _stack_horizons(
+        self, grid: "_SeriesGrid", x: np.ndarray
+    ) -> Tuple[pd.DataFrame, pd.Series]:
+        """Stack the rows of each horizon, with the horizon as a feature.
 
-        return pd.merge(
-            x_targ, x_feat, left_index=True, right_index=True, how="left"
+        The rows are gathered straight into the stacked matrix, instead of
+        concatenating a copy of `x` per horizon.
+        """
+        y = self._build_y_values(grid)
+        keep = ~(np.isnan(x).any(axis=1)[:, None] | np.isnan(y))
+        # Rows and horizon positions, horizon after horizon.
+        horizon_pos, rows = np.nonzero(keep.T)
+
+        stacked = np.empty((len(rows), x.shape[1] + 1))
+        np.take(x, rows, axis=0, out=stacked[:, :-1], mode="clip")
+        horizons = np.asarray(self.horizon)[horizon_pos]
+        stacked[:, -1] = horizons
+
+        index = _with_horizons(grid.index[rows], horizons)
+        x = pd.DataFrame(
+            stacked, index=index, columns=[*self._x_columns(grid), "horizon"]
         )
+        y = pd.Series(y[rows, horizon_pos], index=index, name="target")
+        return x, y
 
-    def _build_x_lags_targets(
-        self, target_data: Dict
-    ) -> Optional[pd.DataFrame]:
-        if not self.target_lags:
-            return None
-        x = []
-        for df in target_data.values():
-            x.append(
-                _build_lags(
-                    df=df,
-                    column="value",
-                    lags=self.target_lags,
-                    prefix="target",
-                )
-            )
-        return pd.concat(x, axis=1)
 
-    def _build_x_lags_features(
-        self, feature_data: Dict, target_data: Dict
-    ) -> Optional[pd.DataFrame]:
-        if not self.feature_lags:
-            return None
-        x = []
-        for name, df in feature_data.items():
-            x.append(
-                _build_lags(
-                    df=df,
-                    column="value",
-                    lags=self.feature_lags,
-                    prefix=name,
-                )
-            )
-        # Concat features on axis 1.
-        x = pd.concat(
-            [df.reset_index().drop(columns=["ts_name"]) for df in x], axis=1
+@dataclass
+class _SeriesGrid:
+    """Series values, each series on its own rows.
+
+    The values of a series are at positions 0 to n - 1 of its row, NaN
+    after, whatever the timestamps of the other series.
+
+    Attributes:
+        targets: Target values, shape (n_targets, n_positions).
+        features: Feature values, shape (n_features, n_positions).
+        feature_names: Names of the features, in the order of `features`.
+        feature_pos: Position in each feature of the time of each target
+            row, shape (n_features, n_rows), -1 if the feature is missing.
+        rows: Target and position of the observed target values.
+        index: The (time, ts_name) index of the observed target values.
+    """
+
+    targets: np.ndarray
+    features: np.ndarray
+    feature_names: List[str]
+    feature_pos: np.ndarray
+    rows: Tuple[np.ndarray, np.ndarray]
+    index: pd.MultiIndex
+
+    @classmethod
+    def from_data(cls, data: Dict) -> "_SeriesGrid":
+        target_data = data["targets"]
+        feature_data = data["features"]
+
+        # Observed target values, stacked target after target.
+        target_pos, time_pos, names = [], [], []
+        for i, (name, df) in enumerate(target_data.items()):
+            target_pos.append(np.full(len(df), i))
+            time_pos.append(np.arange(len(df)))
+            names.append(np.full(len(df), name, dtype=object))
+        rows = (np.concatenate(target_pos), np.concatenate(time_pos))
+        target_times = [
+            df.index.get_level_values("time") for df in target_data.values()
+        ]
+        times = target_times[0].append(target_times[1:])
+        index = pd.MultiIndex.from_arrays(
+            [times, np.concatenate(names)], names=["time", "ts_name"]
         )
-        # Use target to "reindex" on axis 0.
-        for_reindex = pd.concat(target_data.values(), axis=1).reset_index()
-        x = pd.merge(for_reindex, x, how="left", on="time")
-        return x.drop(columns=["value"]).set_index(["time", "ts_name"])
 
+        feature_pos = np.array(
+            [
+                df.index.get_level_values("time").get_indexer(times)
+                for df in feature_data.values()
+            ],
+            dtype=int,
+        ).reshape(len(feature_data), len(times))
 
-def _build_lags(
-    df: pd.DataFrame, column: str, lags: List[int], prefix: str
-) -> pd.DataFrame:
-    return pd.concat(
+        return cls(
+            targets=_to_grid(target_data),
+            features=_to_grid(feature_data),
+            feature_names=list(feature_data),
+            feature_pos=feature_pos,
+            rows=rows,
+            index=index,
+        )
+
+    def latest(self) -> "_SeriesGrid":
+        """Keep only the latest observed row of each target."""
+        target_pos, time_pos = self.rows
+        last = np.r_[target_pos[1:] != target_pos[:-1], True]
+        return replace(
+            self,
+            feature_pos=self.feature_pos[:, last],
+            rows=(target_pos[last], time_pos[last]),
+            index=self.index[last],
+        )
+
+
+def _with_horizons(index: pd.MultiIndex, horizons: np.ndarray) -> pd.MultiIndex:
+    """Add a "horizon" level to a (time, ts_name) index."""
+    return pd.MultiIndex.from_arrays(
         [
-            df[[column]]
-            .shift(lag)
-            .rename(columns={column: f"{prefix}_lag_{lag}"})
-            for lag in lags
+            index.get_level_values("time"),
+            index.get_level_values("ts_name"),
+            horizons,
         ],
-        axis=1,
+        names=["time", "ts_name", "horizon"],
+    )
+
+
+def _to_grid(series: Dict) -> np.ndarray:
+    """Values of each series at the start of its row, NaN padded."""
+    values = np.full(
+        (len(series), max([0, *map(len, series.values())])), np.nan
     )
+    for i, df in enumerate(series.values()):
+        values[i, : len(df)] = df["value"].to_numpy(dtype=float)
+    return values
+
+
+def _build_lag_tensor(values: np.ndarray, lags: List[int]) -> np.ndarray:
+    """Return a (series, time, lag) tensor with `values[s, t - lag]`.
+
+    Negative lags read future values. Out of range values are NaN.
+    """
+    lags = np.asarray(lags)
+    before = max(lags.max(), 0)
+    after = max(-lags.min(), 0)
+    padded = np.pad(values, ((0, 0), (before, after)), constant_values=np.nan)
+    windows = sliding_window_view(padded, before + after + 1, axis=1)
+    return windows[:, :, before - lags]
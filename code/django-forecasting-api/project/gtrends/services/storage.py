@@ -0,0 +1,337 @@
+"""Read and write timeseries values, whatever the storage of their version.
+
+Values of a TSVersion are either stored as TSValue rows (ROWS storage) or as
+TSChunk blobs (CHUNKS storage). Since a version only has one kind of them,
+reads look up both tables and don't need to know the storage of a version.
+"""
+
+import operator
+from functools import reduce
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from django.db.models import Count, OuterRef, Q, QuerySet, Subquery, Sum
+from gtrends.models import TSChunk, TSStorage, TSValue, TSVersion
+
+# Number of rows fetched per round-trip when streaming values from the DB.
+CHUNK_SIZE = 10_000
+# Number of versions per query when reading their last values, within the
+# expression depth limit of SQLite (1000).
+TAIL_BATCH_SIZE = 500
+
+Columns = Tuple[pd.DatetimeIndex, np.ndarray]
+
+
+def read_values(
+    version_ids: List[int], last_n: Optional[int] = None
+) -> Dict[int, Columns]:
+    """Load time and value arrays of the given versions, ordered by time.
+
+    If `last_n` is given, only the last `last_n` values of each version are
+    loaded. Versions without values are omitted.
+    """
+    return {
+        **_read_rows(version_ids, last_n),
+        **_read_chunks(version_ids, last_n),
+    }
+
+
+def read_window(version: TSVersion, start) -> Columns:
+    """Load the values of a version from time `start` on."""
+    if version.storage == TSStorage.CHUNKS:
+        chunks = version.tschunk_set.filter(end_time__gte=start)
+        times, values = _concat_chunks(chunks.order_by("start_time"))
+        keep = times >= start
+        return times[keep], values[keep]
+    rows = version.tsvalue_set.filter(time__gte=start)
+    return _rows_to_columns(rows.order_by("time").values_list("time", "value"))
+
+
+def iter_values(
+    version: TSVersion,
+    start=None,
+    end=None,
+    after=None,
+    batch_size: int = CHUNK_SIZE,
+) -> Iterator[Columns]:
+    """Stream the values of a version in time order, in batches.
+
+    Values are filtered on `start <= time < end` and `time > after`, any
+    bound being optional. Memory use is bounded by `batch_size` values (or,
+    with CHUNKS storage, by the size of the chunks).
+    """
+    if version.storage == TSStorage.CHUNKS:
+        yield from _iter_chunks(version, start, end, after)
+        return
+
+    rows = version.tsvalue_set.all()
+    if start is not None:
+        rows = rows.filter(time__gte=start)
+    if end is not None:
+        rows = rows.filter(time__lt=end)
+    # Keyset pagination: each query starts after the last value seen.
+    while True:
+        page = rows if after is None else rows.filter(time__gt=after)
+        times, values = _rows_to_columns(
+            page.order_by("time").values_list("time", "value")[:batch_size]
+        )
+        if len(times):
+            yield times, values
+        if len(times) < batch_size:
+            return
+        after = times[-1]
+
+
+def has_values(version: TSVersion, before=None) -> bool:
+    """Whether a version has any value, or any value earlier than `before`."""
+    if version.storage == TSStorage.CHUNKS:
+        chunks = version.tschunk_set
+        if before is not None:
+            chunks = chunks.filter(start_time__lt=before)
+        return chunks.exists()
+    rows = version.tsvalue_set
+    if before is not None:
+        rows = rows.filter(time__lt=before)
+    return rows.exists()
+
+
+def count_values(version_ids: Iterable[int]) -> Dict[int, int]:
+    """Number of values of each of the given versions."""
+    rows = (
+        TSValue.objects.filter(version_id__in=version_ids)
+        .values("version_id")
+        .annotate(n_values=Count("id"))
+        .values_list("version_id", "n_values")
+    )
+    chunks = (
+        TSChunk.objects.filter(version_id__in=version_ids)
+        .values("version_id")
+        .annotate(n_values=Sum("n_values"))
+        .values_list("version_id", "n_values")
+    )
+    counts = {version_id: 0 for version_id in version_ids}
+    counts.update(rows)
+    counts.update(chunks)
+    return counts
+
+
+def write_values(
+    version: TSVersion,
+    times: pd.DatetimeIndex,
+    values: np.ndarray,
+    batch_size: int,
+):
+    """Append values to a version, `batch_size` values per query/chunk."""
+    for start in range(0, len(times), batch_size):
+        batch_times = times[start : start + batch_size]
+        batch_values = values[start : start + batch_size]
+        if version.storage == TSStorage.CHUNKS:
+            TSChunk.objects.create(
+                version=version,
+                start_time=batch_times[0],
+                end_time=batch_times[-1],
+                n_values=len(batch_times),
+                times=batch_times.as_unit("ns").asi8.astype("<i8").tobytes(),
+                values=np.asarray(batch_values, dtype="<f8").tobytes(),
+            )
+        else:
+            TSValue.objects.bulk_create(
+                TSValue(version=version, time=time, value=value)
+                for time, value in zip(
+                    batch_times.to_pydatetime(), batch_values.tolist()
+                )
+            )
+
+
+def convert_storage(version: TSVersion, storage: TSStorage, batch_size: int):
+    """Move the values of a version to another storage."""
+    if version.storage == storage:
+        return
+    times, values = read_values([version.id]).get(version.id, empty_columns())
+    version.tsvalue_set.all().delete()
+    version.tschunk_set.all().delete()
+    version.storage = storage
+    version.save(update_fields=["storage"])
+    write_values(version, times, values, batch_size)
+
+
+def _read_rows(
+    version_ids: List[int], last_n: Optional[int] = None
+) -> Dict[int, Columns]:
+    if last_n is None:
+        querysets = [TSValue.objects.filter(version_id__in=version_ids)]
+    else:
+        querysets = _tail_querysets(version_ids, last_n)
+    rows = chain.from_iterable(
+        values.order_by("version_id", "time")
+        .values_list("version_id", "time", "value")
+        .iterator(chunk_size=CHUNK_SIZE)
+        for values in querysets
+    )
+    df = pd.DataFrame.from_records(
+        rows, columns=["version_id", "time", "value"]
+    )
+    if df.empty:
+        return {}
+
+    version_col = df["version_id"].to_numpy()
+    time_col = pd.DatetimeIndex(df["time"])
+    value_col = df["value"].to_numpy(dtype=float)
+
+    # Rows are sorted by version, split them on version boundaries.
+    starts = np.flatnonzero(np.r_[True, version_col[1:] != version_col[:-1]])
+    ends = np.r_[starts[1:], len(version_col)]
+    return {
+        version_col[start]: (time_col[start:end], value_col[start:end])
+        for start, end in zip(starts, ends)
+    }
+
+
+def _tail_querysets(version_ids: List[int], last_n: int) -> Iterator[QuerySet]:
+    """Querysets of the last `last_n` values of the given versions.
+
+    The time of the `last_n`-th most recent value of every version is
+    looked up in one query, then bounds an index range scan per version.
+    Versions are filtered TAIL_BATCH_SIZE at a time, in order of id.
+    """
+    # Time of the `last_n`-th most recent value of each version, if any.
+    cutoff = (
+        TSValue.objects.filter(version_id=OuterRef("id"))
+        .order_by("-time")
+        .values("time")[last_n - 1 : last_n]
+    )
+    cutoffs = list(
+        TSVersion.objects.filter(id__in=version_ids)
+        .annotate(cutoff=Subquery(cutoff))
+        .order_by("id")
+        .values_list("id", "cutoff")
+    )
+    for start in range(0, len(cutoffs), TAIL_BATCH_SIZE):
+        filters = [
+            (
+                Q(version_id=version_id)
+                if cutoff is None
+                else Q(version_id=version_id, time__gte=cutoff)
+            )
+            for version_id, cutoff in cutoffs[start : start + TAIL_BATCH_SIZE]
+        ]
+        yield TSValue.objects.filter(reduce(operator.or_, filters))
+
+
+def _read_chunks(
+    version_ids: List[int], last_n: Optional[int] = None
+) -> Dict[int, Columns]:
+    chunks = TSChunk.objects.filter(version_id__in=version_ids)
+    if last_n is not None:
+        chunks = chunks.filter(id__in=_tail_chunks(version_ids, last_n))
+
+    by_version = {}
+    for chunk in chunks.order_by("version_id", "start_time").iterator():
+        by_version.setdefault(chunk.version_id, []).append(chunk)
+
+    columns = {}
+    for version_id, version_chunks in by_version.items():
+        times, values = _concat_chunks(version_chunks)
+        if last_n is not None:
+            times, values = times[-last_n:], values[-last_n:]
+        columns[version_id] = times, values
+    return columns
+
+
+def _tail_chunks(version_ids: List[int], last_n: int) -> List[int]:
+    """Ids of the chunks holding the last `last_n` values of each version."""
+    selected, counts, starts = [], {}, {}
+    # Latest chunks first, without loading their data.
+    for chunk_id, version_id, start_time, end_time, n_values in (
+        TSChunk.objects.filter(version_id__in=version_ids)
+        .order_by("version_id", "-end_time")
+        .values_list("id", "version_id", "start_time", "end_time", "n_values")
+    ):
+        # Older chunks are only needed if some of their values are more
+        # recent than the ones of the selected chunks.
+        if counts.get(version_id, 0) >= last_n and (
+            end_time < starts[version_id]
+        ):
+            continue
+        selected.append(chunk_id)
+        counts[version_id] = counts.get(version_id, 0) + n_values
+        starts[version_id] = min(starts.get(version_id, start_time), start_time)
+    return selected
+
+
+def _iter_chunks(version: TSVersion, start, end, after) -> Iterator[Columns]:
+    chunks = version.tschunk_set.all()
+    if start is not None:
+        chunks = chunks.filter(end_time__gte=start)
+    if end is not None:
+        chunks = chunks.filter(start_time__lt=end)
+    if after is not None:
+        chunks = chunks.filter(end_time__gt=after)
+
+    pending = empty_columns()
+    for chunk in chunks.order_by("start_time").iterator(chunk_size=1):
+        # Later chunks start after this one: earlier values are final.
+        ready = pending[0] < chunk.start_time
+        if ready.any():
+            yield pending[0][ready], pending[1][ready]
+        pending = _concat_columns(
+            [(pending[0][~ready], pending[1][~ready]), _concat_chunks([chunk])]
+        )
+        keep = np.ones(len(pending[0]), dtype=bool)
+        if start is not None:
+            keep &= pending[0] >= start
+        if end is not None:
+            keep &= pending[0] < end
+        if after is not None:
+            keep &= pending[0] > after
+        pending = pending[0][keep], pending[1][keep]
+    if len(pending[0]):
+        yield pending
+
+
+def _concat_columns(columns: List[Columns]) -> Columns:
+    columns = [(times, values) for times, values in columns if len(times)]
+    if len(columns) == 1:
+        return columns[0]
+    if not columns:
+        return empty_columns()
+    times = columns[0][0].append([times for times, _ in columns[1:]])
+    values = np.concatenate([values for _, values in columns])
+    order = np.argsort(times.asi8, kind="stable")
+    return times[order], values[order]
+
+
+def _concat_chunks(chunks: Iterable[TSChunk]) -> Columns:
+    """Arrays of the values of time ordered chunks.
+
+    A single chunk is read without copying its values.
+    """
+    times, values = [], []
+    for chunk in chunks:
+        times.append(np.frombuffer(chunk.times, dtype="<i8"))
+        values.append(np.frombuffer(chunk.values, dtype="<f8"))
+    if not times:
+        return empty_columns()
+    if len(times) > 1:
+        times, values = [np.concatenate(times)], [np.concatenate(values)]
+        # Chunks appended later may fill gaps in earlier ones.
+        if (np.diff(times[0]) < 0).any():
+            order = np.argsort(times[0], kind="stable")
+            times, values = [times[0][order]], [values[0][order]]
+    return (
+        pd.DatetimeIndex(times[0].view("M8[ns]"), tz="UTC"),
+        values[0],
+    )
+
+
+def _rows_to_columns(rows) -> Columns:
+    df = pd.DataFrame.from_records(rows, columns=["time", "value"])
+    if df.empty:
+        return empty_columns()
+    return pd.DatetimeIndex(df["time"]), df["value"].to_numpy(dtype=float)
+
+
+def empty_columns() -> Columns:
+    return pd.DatetimeIndex([], tz="UTC"), np.array([], dtype=float)
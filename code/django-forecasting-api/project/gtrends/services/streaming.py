@@ -0,0 +1,74 @@
+"""Encode batches of timeseries values for streaming responses.
+
+Each encoder turns an iterator of (times, values) batches, as returned by
+`gtrends.services.storage.iter_values`, into an iterator of bytes, so that
+values are never all held in memory at once.
+
+The "packed" format is columnar: a sequence of frames, each made of the
+number of values `n` (little-endian uint32), then `n` timestamps in
+nanoseconds since the epoch (little-endian int64), then `n` values
+(little-endian float64). The stream ends with the last frame.
+"""
+
+import csv
+import io
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+from gtrends.services.storage import Columns
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def encode_ndjson(batches: Iterator[Columns]) -> Iterator[bytes]:
+    """One JSON object per line, with "time" and "value" keys."""
+    encoder = JSONEncoder()
+    for times, values in batches:
+        yield "".join(
+            encoder.encode({"time": time, "value": value}) + "\n"
+            for time, value in zip(times.to_pydatetime(), values.tolist())
+        ).encode()
+
+
+def encode_csv(batches: Iterator[Columns]) -> Iterator[bytes]:
+    """CSV with a "time,value" header, times in ISO 8601 format."""
+    yield b"time,value\r\n"
+    for times, values in batches:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(
+            zip(
+                (time.isoformat() for time in times.to_pydatetime()),
+                values.tolist(),
+            )
+        )
+        yield buffer.getvalue().encode()
+
+
+def encode_packed(batches: Iterator[Columns]) -> Iterator[bytes]:
+    """Frames of packed time and value arrays, see the module docstring."""
+    for times, values in batches:
+        yield np.uint32(len(times)).astype("<u4").tobytes()
+        yield times.as_unit("ns").asi8.astype("<i8").tobytes()
+        yield np.asarray(values, dtype="<f8").tobytes()
+
+
+def decode_packed(content: bytes) -> Columns:
+    """Read back a "packed" stream, e.g. on the client side."""
+    times, values, offset = [], [], 0
+    while offset < len(content):
+        (n,) = np.frombuffer(content, dtype="<u4", count=1, offset=offset)
+        offset += 4
+        times.append(np.frombuffer(content, "<i8", count=n, offset=offset))
+        offset += 8 * int(n)
+        values.append(np.frombuffer(content, "<f8", count=n, offset=offset))
+        offset += 8 * int(n)
+    times = np.concatenate(times) if times else np.array([], dtype="<i8")
+    values = np.concatenate(values) if values else np.array([], dtype="<f8")
+    return pd.DatetimeIndex(times.view("M8[ns]"), tz="UTC"), values
+
+
+STREAM_FORMATS = {
+    "ndjson": ("application/x-ndjson", encode_ndjson),
+    "csv": ("text/csv", encode_csv),
+    "packed": ("application/octet-stream", encode_packed),
+}
@@ -1,5 +1,24 @@
-from .load_data import load_data
-from .preprocess import build_x_latest, preprocess
+from .backtest import backtest, split_folds
+from .load_data import (
+    extend_tails,
+    load_data,
+    load_data_versions,
+    load_series,
+    select_data,
+)
+from .preprocess import (
+    build_x_latest,
+    history_size,
+    load_training_data,
+    max_horizon,
+    preprocess,
+)
 from .save_mlmodelversion import save_mlmodelversion
-from .train import train
+from .train import (
+    TrainingPlan,
+    get_quantiles,
+    partition_series,
+    plan_training,
+    train,
+)
 from .update_timeseries import update_all_timeseries, update_timeseries
@@ -0,0 +1,187 @@
+from concurrent.futures import as_completed
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from gtrends.services import metrics
+from gtrends.services.parallel import executor, split_cpu_budget, with_n_jobs
+from gtrends.services.tasks.train import get_quantiles, train
+
+WINDOWS = ["expanding", "rolling"]
+
+
+@metrics.timed
+def backtest(
+    x: pd.DataFrame,
+    y: pd.Series,
+    model_params: Dict,
+    horizon: int,
+    n_folds: int = 5,
+    window: str = "expanding",
+    train_size: Optional[int] = None,
+    test_size: Optional[int] = None,
+    cpu_budget: Optional[int] = None,
+) -> Dict:
+    """Evaluate a model config with rolling-origin cross-validation.
+
+    The last `n_folds * test_size` times are split in `n_folds` consecutive
+    test blocks. The model of each fold is fitted on the rows whose target
+    is known at the start of its test block, i.e. at least `horizon` times
+    before it: all of them with an "expanding" window, the last
+    `train_size` times with a "rolling" one.
+
+    The lag matrix is built once by the caller, folds are slices of it,
+    fitted in a process pool within the CPU budget.
+
+    Args:
+        x, y: Features and target, as built by `preprocess`.
+        model_params: Parameters of the LGBMRegressor.
+        horizon: Forecast horizon of `y`, in number of times.
+        n_folds: Number of test blocks.
+        window: "expanding" or "rolling".
+        train_size: Number of training times of a rolling window, by default
+            all the ones available before the first test block.
+        test_size: Number of times of each test block, by default the times
+            are split in `n_folds + 1` blocks.
+        cpu_budget: Number of cores to use, defaults to the
+            TRAIN_CPU_BUDGET setting.
+
+    Returns:
+        The MAE, RMSE and bias over all the folds, and the bounds and
+        metrics of each fold. For a quantile set, these are the ones of the
+        quantile closest to the median, and the pinball loss and coverage
+        (share of targets below the predictions) of each quantile over all
+        the folds are added, under "quantiles".
+    """
+    row_times = x.index.get_level_values("time")
+    times = row_times.unique().sort_values()
+    positions = times.get_indexer(row_times)
+    folds = split_folds(
+        len(times), horizon, n_folds, window, train_size, test_size
+    )
+
+    processes, n_jobs = split_cpu_budget(
+        cpu_budget or settings.TRAIN_CPU_BUDGET, len(folds)
+    )
+    quantiles = get_quantiles(model_params)
+    model_params = with_n_jobs(model_params, n_jobs)
+    preds, actuals = [None] * len(folds), [None] * len(folds)
+    errors, results = [None] * len(folds), [None] * len(folds)
+    with executor(processes) as pool:
+        futures = {}
+        for i, (train_range, test_range) in enumerate(folds):
+            is_train = _within(positions, train_range)
+            is_test = _within(positions, test_range)
+            future = pool.submit(
+                _fit_predict, x[is_train], y[is_train], x[is_test], model_params
+            )
+            futures[future] = (i, is_train, is_test)
+
+        for future in as_completed(futures):
+            i, is_train, is_test = futures[future]
+            preds[i], actuals[i] = future.result(), y[is_test].to_numpy()
+            errors[i] = _point(preds[i], quantiles) - actuals[i]
+            (train_start, train_end), (test_start, test_end) = folds[i]
+            results[i] = {
+                "train_start": times[train_start].isoformat(),
+                "train_end": times[train_end - 1].isoformat(),
+                "test_start": times[test_start].isoformat(),
+                "test_end": times[test_end - 1].isoformat(),
+                "n_train": int(is_train.sum()),
+                "n_test": int(is_test.sum()),
+                **_metrics(errors[i]),
+            }
+
+    report = {
+        "n_folds": len(folds),
+        "window": window,
+        "horizon": horizon,
+        **_metrics(np.concatenate(errors)),
+        "folds": results,
+    }
+    if quantiles is not None:
+        report["quantiles"] = _quantile_metrics(
+            quantiles, np.concatenate(preds), np.concatenate(actuals)
+        )
+    return report
+
+
+def split_folds(
+    n_times: int,
+    horizon: int,
+    n_folds: int,
+    window: str = "expanding",
+    train_size: Optional[int] = None,
+    test_size: Optional[int] = None,
+) -> List[Tuple[Tuple[int, int], Tuple[int, int]]]:
+    """Time positions of the train and test blocks of each fold.
+
+    Returns:
+        The (start, end) train positions and (start, end) test positions of
+        each fold, ends excluded.
+    """
+    if window not in WINDOWS:
+        raise ValueError(
+            f"Unknown window {window!r}, expected one of {WINDOWS}."
+        )
+    if test_size is None:
+        test_size = n_times // (n_folds + 1)
+    first_test = n_times - n_folds * test_size
+    if test_size < 1 or first_test - horizon + 1 < 1:
+        raise ValueError(
+            f"Not enough history for {n_folds} folds: {n_times} times, "
+            f"horizon {horizon}."
+        )
+
+    folds = []
+    for fold in range(n_folds):
+        test_start = first_test + fold * test_size
+        # The target of a row is known `horizon` times after it.
+        train_end = test_start - horizon + 1
+        train_start = 0
+        if window == "rolling":
+            # By default, as long as the window of the first fold.
+            size = train_size or first_test - horizon + 1
+            train_start = max(0, train_end - size)
+        folds.append(
+            ((train_start, train_end), (test_start, test_start + test_size))
+        )
+    return folds
+
+
+def _fit_predict(x_train, y_train, x_test, model_params) -> np.ndarray:
+    return train(x_train, y_train, model_params).predict(x_test)
+
+
+def _point(preds: np.ndarray, quantiles: Optional[List[float]]) -> np.ndarray:
+    """The point forecast, the quantile closest to the median if a set."""
+    if quantiles is None:
+        return preds
+    return preds[:, np.abs(np.array(quantiles) - 0.5).argmin()]
+
+
+def _quantile_metrics(
+    quantiles: List[float], preds: np.ndarray, actuals: np.ndarray
+) -> Dict[str, Dict[str, float]]:
+    report = {}
+    for i, q in enumerate(quantiles):
+        errors = actuals - preds[:, i]
+        report[str(q)] = {
+            "pinball": float(np.maximum(q * errors, (q - 1) * errors).mean()),
+            "coverage": float((errors <= 0).mean()),
+        }
+    return report
+
+
+def _within(positions: np.ndarray, bounds: Tuple[int, int]) -> np.ndarray:
+    start, end = bounds
+    return (positions >= start) & (positions < end)
+
+
+def _metrics(errors: np.ndarray) -> Dict[str, float]:
+    return {
+        "mae": float(np.abs(errors).mean()),
+        "rmse": float(np.sqrt((errors**2).mean())),
+        "bias": float(errors.mean()),
+    }
@@ -1,12 +1,81 @@
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 from gtrends.models import TimeSeries
+from gtrends.services import metrics, storage
 
 
+@metrics.timed
 def load_data(
-    target_ts: List[TimeSeries], feature_ts: List[TimeSeries]
+    target_ts: List[TimeSeries],
+    feature_ts: List[TimeSeries],
+    last_n: Optional[int] = None,
+) -> Dict[str, Dict[str, pd.DataFrame]]:
+    """Load the latest version of the target and feature timeseries.
+
+    If `last_n` is given, only the last `last_n` values of each timeseries
+    are loaded, so that the cost does not grow with the history length.
+    """
+    ts_ids = {item.timeseries_id for item in [*target_ts, *feature_ts]}
+    series = load_series(ts_ids, last_n)
+    return select_data(series, target_ts, feature_ts)
+
+
+@metrics.timed
+def load_series(
+    ts_ids: Iterable[int], last_n: Optional[int] = None
+) -> Dict[int, Tuple[str, int, pd.DataFrame]]:
+    """Map each timeseries id to its name, latest version id and values."""
+    # Latest version of every requested timeseries, in a single query.
+    latest = _latest_versions(ts_ids)
+    # Values of all the latest versions, streamed in bulk.
+    columns = storage.read_values(
+        [version_id for _, version_id in latest.values()], last_n
+    )
+
+    series = {}
+    for ts_id, (name, version_id) in latest.items():
+        times, values = columns.get(version_id, storage.empty_columns())
+        series[ts_id] = (name, version_id, _build_frame(name, times, values))
+    return series
+
+
+@metrics.timed
+def extend_tails(
+    series: Dict[int, Tuple[str, int, pd.DataFrame]],
+    last_n: int,
+    until: Dict[int, pd.Timestamp],
+) -> Dict[int, Tuple[str, int, pd.DataFrame]]:
+    """Reach further back in the tails loaded by `load_series`, if needed.
+
+    The tail of each timeseries of `until` is extended until it holds
+    `last_n` values up to the given time, e.g. for a feature running ahead
+    of the targets, whose latest features are read at the last time of the
+    targets.
+    """
+    series = dict(series)
+    for ts_id, time in until.items():
+        name, version_id, df = series[ts_id]
+        requested = last_n
+        # Fewer values than requested: the whole history is loaded.
+        while len(df) >= requested:
+            n_after = int((df.index.get_level_values("time") > time).sum())
+            if len(df) - n_after >= last_n:
+                break
+            requested = last_n + n_after
+            df = load_series([ts_id], requested)[ts_id][2]
+        series[ts_id] = (name, version_id, df)
+    return series
+
+
+@metrics.timed
+def select_data(
+    series: Dict[int, Tuple[str, int, pd.DataFrame]],
+    target_ts: List[TimeSeries],
+    feature_ts: List[TimeSeries],
 ) -> Dict[str, Dict[str, pd.DataFrame]]:
+    """Pick the targets and features out of series loaded by `load_series`."""
     targ_feat = {
         "targets": target_ts,
         "features": feature_ts,
@@ -15,12 +84,60 @@ def load_data(
     metadata = {"targets": {}, "features": {}}
     for key, items in targ_feat.items():
         for item in items:
-            ts = item.timeseries
-            version = ts.tsversion_set.last()
-            values = version.tsvalue_set.all().values("time", "value")
-            df = pd.DataFrame(values)
-            df["ts_name"] = ts.name
-            df = df.set_index(["time", "ts_name"])
-            data[key][ts.name] = df
-            metadata[key][ts.name] = version.id
+            name, version_id, df = series[item.timeseries_id]
+            data[key][name] = df
+            metadata[key][name] = version_id
     return data, metadata
+
+
+@metrics.timed
+def load_data_versions(
+    target_ts: List[TimeSeries], feature_ts: List[TimeSeries]
+) -> Dict[int, Tuple[int, str, int]]:
+    """Map each timeseries id to its latest version and number of values.
+
+    This identifies the data `load_data` would return, without loading any
+    value. Versions are given by id and creation time: ids are reused once
+    the database is reset, creation times are not, so that the keys built
+    from these do not match data of another database.
+    """
+    ts_ids = {item.timeseries_id for item in [*target_ts, *feature_ts]}
+    rows = (
+        TimeSeries.objects.filter(id__in=ts_ids)
+        .exclude(current_version=None)
+        .values_list("id", "current_version_id", "current_version__created_at")
+    )
+    latest = {
+        ts_id: (version_id, created_at)
+        for ts_id, version_id, created_at in rows
+    }
+    counts = storage.count_values(
+        [version_id for version_id, _ in latest.values()]
+    )
+    return {
+        ts_id: (version_id, created_at.isoformat(), counts[version_id])
+        for ts_id, (version_id, created_at) in latest.items()
+    }
+
+
+def _latest_versions(ts_ids: Iterable[int]) -> Dict[int, Tuple[str, int]]:
+    """Map each timeseries id to its name and latest version id."""
+    rows = TimeSeries.objects.filter(id__in=ts_ids).values_list(
+        "id", "name", "current_version_id"
+    )
+    latest = {}
+    for ts_id, name, version_id in rows:
+        if version_id is None:
+            raise ValueError(f"Timeseries {name} has no data.")
+        latest[ts_id] = (name, version_id)
+    return latest
+
+
+def _build_frame(
+    name: str, times: pd.DatetimeIndex, values: np.ndarray
+) -> pd.DataFrame:
+    index = pd.MultiIndex.from_arrays(
+        [times, np.full(len(times), name, dtype=object)],
+        names=["time", "ts_name"],
+    )
+    return pd.DataFrame({"value": values}, index=index)
@@ -1,12 +1,53 @@
 from typing import Dict, Tuple
 
 import pandas as pd
+from gtrends.models import MLModel
+from gtrends.services import feature_store, metrics
 from gtrends.services.preprocessing import Preprocessor
 
+from .load_data import load_data, load_data_versions
 
+
+@metrics.timed
 def preprocess(data: Dict, prep_params: Dict) -> Tuple[pd.DataFrame, pd.Series]:
     return Preprocessor(**prep_params).build_x_y(data)
 
 
+@metrics.timed
+def load_training_data(ml_model: MLModel) -> feature_store.Features:
+    """Load and preprocess the data of a model, through the feature store.
+
+    The features are only built if no model with the same DataConfig and
+    preprocessing params stored them for the current data versions.
+
+    Returns:
+        x, y and the data versions, as returned by `load_data`.
+    """
+    target_ts = ml_model.data_config.targets.all()
+    feature_ts = ml_model.data_config.features.all()
+    prep_params = ml_model.preprocess_config.params
+    key = feature_store.feature_key(
+        "train",
+        ml_model.data_config_id,
+        prep_params,
+        load_data_versions(target_ts, feature_ts),
+    )
+
+    def build():
+        data, metadata = load_data(target_ts, feature_ts)
+        return (*preprocess(data, prep_params), metadata)
+
+    return feature_store.get_or_build(key, build)
+
+
+@metrics.timed
 def build_x_latest(data: Dict, prep_params: Dict) -> pd.DataFrame:
     return Preprocessor(**prep_params).build_x_latest(data)
+
+
+def max_horizon(prep_params: Dict) -> int:
+    return max(Preprocessor(**prep_params).horizons)
+
+
+def history_size(prep_params: Dict) -> int:
+    return Preprocessor(**prep_params).history_size
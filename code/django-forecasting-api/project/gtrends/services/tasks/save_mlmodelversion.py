@@ -1,26 +1,35 @@
-import os
-from typing import Dict
+from typing import Dict, Union
 from uuid import uuid4
 
-from django.core.files import File
+from django.conf import settings
+from django.core.files.base import ContentFile
 from gtrends import models
-from gtrends.services.ml import save_engine
+from gtrends.services import metrics
+from gtrends.services.ml import (
+    PartitionedEngine,
+    QuantileEngine,
+    dump_engine,
+    engine_cache,
+)
 from lightgbm import LGBMRegressor
 
 
+@metrics.timed
 def save_mlmodelversion(
-    engine: LGBMRegressor, ml_model: models.MLModel, metadata: Dict
+    engine: Union[LGBMRegressor, QuantileEngine, PartitionedEngine],
+    ml_model: models.MLModel,
+    metadata: Dict,
 ) -> models.MLModelVersion:
-    filename = str(uuid4()).replace("-", "")[:10] + ".txt"
-    tmp_path = "/tmp/" + filename
-    save_engine(engine, tmp_path)
-    with open(tmp_path, "r") as f:
-        ml_model_file = File(f, filename)
-        ml_model_version = models.MLModelVersion(
-            ml_model=ml_model,
-            ml_file=ml_model_file,
-            metadata=metadata,
-        )
-        ml_model_version.save()
-    os.remove(tmp_path)
+    content, suffix = dump_engine(engine, settings.MODEL_FILE_COMPRESSION)
+    # Written once, straight to the storage backend.
+    ml_model_version = models.MLModelVersion(
+        ml_model=ml_model,
+        ml_file=ContentFile(content, name=uuid4().hex + suffix),
+        metadata=metadata,
+    )
+    ml_model_version.save()
+    ml_model.current_version = ml_model_version
+    ml_model.save(update_fields=["current_version"])
+    # Previous versions will not be served anymore.
+    engine_cache.evict_model(ml_model.id)
     return ml_model_version
@@ -1,7 +1,353 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
+
+import lightgbm
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from gtrends.models import MLModel, MLModelVersion
+from gtrends.services import metrics
+from gtrends.services.ml import (
+    Engine,
+    PartitionedEngine,
+    QuantileEngine,
+    load_engine,
+)
+from gtrends.services.parallel import executor, split_cpu_budget, with_n_jobs
 from lightgbm import LGBMRegressor
 
+from .preprocess import max_horizon
+
+# Params of a quantile set, not passed to LightGBM, see `train`.
+QUANTILE_PARAMS = ("quantiles", "non_crossing")
+# Params of a partitioned model, not passed to LightGBM, see `train`.
+PARTITION_PARAMS = ("partitioning", "n_clusters")
+PARTITIONINGS = ["global", "series", "cluster"]
+# Params of incremental training, not passed to LightGBM, see
+# `plan_training`.
+INCREMENTAL_PARAMS = ("incremental_window",)
+# Default "incremental_window", in multiples of the longest horizon.
+INCREMENTAL_WINDOW_HORIZONS = 4
+
+
+@metrics.timed
+def train(
+    x,
+    y,
+    model_params,
+    init_model: Optional[Engine] = None,
+    cpu_budget: Optional[int] = None,
+) -> Union[LGBMRegressor, QuantileEngine, PartitionedEngine]:
+    """Fit a model, or add boosting rounds to `init_model` if given.
+
+    With a "quantiles" param, a quantile set is fitted instead: a booster
+    per quantile, on the same x and y, see `QuantileEngine` for the
+    "non_crossing" param.
+
+    With a "partitioning" param other than "global", a model is fitted per
+    partition of the targets, on its rows of x and y: per "series", or per
+    "cluster" of series, see `partition_series`. Partitions of an
+    `init_model` are kept, those without rows in x unchanged.
+
+    Args:
+        cpu_budget: Number of cores to fit the partitions in parallel, they
+            are fitted one after the other by default.
+    """
+    if init_model is not None:
+        model_params = {
+            **model_params,
+            "n_estimators": settings.INCREMENTAL_TRAINING_ROUNDS,
+        }
+    if model_params.get("partitioning", "global") == "global":
+        return _fit(x, y, model_params, init_model)
+
+    routes = (
+        partition_series(y, model_params)
+        if init_model is None
+        else init_model.routes
+    )
+    partitions = sorted(set(routes.values()))
+    # Partition of each row, from the codes of the distinct ts_names.
+    codes, names = pd.factorize(x.index.get_level_values("ts_name"))
+    row_partitions = pd.Index(partitions).get_indexer(
+        [routes[name] for name in names]
+    )[codes]
+
+    processes, n_jobs = split_cpu_budget(cpu_budget or 1, len(partitions))
+    if cpu_budget is not None:
+        model_params = with_n_jobs(model_params, n_jobs)
+    with executor(processes) as pool:
+        futures, engines = {}, {}
+        for i, partition in enumerate(partitions):
+            rows = np.flatnonzero(row_partitions == i)
+            if not len(rows):
+                # Nothing new for this partition, when training incrementally.
+                engines[partition] = init_model.engines[partition]
+                continue
+            futures[partition] = pool.submit(
+                _fit_partition,
+                x.iloc[rows],
+                y.iloc[rows],
+                model_params,
+                None if init_model is None else init_model.engines[partition],
+            )
+        for partition, future in futures.items():
+            engines[partition] = future.result()
+    return PartitionedEngine(
+        {partition: engines[partition] for partition in partitions}, routes
+    )
+
+
+def partition_series(y: pd.Series, model_params: Dict) -> Dict[str, str]:
+    """Assign each target to a partition.
+
+    With "series" partitioning, each target is a partition of its own. With
+    "cluster" partitioning, targets are grouped in "n_clusters" clusters of
+    similar scale (global models suffer from the different scales of the
+    series, see the local-vs-global-forecasting study): sorted by their
+    mean value, and split in clusters of consecutive targets.
+
+    Returns:
+        The partition of each target, by ts_name.
+    """
+    means = y.groupby(level="ts_name", sort=True).mean().sort_values()
+    if model_params["partitioning"] == "series":
+        return {name: name for name in means.index}
+    clusters = np.array_split(means.index, model_params["n_clusters"])
+    return {
+        name: f"cluster_{i}"
+        for i, names in enumerate(clusters)
+        for name in names
+    }
+
+
+def get_partitioning(model_params: Dict) -> Optional[Dict]:
+    """The partitioning params, None for a global model."""
+    if model_params.get("partitioning", "global") == "global":
+        return None
+    return {key: model_params.get(key) for key in PARTITION_PARAMS}
+
+
+def _fit(
+    x, y, model_params, init_model: Optional[Engine]
+) -> Union[LGBMRegressor, QuantileEngine]:
+    lgbm_params = {
+        k: v
+        for k, v in model_params.items()
+        if k not in QUANTILE_PARAMS + PARTITION_PARAMS + INCREMENTAL_PARAMS
+    }
+    quantiles = get_quantiles(model_params)
+    if quantiles is None:
+        model = LGBMRegressor(**lgbm_params)
+        model.fit(x, y, init_model=init_model)
+        return model
+
+    boosters = {}
+    for q in quantiles:
+        model = LGBMRegressor(objective="quantile", alpha=q, **lgbm_params)
+        model.fit(
+            x,
+            y,
+            init_model=None if init_model is None else init_model.boosters[q],
+        )
+        boosters[q] = model.booster_
+    return QuantileEngine(boosters, model_params.get("non_crossing"))
+
+
+def _fit_partition(
+    x, y, model_params, init_model: Optional[Engine]
+) -> Union[lightgbm.Booster, QuantileEngine]:
+    model = _fit(x, y, model_params, init_model)
+    return model.booster_ if isinstance(model, LGBMRegressor) else model
+
+
+def get_quantiles(model_params: Dict) -> Optional[List[float]]:
+    """The sorted quantiles of a quantile set, None for a single model."""
+    quantiles = model_params.get("quantiles")
+    return None if quantiles is None else sorted(quantiles)
+
+
+@dataclass
+class TrainingPlan:
+    """What to fit a new model version on, and how it relates to the others.
+
+    Attributes:
+        x, y: The training data, only the recent rows of the targets with
+            new data when training incrementally, see `plan_training`.
+        init_model: The booster of the previous version, None for a full
+            refit.
+        lineage: Stored in the version metadata, under "training".
+    """
+
+    x: pd.DataFrame
+    y: pd.Series
+    init_model: Optional[lightgbm.Booster]
+    lineage: Dict
+
+
+@metrics.timed
+def plan_training(
+    ml_model: MLModel,
+    metadata: Dict,
+    x: pd.DataFrame,
+    y: pd.Series,
+    incremental: Optional[bool] = None,
+) -> TrainingPlan:
+    """Decide between a full refit and a warm start from the latest version.
+
+    A new version is trained incrementally if there are new rows, with a
+    more recent time than the ones of the same horizon seen by the latest
+    version (rows of a longer horizon stop earlier). The boosting rounds
+    are fitted on the "incremental_window" latest rows of each target and
+    horizon with new rows, 4 times the longest horizon by default, and on
+    all the new rows if more: a row or two per target would be too few to
+    fit on. A full refit is done instead if:
+        - a full refit is requested, with `incremental=False`;
+        - the data versions changed, e.g. a timeseries got a new version
+          because past values changed;
+        - the quantiles of a quantile set, or the partitioning, changed;
+        - FULL_REFIT_EVERY incremental trainings happened since the last
+          full refit;
+        - there is no new row.
+
+    Args:
+        ml_model: The model to train.
+        metadata: Data versions, as returned by `load_data`.
+        x, y: The full training data.
+        incremental: True or False to force the mode, if possible. By
+            default, the mode is chosen by the rules above.
+    """
+    last_time = x.index.get_level_values("time").max()
+    last_times = _last_times(x)
+    ml_model.refresh_from_db(fields=["current_version"])
+    previous = ml_model.current_version
+    model_params = ml_model.ml_config.params
+    structure = {
+        "quantiles": get_quantiles(model_params),
+        "partitioning": get_partitioning(model_params),
+    }
+    reason = _full_refit_reason(previous, metadata, structure, incremental)
+
+    if reason is None:
+        parent = previous.metadata["training"]
+        is_new = _new_rows(x, parent)
+        if is_new.any():
+            window = model_params.get(
+                "incremental_window",
+                INCREMENTAL_WINDOW_HORIZONS
+                * max_horizon(ml_model.preprocess_config.params),
+            )
+            rows = is_new | _recent_rows(x, is_new, window)
+            return TrainingPlan(
+                x=x[rows],
+                y=y[rows],
+                init_model=load_engine(previous.ml_file),
+                lineage={
+                    "mode": "incremental",
+                    "parent": previous.id,
+                    # The full refit this version stems from.
+                    "base": parent["base"] or previous.id,
+                    "n_incremental": parent["n_incremental"] + 1,
+                    "n_rows": int(rows.sum()),
+                    "n_new_rows": int(is_new.sum()),
+                    "window": window,
+                    "last_time": last_time.isoformat(),
+                    **last_times,
+                    **structure,
+                },
+            )
+        reason = "no new data"
+
+    return TrainingPlan(
+        x=x,
+        y=y,
+        init_model=None,
+        lineage={
+            "mode": "full",
+            "reason": reason,
+            "parent": previous.id if previous is not None else None,
+            "base": None,
+            "n_incremental": 0,
+            "n_rows": len(x),
+            "last_time": last_time.isoformat(),
+            **last_times,
+            **structure,
+        },
+    )
+
+
+def _last_times(x: pd.DataFrame) -> Dict:
+    """Time of the latest row of each horizon, if x stacks several."""
+    if "horizon" not in x.index.names:
+        return {}
+    times = x.index.get_level_values("time").to_series(index=None)
+    horizons = x.index.get_level_values("horizon").to_numpy()
+    last_times = times.groupby(horizons).max()
+    return {
+        "last_times": {
+            str(horizon): time.isoformat()
+            for horizon, time in last_times.items()
+        }
+    }
+
+
+def _new_rows(x: pd.DataFrame, parent: Dict) -> np.ndarray:
+    """Whether each row is more recent than the ones seen by `parent`."""
+    times = x.index.get_level_values("time")
+    cutoff = pd.Timestamp(parent["last_time"])
+    # Missing from the versions trained before the lineage had them.
+    last_times = parent.get("last_times")
+    if "horizon" in x.index.names and last_times:
+        cutoffs = pd.Series(
+            {int(h): pd.Timestamp(t) for h, t in last_times.items()}
+        )
+        horizons = x.index.get_level_values("horizon")
+        # Horizons unknown to the parent use its overall last time.
+        cutoff = pd.DatetimeIndex(cutoffs.reindex(horizons).fillna(cutoff))
+    return np.asarray(times > cutoff)
+
+
+def _recent_rows(
+    x: pd.DataFrame, is_new: np.ndarray, window: int
+) -> np.ndarray:
+    """Whether each row is among the `window` latest of its target and horizon.
+
+    Only the rows of the targets with new rows are kept. The rows of each
+    target and horizon are in time order.
+    """
+    groups = [name for name in x.index.names if name != "time"]
+    from_end = (
+        pd.Series(0, index=x.index)
+        .groupby(level=groups, sort=False)
+        .cumcount(ascending=False)
+        .to_numpy()
+    )
+    ts_names = x.index.get_level_values("ts_name")
+    updated = ts_names.isin(ts_names[is_new])
+    return updated & (from_end < window)
+
 
-def train(x, y, model_params):
-    model = LGBMRegressor(**model_params)
-    model.fit(x, y)
-    return model
+def _full_refit_reason(
+    previous: Optional[MLModelVersion],
+    metadata: Dict,
+    structure: Dict,
+    incremental: Optional[bool],
+) -> Optional[str]:
+    if incremental is False:
+        return "requested"
+    if previous is None:
+        return "first version"
+    parent = previous.metadata.get("training")
+    if parent is None:
+        return "no lineage"
+    if any(previous.metadata.get(key) != metadata[key] for key in metadata):
+        return "data versions changed"
+    # Missing from the versions trained before these options existed.
+    for key, value in structure.items():
+        if parent.get(key) != value:
+            return f"{key} changed"
+    if incremental is None and (
+        parent["n_incremental"] >= settings.FULL_REFIT_EVERY
+    ):
+        return "scheduled"
+    return None
@@ -1,17 +1,107 @@
-from typing import Tuple
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
 
+import numpy as np
 import pandas as pd
-from gtrends.models import TimeSeries, TSValue, TSVersion
-from gtrends.services.data_sources import download_data
-
-
-def update_all_timeseries():
-    """Update all timeseries values."""
-    for ts in TimeSeries.object.all():
-        update_timeseries(ts)
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from gtrends.models import TimeSeries, TSVersion
+from gtrends.services import metrics, prediction_cache, storage
+from gtrends.services.data_sources import DATASOURCE_MAP, download_data
+from gtrends.services.rate_limit import TokenBucket
+
+
+@metrics.timed
+def update_all_timeseries(
+    timeseries: Optional[Iterable[TimeSeries]] = None,
+) -> Tuple[Dict[str, Tuple[bool, int]], Dict[str, Exception]]:
+    """Update timeseries values, downloading them concurrently.
+
+    Timeseries are downloaded in batches, as many at once as their source
+    allows (see `DataSource.download_many`). Downloads run in a thread pool
+    of `DATASOURCE_MAX_WORKERS` threads, and are throttled to
+    `DATASOURCE_RATE_LIMIT` requests per second (with bursts up to
+    `DATASOURCE_BURST`). Values are written from the calling thread as soon
+    as they are downloaded, in one transaction per timeseries.
 
+    Args:
+        timeseries: The timeseries to update, all of them by default.
 
-def update_timeseries(timeseries: TimeSeries) -> Tuple[bool, int]:
+    Returns:
+        A pair with:
+            - dict: The result of `update_timeseries` by timeseries name.
+            - dict: The download error by timeseries name, for failed ones.
+    """
+    if timeseries is None:
+        timeseries = TimeSeries.objects.all()
+    limiter = TokenBucket(
+        settings.DATASOURCE_RATE_LIMIT, settings.DATASOURCE_BURST
+    )
+
+    def download(batch: _Batch) -> Dict[str, pd.DataFrame]:
+        limiter.acquire()
+        return batch.source.download_many(batch.timeseries, batch.since)
+
+    updated, failed = {}, {}
+    with ThreadPoolExecutor(settings.DATASOURCE_MAX_WORKERS) as pool:
+        futures = {
+            pool.submit(download, batch): batch
+            for batch in _batches(timeseries)
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                new_data = future.result()
+            except Exception as e:
+                for ts in batch.timeseries:
+                    failed[ts.name] = e
+                continue
+            for ts in batch.timeseries:
+                if ts.name not in new_data:
+                    failed[ts.name] = ValueError("No data downloaded.")
+                    continue
+                with transaction.atomic():
+                    updated[ts.name] = update_timeseries(
+                        ts, new_data[ts.name], since=batch.since
+                    )
+    return updated, failed
+
+
+class _Batch(NamedTuple):
+    """Timeseries downloaded with a single request."""
+
+    source: type
+    timeseries: List[TimeSeries]
+    since: Optional[dt.datetime]
+
+
+def _batches(timeseries: Iterable[TimeSeries]) -> List[_Batch]:
+    """Group timeseries by source, in batches of the source size."""
+    groups = {}
+    # Sorted, so that the batches are the same from one update to the next.
+    for ts in sorted(timeseries, key=lambda ts: ts.name):
+        since = download_since(ts)
+        groups.setdefault((ts.source, since), []).append(ts)
+
+    batches = []
+    for (source_name, since), group in groups.items():
+        source = DATASOURCE_MAP[source_name]
+        size = source.batch_size()
+        for start in range(0, len(group), size):
+            batch = group[start : start + size]
+            batches.append(_Batch(source, batch, since))
+    return batches
+
+
+@metrics.timed
+def update_timeseries(
+    timeseries: TimeSeries,
+    new_data: Optional[pd.DataFrame] = None,
+    batch_size: Optional[int] = None,
+    since: Optional[dt.datetime] = None,
+) -> Tuple[bool, int]:
     """Update timeseries values.
 
     Either add the new values (if past values are the same) to the latest
@@ -19,56 +109,119 @@ def update_timeseries(timeseries: TimeSeries) -> Tuple[bool, int]:
 
     Args:
         timeseries: A timeseries object.
+        new_data: Already downloaded values, downloaded if not given.
+        batch_size: Number of values inserted per query, defaults to the
+            TSVALUE_BATCH_SIZE setting.
+        since: If `new_data` only holds the values from `since` on, see
+            `download_since`. Set when downloading.
 
     Returns:
         A pair with:
             - bool: True if it created a new version, False otherwise
             - int: The number of new values added.
     """
-    new_data = download_data(timeseries)
+    if new_data is None:
+        since = download_since(timeseries)
+        new_data = download_data(timeseries, since)
+
+    times, values = _to_arrays(new_data)
 
     # Assign version.
     new_version = True
-    versions = timeseries.tsversion_set.order_by("created_at")
-    if versions:
-        version = versions.last()
-        old_data = _build_old_data(version)
-
-        if _is_old_data_in_new_data(old_data, new_data):
+    version = timeseries.current_version
+    if version is not None:
+        is_new = _find_new_values(version, times, values, since is not None)
+        if is_new is None and since is not None:
+            # Stored values changed: the new version needs the full history.
+            times, values = _to_arrays(download_data(timeseries))
+        if is_new is not None:
             # If old values match, just keep the new values.
             new_version = False
-            new_data = new_data.loc[~new_data.index.isin(old_data.index)]
+            times, values = times[is_new], values[is_new]
         else:
             # Else, set the old version to expired.
             version.expired = True
             version.save()
     if new_version:
-        version = TSVersion(timeseries=timeseries)
+        version = TSVersion(
+            timeseries=timeseries, storage=settings.TIMESERIES_STORAGE
+        )
         version.save()
+        timeseries.current_version = version
+        timeseries.save(update_fields=["current_version"])
 
     # Store new data.
-    objs = [
-        TSValue(version=version, time=d[0], value=d[1].value)
-        for d in new_data.iterrows()
-    ]
-    TSValue.objects.bulk_create(objs)
-
-    return new_version, len(objs)
-
-
-def _build_old_data(version: TSVersion) -> pd.DataFrame:
-    old_data = pd.DataFrame(
-        version.tsvalue_set.values("time", "value")
-    ).set_index("time")
-    old_data.index = old_data.index.tz_localize(None)
-    return old_data
-
-
-def _is_old_data_in_new_data(
-    old_data: pd.DataFrame, new_data: pd.DataFrame
-) -> bool:
-    if old_data.index.isin(new_data.index).all() and new_data.loc[
-        old_data.index
-    ].equals(old_data):
-        return True
-    return False
+    storage.write_values(
+        version, times, values, batch_size or settings.TSVALUE_BATCH_SIZE
+    )
+
+    if new_version or len(times):
+        prediction_cache.invalidate_timeseries(timeseries.id)
+
+    return new_version, len(times)
+
+
+def _to_arrays(new_data: pd.DataFrame) -> Tuple[pd.DatetimeIndex, np.ndarray]:
+    """Split downloaded data in sorted, timezone aware, time and values."""
+    new_data = new_data.sort_index()
+    times = pd.DatetimeIndex(new_data.index).as_unit("ns")
+    if times.tz is None:
+        times = times.tz_localize(timezone.get_default_timezone())
+    return times, new_data["value"].to_numpy(dtype=float)
+
+
+@metrics.timed
+def download_since(timeseries: TimeSeries) -> Optional[dt.datetime]:
+    """Time to download the values of a timeseries from, None for all.
+
+    Sources supporting it only download the last DATASOURCE_SINCE_OVERLAP
+    stored values (to check them) and the newer ones.
+    """
+    if not DATASOURCE_MAP[timeseries.source].supports_since:
+        return None
+    version_id = timeseries.current_version_id
+    if version_id is None:
+        return None
+    times, _ = storage.read_values(
+        [version_id], last_n=settings.DATASOURCE_SINCE_OVERLAP
+    ).get(version_id, storage.empty_columns())
+    return times[0].to_pydatetime() if len(times) else None
+
+
+def _find_new_values(
+    version: TSVersion,
+    times: pd.DatetimeIndex,
+    values: np.ndarray,
+    partial: bool = False,
+) -> Optional[np.ndarray]:
+    """Compare downloaded values with the stored ones.
+
+    Only the stored values in the time window of the downloaded ones are
+    loaded: any older stored value cannot be in the downloaded data, unless
+    the download is `partial`, i.e. only from a given time on.
+
+    Returns:
+        The mask of the downloaded values which are not stored yet, or None
+        if some stored values are missing or different in the new data.
+    """
+    if len(times) == 0:
+        return None if storage.has_values(version) else np.zeros(0, dtype=bool)
+    if not partial and storage.has_values(version, before=times[0]):
+        return None
+
+    old_times, old_values = storage.read_window(version, times[0])
+    old_times = old_times.as_unit("ns").asi8
+
+    # Position of each stored time among the (sorted) downloaded ones.
+    new_times = times.asi8
+    pos = np.searchsorted(new_times, old_times)
+    found = pos < len(new_times)
+    found[found] = new_times[pos[found]] == old_times[found]
+    if not found.all() or not np.array_equal(
+        values[pos], old_values, equal_nan=True
+    ):
+        return None
+
+    is_new = np.ones(len(new_times), dtype=bool)
+    is_new[pos] = False
+    return is_new
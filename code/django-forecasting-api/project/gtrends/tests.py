@@ -1,3 +1,2182 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from io import StringIO
+from typing import Dict, List, Optional, Tuple
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connections, router, transaction
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from gtrends import models
+from gtrends.database import replica_reads
+from gtrends.services import (
+    benchmarks,
+    feature_store,
+    jobs,
+    metrics,
+    prediction_cache,
+    storage,
+)
+from gtrends.services.data_sources import (
+    DATASOURCE_MAP,
+    DataSource,
+    GTrendSource,
+    LocalFileSource,
+)
+from gtrends.serializers import MLConfigSerializer
+from gtrends.services.ml import (
+    EngineCache,
+    PartitionedEngine,
+    QuantileEngine,
+    engine_cache,
+    load_engine,
+)
+from gtrends.services.pipelines import (
+    backtest_pipeline,
+    batch_inference_pipeline,
+    inference_pipeline,
+    train_all_pipeline,
+    train_pipeline,
+)
+from gtrends.services.parallel import split_cpu_budget
+from gtrends.services.preprocessing import BasePreprocessor, Preprocessor
+from gtrends.services.rate_limit import TokenBucket
+from gtrends.services.streaming import decode_packed
+from gtrends.services.tasks import (
+    backtest,
+    load_data,
+    load_data_versions,
+    partition_series,
+    preprocess,
+    split_folds,
+    train,
+    update_all_timeseries,
+    update_timeseries,
+)
+from rest_framework.test import APIClient
+
+
+def make_series(name, periods=60, start="2022-01-02", seed=0):
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_arrays(
+        [
+            pd.date_range(start, periods=periods, freq="W", tz="UTC"),
+            [name] * periods,
+        ],
+        names=["time", "ts_name"],
+    )
+    values = rng.integers(0, 100, periods).astype(float)
+    return pd.DataFrame({"value": values}, index=index)
+
+
+def make_data(targets, features, **kwargs):
+    return {
+        "targets": {
+            name: make_series(name, seed=i, **kwargs)
+            for i, name in enumerate(targets)
+        },
+        "features": {
+            name: make_series(name, seed=100 + i, **kwargs)
+            for i, name in enumerate(features)
+        },
+    }
+
+
+class StubSource(DataSource):
+    """Local data source serving `make_series` values, with two new points."""
+
+    def download(self, since=None):
+        if self.timeseries.name == "broken":
+            raise ConnectionError("Download failed.")
+        df = make_series(self.timeseries.name, periods=62).droplevel("ts_name")
+        df.index = df.index.tz_localize(None)
+        return df
+
+
+def create_timeseries(name, periods=60, seed=0, source="GOOGLE_TRENDS"):
+    """Create a timeseries with a single version filled with random values."""
+    ts = models.TimeSeries.objects.create(name=name, source=source)
+    version = models.TSVersion.objects.create(timeseries=ts)
+    df = make_series(name, periods=periods, seed=seed)
+    models.TSValue.objects.bulk_create(
+        models.TSValue(version=version, time=time, value=value)
+        for (time, _), value in df["value"].items()
+    )
+    ts.current_version = version
+    ts.save()
+    return ts
+
+
+def create_data_config(targets, features):
+    config = models.DataConfig.objects.create(name="config")
+    for i, name in enumerate(targets):
+        models.DataTargets.objects.create(
+            config=config, timeseries=create_timeseries(name, seed=i)
+        )
+    for i, name in enumerate(features):
+        models.DataFeatures.objects.create(
+            config=config, timeseries=create_timeseries(name, seed=100 + i)
+        )
+    return config
+
+
+def create_preprocess_config(name="preprocessing", **params):
+    params = {
+        "horizon": 1,
+        "target_lags": [0, 1],
+        "feature_lags": [0],
+        **params,
+    }
+    return models.PreprocessingConfig.objects.create(name=name, params=params)
+
+
+def create_ml_model(
+    data_config, preprocess_config=None, name="model", model_params=None
+):
+    return models.MLModel.objects.create(
+        name=name,
+        ml_config=models.MLConfig.objects.create(
+            params=model_params or {"n_estimators": 5}
+        ),
+        data_config=data_config,
+        preprocess_config=preprocess_config or create_preprocess_config(),
+    )
+
+
+class MediaRootMixin:
+    """Store model files and features in temporary directories."""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(
+            MEDIA_ROOT=media_root,
+            FEATURE_STORE_DIR=os.path.join(media_root, "features"),
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        # Version ids are reused by the tests, drop boosters of other tests.
+        engine_cache.clear()
+
+
+def load_data_reference(target_ts, feature_ts):
+    """The previous `load_data`, querying the values series by series."""
+    data = {"targets": {}, "features": {}}
+    metadata = {"targets": {}, "features": {}}
+    for key, items in {"targets": target_ts, "features": feature_ts}.items():
+        for item in items:
+            ts = item.timeseries
+            version = ts.tsversion_set.last()
+            values = version.tsvalue_set.all().values("time", "value")
+            df = pd.DataFrame(values)
+            df["ts_name"] = ts.name
+            df = df.set_index(["time", "ts_name"])
+            data[key][ts.name] = df
+            metadata[key][ts.name] = version.id
+    return data, metadata
+
+
+class LoadDataParityTest(TestCase):
+    def setUp(self):
+        self.config = models.DataConfig.objects.create(name="config")
+        times = pd.date_range("2022-01-02", periods=20, freq="W", tz="UTC")
+        inputs = [
+            ("a", models.DataTargets),
+            ("b", models.DataTargets),
+            ("f", models.DataFeatures),
+        ]
+        for i, (name, relation) in enumerate(inputs):
+            ts = models.TimeSeries.objects.create(
+                name=name, source="GOOGLE_TRENDS"
+            )
+            # Only the values of the latest version are loaded.
+            for n_version in range(2):
+                version = models.TSVersion.objects.create(timeseries=ts)
+                models.TSValue.objects.bulk_create(
+                    models.TSValue(
+                        version=version, time=time, value=10 * i + n_version + j
+                    )
+                    for j, time in enumerate(times[i:])
+                )
+            ts.current_version = version
+            ts.save()
+            relation.objects.create(config=self.config, timeseries=ts)
+
+    def test_same_output(self):
+        inputs = (self.config.targets.all(), self.config.features.all())
+        data, metadata = load_data(*inputs)
+        ref_data, ref_metadata = load_data_reference(*inputs)
+        self.assertEqual(metadata, ref_metadata)
+        for key in ["targets", "features"]:
+            self.assertEqual(list(data[key]), list(ref_data[key]))
+            for name, df in data[key].items():
+                # Index names and order, dtypes and values.
+                pd.testing.assert_frame_equal(df, ref_data[key][name])
+
+
+class LoadDataTest(TestCase):
+    def setUp(self):
+        self.config = create_data_config(["a", "b"], ["f"])
+
+    def test_load_data(self):
+        data, metadata = load_data(
+            self.config.targets.all(), self.config.features.all()
+        )
+        expected = make_data(["a", "b"], ["f"])
+        for key, series in expected.items():
+            self.assertEqual(list(data[key]), list(series))
+            for name, df in series.items():
+                version = models.TSVersion.objects.get(timeseries__name=name)
+                self.assertEqual(metadata[key][name], version.id)
+                pd.testing.assert_frame_equal(data[key][name], df)
+
+    def test_load_data_tail(self):
+        full, _ = load_data(
+            self.config.targets.all(), self.config.features.all()
+        )
+        tail, _ = load_data(
+            self.config.targets.all(), self.config.features.all(), last_n=5
+        )
+        for key, series in full.items():
+            for name, df in series.items():
+                pd.testing.assert_frame_equal(tail[key][name], df.iloc[-5:])
+
+    def test_read_tail_many_versions(self):
+        ts = models.TimeSeries.objects.get(name="a")
+        models.TSVersion.objects.bulk_create(
+            models.TSVersion(timeseries=ts) for _ in range(1500)
+        )
+        versions = list(ts.tsversion_set.values_list("id", flat=True))
+        times = pd.date_range("2022-01-02", periods=4, freq="W", tz="UTC")
+        models.TSValue.objects.bulk_create(
+            models.TSValue(version_id=version_id, time=time, value=i)
+            for version_id in versions[1:]
+            for i, time in enumerate(times[: 1 + version_id % 4])
+        )
+        with CaptureQueriesContext(connections["default"]) as queries:
+            columns = storage.read_values(versions, last_n=2)
+        self.assertEqual(len(columns), len(versions))
+        # The cutoff times, then an index range scan per version, without
+        # a subquery run for each row, in batches of versions.
+        value_queries = [
+            query["sql"]
+            for query in queries
+            if 'FROM "gtrends_tsvalue"' in query["sql"]
+        ]
+        n_batches = -(-len(versions) // storage.TAIL_BATCH_SIZE)
+        self.assertEqual(len(value_queries), 1 + n_batches)
+        for sql in value_queries[1:]:
+            self.assertEqual(sql.count("SELECT"), 1)
+        for version_id in versions[1:]:
+            n_values = 1 + version_id % 4
+            tail_times, values = columns[version_id]
+            self.assertEqual(list(tail_times), list(times[:n_values][-2:]))
+            self.assertEqual(list(values), list(range(n_values))[-2:])
+
+
+@dataclass
+class BaselinePreprocessor(BasePreprocessor):
+    """The first, pandas only, `Preprocessor`, as released.
+
+    It only handles a single target and at most one feature: the target
+    lags are concatenated on axis 1, and features aligned on position.
+    """
+
+    horizon: int
+    target_lags: List[int]
+    feature_lags: List[int]
+
+    def build_x_y(self, data: Dict) -> Tuple[pd.DataFrame, pd.Series]:
+        # Build x and y.
+        x = self.build_x(data)
+        y = self.build_y(data["targets"])
+
+        # Align x indexes with y indexes.
+        x = pd.merge(y, x, left_index=True, right_index=True, how="left")
+        x = x.iloc[:, 1:]
+
+        # Drop missing values generated by lags/horizon.
+        idx = ~(x.isnull().any(axis=1) | y.isnull())
+        x = x.loc[idx]
+        y = y.loc[idx]
+
+        return x, y
+
+    def build_x_latest(self, data: Dict) -> pd.DataFrame:
+        x = self.build_x(data)
+        return x[x.index == x.index.max()]
+
+    def build_y(self, target_data: Dict) -> pd.DataFrame:
+        y = {}
+        for name, df in target_data.items():
+            y[name] = (
+                df["value"]
+                .shift(-self.horizon)
+                .rename(f"horizon_{self.horizon}")
+            )
+        return pd.concat(y.values())
+
+    def build_x(self, data: Dict) -> pd.DataFrame:
+        target_data = data["targets"]
+        feature_data = data["features"]
+
+        # Build x_target and x_features.
+        x_targ = self._build_x_lags_targets(target_data)
+        x_feat = self._build_x_lags_features(feature_data, target_data)
+
+        # Combine x_target and x_features.
+        if x_feat is None and x_targ is None:
+            raise ValueError("Cannot have no target lags and no feature lags.")
+        elif x_feat is None:
+            return x_targ
+        elif x_targ is None:
+            return x_feat
+
+        return pd.merge(
+            x_targ, x_feat, left_index=True, right_index=True, how="left"
+        )
+
+    def _build_x_lags_targets(
+        self, target_data: Dict
+    ) -> Optional[pd.DataFrame]:
+        if not self.target_lags:
+            return None
+        x = []
+        for df in target_data.values():
+            x.append(
+                _build_lags(
+                    df=df,
+                    column="value",
+                    lags=self.target_lags,
+                    prefix="target",
+                )
+            )
+        return pd.concat(x, axis=1)
+
+    def _build_x_lags_features(
+        self, feature_data: Dict, target_data: Dict
+    ) -> Optional[pd.DataFrame]:
+        if not self.feature_lags:
+            return None
+        x = []
+        for name, df in feature_data.items():
+            x.append(
+                _build_lags(
+                    df=df,
+                    column="value",
+                    lags=self.feature_lags,
+                    prefix=name,
+                )
+            )
+        # Concat features on axis 1.
+        x = pd.concat(
+            [df.reset_index().drop(columns=["ts_name"]) for df in x], axis=1
+        )
+        # Use target to "reindex" on axis 0.
+        for_reindex = pd.concat(target_data.values(), axis=1).reset_index()
+        x = pd.merge(for_reindex, x, how="left", on="time")
+        return x.drop(columns=["value"]).set_index(["time", "ts_name"])
+
+
+def _build_lags(
+    df: pd.DataFrame, column: str, lags: List[int], prefix: str
+) -> pd.DataFrame:
+    return pd.concat(
+        [
+            df[[column]]
+            .shift(lag)
+            .rename(columns={column: f"{prefix}_lag_{lag}"})
+            for lag in lags
+        ],
+        axis=1,
+    )
+
+
+class PreprocessorParityTest(SimpleTestCase):
+    """Check `Preprocessor` against `BaselinePreprocessor`.
+
+    The baseline is run target by target, and feature by feature, which it
+    handles, and its columns put side by side.
+    """
+
+    def baseline_x(self, data, params, latest=False):
+        xs = []
+        for name, df in data["targets"].items():
+            targets = {name: df}
+            parts = []
+            if params["target_lags"]:
+                baseline = BaselinePreprocessor(
+                    **{**params, "feature_lags": []}
+                )
+                parts.append(
+                    baseline.build_x({"targets": targets, "features": {}})
+                )
+            if params["feature_lags"]:
+                baseline = BaselinePreprocessor(**{**params, "target_lags": []})
+                for feature, feature_df in data["features"].items():
+                    single = {
+                        "targets": targets,
+                        "features": {feature: feature_df},
+                    }
+                    parts.append(baseline.build_x(single))
+            x = pd.concat(parts, axis=1)
+            xs.append(x[x.index == x.index.max()] if latest else x)
+        return pd.concat(xs)
+
+    def assert_same_x_y(self, data, params):
+        x, y = Preprocessor(**params).build_x_y(data)
+        x_ref = self.baseline_x(data, params)
+        y_ref = BaselinePreprocessor(**params).build_y(data["targets"])
+        # Drop missing values generated by lags/horizon, as the baseline.
+        idx = ~(x_ref.isnull().any(axis=1) | y_ref.isnull())
+        pd.testing.assert_frame_equal(x, x_ref.loc[idx])
+        pd.testing.assert_series_equal(y, y_ref.loc[idx])
+
+    def test_single_target_single_feature(self):
+        params = {"horizon": 2, "target_lags": [0, 1, 4], "feature_lags": [1]}
+        self.assert_same_x_y(make_data(["a"], ["f"]), params)
+
+    def test_many_targets_many_features(self):
+        params = {"horizon": 1, "target_lags": [0, 3], "feature_lags": [0, 2]}
+        data = make_data(["a", "b", "c"], ["f", "g"])
+        self.assert_same_x_y(data, params)
+
+    def test_no_target_lags(self):
+        params = {"horizon": 3, "target_lags": [], "feature_lags": [0, 5]}
+        self.assert_same_x_y(make_data(["a", "b"], ["f"]), params)
+
+    def test_no_features(self):
+        params = {"horizon": 1, "target_lags": [0, 1, 2], "feature_lags": [1]}
+        self.assert_same_x_y(make_data(["a", "b"], []), params)
+
+    def test_shorter_feature_history(self):
+        params = {"horizon": 1, "target_lags": [0], "feature_lags": [0, 1]}
+        data = make_data(["a", "b"], [])
+        data["features"]["f"] = make_series("f", periods=30, start="2022-06-05")
+        self.assert_same_x_y(data, params)
+
+    def test_misaligned_and_gapped_series(self):
+        params = {
+            "horizon": 2,
+            "target_lags": [0, 1, 3],
+            "feature_lags": [0, 1],
+        }
+        data = make_data(["a", "b", "c"], ["f", "g"])
+        # Every other value of "b" and "f", values missing from "c" and "g".
+        data["targets"]["b"] = data["targets"]["b"].iloc[::2]
+        data["targets"]["c"] = data["targets"]["c"].drop(
+            data["targets"]["c"].index[[5, 6, 7, 20, 41]]
+        )
+        data["features"]["f"] = data["features"]["f"].iloc[1::2]
+        data["features"]["g"] = data["features"]["g"].iloc[10:-10]
+        self.assert_same_x_y(data, params)
+        x, _ = Preprocessor(**params).build_x_y(data)
+        self.assertEqual(set(x.index.get_level_values("ts_name")), {"a", "c"})
+
+        params["feature_lags"] = []
+        self.assert_same_x_y(data, params)
+        x, _ = Preprocessor(**params).build_x_y(data)
+        self.assertEqual(
+            set(x.index.get_level_values("ts_name")), {"a", "b", "c"}
+        )
+        x_latest = Preprocessor(**params).build_x_latest(data)
+        x_ref = self.baseline_x(data, params, latest=True)
+        pd.testing.assert_frame_equal(x_latest, x_ref)
+        self.assertFalse(x_latest.isnull().any().any())
+
+    def test_daily_and_every_other_day_targets(self):
+        params = {"horizon": 1, "target_lags": [0, 1], "feature_lags": []}
+        data = make_data(["a", "b"], [])
+        for name, freq in [("a", "D"), ("b", "2D")]:
+            df = data["targets"][name]
+            df.index = pd.MultiIndex.from_arrays(
+                [
+                    pd.date_range("2022-01-02", periods=len(df), freq=freq),
+                    df.index.get_level_values("ts_name"),
+                ],
+                names=["time", "ts_name"],
+            )
+        self.assert_same_x_y(data, params)
+        x, _ = Preprocessor(**params).build_x_y(data)
+        self.assertEqual(list(x.groupby(level="ts_name").size()), [58, 58])
+
+    def test_no_lags(self):
+        params = {"horizon": 1, "target_lags": [], "feature_lags": []}
+        with self.assertRaises(ValueError):
+            Preprocessor(**params).build_x_y(make_data(["a"], ["f"]))
+
+    def test_latest_from_tail(self):
+        params = {"horizon": 1, "target_lags": [0, 3], "feature_lags": [0, 2]}
+        data = make_data(["a", "b", "c"], ["f", "g"])
+        preprocessor = Preprocessor(**params)
+        tail = {
+            key: {
+                name: df.iloc[-preprocessor.history_size :]
+                for name, df in series.items()
+            }
+            for key, series in data.items()
+        }
+        x = preprocessor.build_x_latest(tail)
+        x_ref = self.baseline_x(data, params, latest=True)
+        pd.testing.assert_frame_equal(x, x_ref)
+        self.assertEqual(len(x), 3)
+
+    def test_multi_horizon(self):
+        params = {"target_lags": [0, 3], "feature_lags": [0, 2]}
+        data = make_data(["a", "b"], ["f"])
+        x, y = Preprocessor(horizon=[1, 3], **params).build_x_y(data)
+        self.assertEqual(x.index.names, ["time", "ts_name", "horizon"])
+        for horizon in [1, 3]:
+            x_ref, y_ref = Preprocessor(horizon=horizon, **params).build_x_y(
+                data
+            )
+            x_h = x.xs(horizon, level="horizon")
+            pd.testing.assert_frame_equal(x_h.drop(columns="horizon"), x_ref)
+            self.assertTrue((x_h["horizon"] == horizon).all())
+            np.testing.assert_array_equal(y.xs(horizon, level="horizon"), y_ref)
+
+        x_latest = Preprocessor(horizon=[1, 3], **params).build_x_latest(data)
+        x_ref = Preprocessor(horizon=1, **params).build_x_latest(data)
+        self.assertEqual(list(x_latest["horizon"]), [1, 3, 1, 3])
+        pd.testing.assert_frame_equal(
+            x_latest.xs(3, level="horizon").drop(columns="horizon"), x_ref
+        )
+
+
+class MultiHorizonTest(MediaRootMixin, TestCase):
+    def test_forecast_path(self):
+        ml_model = create_ml_model(
+            create_data_config(["a", "b"], ["f"]),
+            create_preprocess_config(horizon=[1, 2, 4]),
+        )
+        train_pipeline(ml_model)
+        predictions = inference_pipeline(ml_model)
+        self.assertEqual(set(predictions), {"a", "b"})
+        for pred in predictions.values():
+            self.assertEqual(pred["horizon"], [1, 2, 4])
+            self.assertEqual(len(pred["prediction"]), 3)
+            self.assertEqual(
+                pred["predicted_delta"],
+                [p - pred["last_value"] for p in pred["prediction"]],
+            )
+
+        report = backtest_pipeline(ml_model, n_folds=2, cpu_budget=1)
+        self.assertEqual(report["horizon"], 4)
+
+
+class QuantileSetTest(MediaRootMixin, TestCase):
+    quantiles = [0.1, 0.5, 0.9]
+
+    def create_model(self, **params):
+        return create_ml_model(
+            create_data_config(["a", "b"], ["f"]),
+            create_preprocess_config(horizon=[1, 2]),
+            model_params={
+                "n_estimators": 5,
+                "quantiles": self.quantiles,
+                **params,
+            },
+        )
+
+    def test_one_bundle(self):
+        ml_model = self.create_model(non_crossing="sort")
+        ml_model_version = train_pipeline(ml_model)
+        self.assertEqual(
+            ml_model_version.metadata["training"]["quantiles"], self.quantiles
+        )
+        engine = load_engine(ml_model_version.ml_file)
+        self.assertIsInstance(engine, QuantileEngine)
+        self.assertEqual(engine.quantiles, self.quantiles)
+        for q in self.quantiles:
+            self.assertIn(f"[alpha: {q}]", engine.boosters[q].model_to_string())
+
+        misses = engine_cache.stats()["misses"]
+        predictions = inference_pipeline(ml_model)
+        # All the quantiles from a single model load.
+        self.assertEqual(engine_cache.stats()["misses"], misses + 1)
+        for pred in predictions.values():
+            self.assertEqual(pred["quantiles"], self.quantiles)
+            self.assertEqual(list(pred["prediction"]), ["0.1", "0.5", "0.9"])
+            # A forecast path per quantile, never crossing.
+            paths = np.array(list(pred["prediction"].values()))
+            self.assertEqual(paths.shape, (3, 2))
+            self.assertTrue((np.diff(paths, axis=0) >= 0).all())
+            self.assertEqual(
+                pred["predicted_delta"]["0.9"],
+                [p - pred["last_value"] for p in pred["prediction"]["0.9"]],
+            )
+
+        report = backtest_pipeline(ml_model, n_folds=2, cpu_budget=1)
+        self.assertEqual(list(report["quantiles"]), ["0.1", "0.5", "0.9"])
+        for quantile_report in report["quantiles"].values():
+            self.assertGreaterEqual(quantile_report["pinball"], 0)
+            self.assertTrue(0 <= quantile_report["coverage"] <= 1)
+
+    def test_non_crossing(self):
+        x, y = preprocess(
+            make_data(["a", "b"], ["f"]),
+            {"horizon": 1, "target_lags": [0, 1], "feature_lags": [0]},
+        )
+        params = {"n_estimators": 5, "quantiles": self.quantiles}
+        raw = train(x, y, params).predict(x)
+        self.assertEqual(raw.shape, (len(x), 3))
+
+        engine = train(x, y, {**params, "non_crossing": "sort"})
+        np.testing.assert_allclose(engine.predict(x), np.sort(raw, axis=1))
+
+        engine = train(x, y, {**params, "non_crossing": "normal"})
+        matched = engine.predict(x)
+        self.assertTrue((np.diff(matched, axis=1) >= 0).all())
+        # Symmetric quantiles: the median is the mean of the predictions.
+        np.testing.assert_allclose(matched[:, 1], raw.mean(axis=1))
+
+        with self.assertRaises(ValueError):
+            QuantileEngine(engine.boosters, non_crossing="isotonic")
+
+    def test_incremental_training(self):
+        ml_model = self.create_model(min_child_samples=1)
+        first = train_pipeline(ml_model)
+        for i, name in enumerate(["a", "b", "f"]):
+            new_data = make_series(
+                name, periods=62, seed=i if name != "f" else 100
+            ).droplevel("ts_name")
+            timeseries = models.TimeSeries.objects.get(name=name)
+            update_timeseries(timeseries, new_data)
+        second = train_pipeline(ml_model)
+        self.assertEqual(second.metadata["training"]["mode"], "incremental")
+        first_engine = load_engine(first.ml_file)
+        second_engine = load_engine(second.ml_file)
+        # Each booster goes on from the trees of the first version. Those
+        # of the extreme quantiles may not grow, if all the new rows are on
+        # the same side of them.
+        x, _ = preprocess(
+            load_data(
+                ml_model.data_config.targets.all(),
+                ml_model.data_config.features.all(),
+            )[0],
+            ml_model.preprocess_config.params,
+        )
+        for q in self.quantiles:
+            n_trees = first_engine.boosters[q].num_trees()
+            np.testing.assert_allclose(
+                second_engine.boosters[q].predict(x, num_iteration=n_trees),
+                first_engine.boosters[q].predict(x),
+            )
+        self.assertGreater(
+            sum(b.num_trees() for b in second_engine.boosters.values()),
+            sum(b.num_trees() for b in first_engine.boosters.values()),
+        )
+
+        ml_model.ml_config.params["quantiles"] = [0.25, 0.75]
+        ml_model.ml_config.save()
+        third = train_pipeline(ml_model)
+        self.assertEqual(
+            third.metadata["training"]["reason"], "quantiles changed"
+        )
+
+    def test_validation(self):
+        def errors(params):
+            serializer = MLConfigSerializer(data={"params": params})
+            return not serializer.is_valid()
+
+        self.assertFalse(errors({"quantiles": [0.1, 0.9]}))
+        self.assertFalse(
+            errors({"quantiles": [0.1, 0.9], "non_crossing": "normal"})
+        )
+        self.assertTrue(errors({"quantiles": []}))
+        self.assertTrue(errors({"quantiles": [0.5, 1]}))
+        self.assertTrue(errors({"quantiles": [0.5, 0.5]}))
+        self.assertTrue(errors({"quantiles": [0.5], "alpha": 0.5}))
+        self.assertTrue(errors({"quantiles": [0.5], "non_crossing": "normal"}))
+        self.assertTrue(errors({"quantiles": [0.5], "non_crossing": "other"}))
+        self.assertTrue(errors({"non_crossing": "sort"}))
+
+
+class PartitioningTest(MediaRootMixin, TestCase):
+    prep_params = {"horizon": 1, "target_lags": [0, 1], "feature_lags": [0]}
+
+    def setUp(self):
+        super().setUp()
+        self.x, self.y = preprocess(
+            make_data(["a", "b", "c"], ["f"]), self.prep_params
+        )
+
+    def test_partition_series(self):
+        self.assertEqual(
+            partition_series(self.y, {"partitioning": "series"}),
+            {"a": "a", "b": "b", "c": "c"},
+        )
+        routes = partition_series(
+            self.y, {"partitioning": "cluster", "n_clusters": 2}
+        )
+        self.assertEqual(set(routes.values()), {"cluster_0", "cluster_1"})
+        # Clusters of series of similar means.
+        means = self.y.groupby(level="ts_name").mean().sort_values()
+        self.assertEqual(routes[means.index[0]], routes[means.index[1]])
+        self.assertNotEqual(routes[means.index[1]], routes[means.index[2]])
+
+    def test_per_series(self):
+        params = {"n_estimators": 5, "n_jobs": 1}
+        engine = train(self.x, self.y, {**params, "partitioning": "series"})
+        self.assertIsInstance(engine, PartitionedEngine)
+        self.assertEqual(engine.partitions, ["a", "b", "c"])
+        preds = engine.predict(self.x)
+        for name in ["a", "b", "c"]:
+            # The same as a local model, fitted on the rows of the series.
+            is_series = self.x.index.get_level_values("ts_name") == name
+            local = train(self.x[is_series], self.y[is_series], params)
+            np.testing.assert_allclose(
+                preds[is_series], local.predict(self.x[is_series])
+            )
+
+        with self.assertRaises(ValueError):
+            engine.predict(self.x.rename(index={"a": "d"}, level="ts_name"))
+
+    def test_process_pool(self):
+        params = {"n_estimators": 5, "partitioning": "series"}
+        inline = train(self.x, self.y, params, cpu_budget=1)
+        pooled = train(self.x, self.y, params, cpu_budget=3)
+        np.testing.assert_array_equal(
+            inline.predict(self.x), pooled.predict(self.x)
+        )
+
+    def test_pipeline(self):
+        ml_model = create_ml_model(
+            create_data_config(["a", "b", "c"], ["f"]),
+            model_params={
+                "n_estimators": 5,
+                "partitioning": "cluster",
+                "n_clusters": 2,
+                "quantiles": [0.1, 0.9],
+                "non_crossing": "sort",
+            },
+        )
+        ml_model_version = train_pipeline(ml_model)
+        self.assertEqual(
+            ml_model_version.metadata["training"]["partitioning"],
+            {"partitioning": "cluster", "n_clusters": 2},
+        )
+        engine = load_engine(ml_model_version.ml_file)
+        self.assertEqual(len(engine.partitions), 2)
+        self.assertEqual(set(engine.routes), {"a", "b", "c"})
+
+        misses = engine_cache.stats()["misses"]
+        predictions = inference_pipeline(ml_model)
+        self.assertEqual(engine_cache.stats()["misses"], misses + 1)
+        self.assertEqual(set(predictions), {"a", "b", "c"})
+        for pred in predictions.values():
+            self.assertEqual(pred["quantiles"], [0.1, 0.9])
+            self.assertLessEqual(
+                pred["prediction"]["0.1"], pred["prediction"]["0.9"]
+            )
+
+        ml_model.ml_config.params["partitioning"] = "series"
+        del ml_model.ml_config.params["n_clusters"]
+        ml_model.ml_config.save()
+        version = train_pipeline(ml_model)
+        self.assertEqual(
+            version.metadata["training"]["reason"], "partitioning changed"
+        )
+
+    def test_incremental_partition_without_new_rows(self):
+        ml_model = create_ml_model(
+            create_data_config(["a", "b"], []),
+            create_preprocess_config(feature_lags=[]),
+            # Let the few new rows be split.
+            model_params={
+                "n_estimators": 5,
+                "min_child_samples": 1,
+                "partitioning": "series",
+            },
+        )
+        first = train_pipeline(ml_model)
+        # Only "a" gets new values.
+        new_data = make_series("a", periods=64).droplevel("ts_name")
+        timeseries = models.TimeSeries.objects.get(name="a")
+        self.assertFalse(update_timeseries(timeseries, new_data)[0])
+        second = train_pipeline(ml_model)
+        self.assertEqual(second.metadata["training"]["mode"], "incremental")
+        self.assertEqual(second.metadata["training"]["n_rows"], 4)
+
+        first_engine = load_engine(first.ml_file)
+        second_engine = load_engine(second.ml_file)
+        self.assertEqual(second_engine.partitions, ["a", "b"])
+        self.assertEqual(
+            second_engine.engines["b"].model_to_string(),
+            first_engine.engines["b"].model_to_string(),
+        )
+        self.assertGreater(
+            second_engine.engines["a"].num_trees(),
+            first_engine.engines["a"].num_trees(),
+        )
+
+    def test_validation(self):
+        def errors(params):
+            return not MLConfigSerializer(data={"params": params}).is_valid()
+
+        self.assertFalse(errors({"partitioning": "series"}))
+        self.assertFalse(errors({"partitioning": "cluster", "n_clusters": 3}))
+        self.assertTrue(errors({"partitioning": "cluster"}))
+        self.assertTrue(errors({"partitioning": "series", "n_clusters": 3}))
+        self.assertTrue(errors({"partitioning": "other"}))
+
+
+class FeatureStoreTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        data_config = create_data_config(["a", "b"], ["f"])
+        preprocess_config = create_preprocess_config(horizon=[1, 2])
+        self.ml_models = [
+            create_ml_model(
+                data_config,
+                preprocess_config,
+                name=f"model_{n_estimators}",
+                model_params={"n_estimators": n_estimators},
+            )
+            for n_estimators in [3, 6]
+        ]
+
+    def test_round_trip(self):
+        x, y = Preprocessor(
+            horizon=[1, 2], target_lags=[0, 1], feature_lags=[0]
+        ).build_x_y(make_data(["a", "b"], ["f"]))
+        feature_store.put("key", x, y, {"targets": {"a": 1}})
+        stored = feature_store.get("key")
+        pd.testing.assert_frame_equal(stored.x, x)
+        pd.testing.assert_series_equal(stored.y, y)
+        self.assertEqual(stored.metadata, {"targets": {"a": 1}})
+        # Memory-mapped read-only.
+        self.assertFalse(stored.x.values.flags.writeable)
+        self.assertIsNone(feature_store.get("other"))
+
+        with override_settings(FEATURE_STORE_DIR=""):
+            self.assertIsNone(feature_store.get("key"))
+
+    def test_lru_eviction(self):
+        x, y = Preprocessor(
+            horizon=1, target_lags=[0], feature_lags=[]
+        ).build_x_y(make_data(["a"], []))
+        feature_store.put("first", x, y, {})
+        size = sum(
+            f.stat().st_size for f in os.scandir(feature_store._path("first"))
+        )
+        with override_settings(FEATURE_STORE_MAX_BYTES=2 * size):
+            feature_store.put("second", x, y, {})
+            feature_store.get("first")
+            feature_store.put("third", x, y, {})
+        self.assertIsNotNone(feature_store.get("first"))
+        self.assertIsNone(feature_store.get("second"))
+        self.assertIsNotNone(feature_store.get("third"))
+
+    def test_pipelines_share_features(self):
+        tasks = sys.modules["gtrends.services.tasks.preprocess"]
+        with mock.patch.object(
+            tasks, "preprocess", side_effect=tasks.preprocess
+        ) as preprocess:
+            for ml_model in self.ml_models:
+                train_pipeline(ml_model)
+            backtest_pipeline(self.ml_models[0], n_folds=2, cpu_budget=1)
+        self.assertEqual(preprocess.call_count, 1)
+
+        module = sys.modules["gtrends.services.pipelines.inference_pipeline"]
+        with mock.patch.object(
+            module, "load_series", side_effect=module.load_series
+        ) as load_series:
+            predictions = inference_pipeline(self.ml_models[0])
+            prediction_cache.get_cache().clear()
+            self.assertEqual(inference_pipeline(self.ml_models[0]), predictions)
+            inference_pipeline(self.ml_models[1])
+        self.assertEqual(load_series.call_count, 1)
+
+        # New values, new features.
+        timeseries = models.TimeSeries.objects.get(name="a")
+        models.TSValue.objects.create(
+            version=timeseries.current_version,
+            time=pd.Timestamp("2030-01-01", tz="UTC"),
+            value=1.0,
+        )
+        with mock.patch.object(
+            tasks, "preprocess", side_effect=tasks.preprocess
+        ) as preprocess:
+            train_pipeline(self.ml_models[0])
+        self.assertEqual(preprocess.call_count, 1)
+
+    def test_database_reset(self):
+        train_pipeline(self.ml_models[0])
+        # A new database, reusing the version ids, with as many values.
+        for ts in models.TimeSeries.objects.all():
+            version_id = ts.current_version_id
+            rows = list(
+                models.TSValue.objects.filter(
+                    version_id=version_id
+                ).values_list("time", "value")
+            )
+            ts.current_version.delete()
+            version = models.TSVersion.objects.create(
+                id=version_id, timeseries=ts
+            )
+            models.TSValue.objects.bulk_create(
+                models.TSValue(version=version, time=time, value=value + 1)
+                for time, value in rows
+            )
+            ts.current_version = version
+            ts.save()
+
+        tasks = sys.modules["gtrends.services.tasks.preprocess"]
+        with mock.patch.object(
+            tasks, "preprocess", side_effect=tasks.preprocess
+        ) as preprocess:
+            train_pipeline(self.ml_models[0])
+        self.assertEqual(preprocess.call_count, 1)
+
+
+class EngineCacheTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.ml_model = create_ml_model(create_data_config(["a"], ["f"]))
+
+    def test_hits_and_misses(self):
+        cache = EngineCache(max_size=2, max_bytes=2**30)
+        version = train_pipeline(self.ml_model)
+        engine = cache.get(version)
+        self.assertIs(cache.get(version), engine)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_lru_eviction(self):
+        cache = EngineCache(max_size=2, max_bytes=2**30)
+        versions = [train_pipeline(self.ml_model) for _ in range(3)]
+        for version in versions:
+            cache.get(version)
+        cache.get(versions[0])
+        stats = cache.stats()
+        self.assertEqual(stats["misses"], 4)
+        self.assertEqual(stats["evictions"], 2)
+        self.assertEqual(stats["size"], 2)
+
+    def test_memory_bound(self):
+        version = train_pipeline(self.ml_model)
+        cache = EngineCache(max_size=2, max_bytes=version.ml_file.size - 1)
+        cache.get(version)
+        self.assertEqual(cache.stats()["size"], 0)
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def test_compressed_model_files(self):
+        version = train_pipeline(self.ml_model)
+        with override_settings(MODEL_FILE_COMPRESSION="gzip"):
+            compressed = train_pipeline(self.ml_model)
+        self.assertTrue(compressed.ml_file.name.endswith(".txt.gz"))
+        self.assertLess(compressed.ml_file.size, version.ml_file.size)
+        self.assertEqual(
+            load_engine(compressed.ml_file).model_to_string(),
+            load_engine(version.ml_file).model_to_string(),
+        )
+
+    def test_new_version_evicts_previous_ones(self):
+        engine_cache.clear()
+        train_pipeline(self.ml_model)
+        inference_pipeline(self.ml_model)
+        self.assertEqual(engine_cache.stats()["size"], 1)
+        train_pipeline(self.ml_model)
+        self.assertEqual(engine_cache.stats()["size"], 0)
+
+
+class PredictionCacheTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        prediction_cache.get_cache().clear()
+        self.ml_model = create_ml_model(create_data_config(["a"], ["f"]))
+        train_pipeline(self.ml_model)
+        module = sys.modules["gtrends.services.pipelines.inference_pipeline"]
+        patcher = mock.patch.object(
+            module, "build_x_latest", side_effect=module.build_x_latest
+        )
+        self.build_x_latest = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_repeated_predictions_are_cached(self):
+        predictions = inference_pipeline(self.ml_model)
+        self.assertEqual(inference_pipeline(self.ml_model), predictions)
+        self.assertEqual(self.build_x_latest.call_count, 1)
+
+    def test_new_model_version_is_not_cached(self):
+        inference_pipeline(self.ml_model)
+        train_pipeline(self.ml_model)
+        with mock.patch.object(
+            prediction_cache,
+            "set_predictions",
+            side_effect=prediction_cache.set_predictions,
+        ) as set_predictions:
+            inference_pipeline(self.ml_model)
+        self.assertEqual(set_predictions.call_count, 1)
+        # Same data: the features come from the feature store.
+        self.assertEqual(self.build_x_latest.call_count, 1)
+
+    def test_update_timeseries_invalidates_predictions(self):
+        inference_pipeline(self.ml_model)
+        key = prediction_cache.prediction_key(
+            self.ml_model.mlmodelversion_set.last().id,
+            load_data_versions(
+                self.ml_model.data_config.targets.all(),
+                self.ml_model.data_config.features.all(),
+            ),
+        )
+        self.assertIsNotNone(prediction_cache.get_predictions(key))
+        timeseries = models.TimeSeries.objects.get(name="a")
+        new_data = make_series("a", periods=61).droplevel("ts_name")
+        new_data.index = new_data.index.tz_localize(None)
+        with mock.patch(
+            "gtrends.services.tasks.update_timeseries.download_data",
+            return_value=new_data,
+        ):
+            self.assertEqual(update_timeseries(timeseries), (False, 1))
+        self.assertIsNone(prediction_cache.get_predictions(key))
+        inference_pipeline(self.ml_model)
+        self.assertEqual(self.build_x_latest.call_count, 2)
+
+
+class BatchPredictTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        prediction_cache.get_cache().clear()
+        data_config = create_data_config(["a", "b"], ["f"])
+        preprocess_config = create_preprocess_config()
+        self.ml_models = [
+            create_ml_model(
+                data_config,
+                preprocess_config,
+                name=f"model_{n_estimators}",
+                model_params={"n_estimators": n_estimators},
+            )
+            for n_estimators in [3, 6]
+        ]
+        for ml_model in self.ml_models:
+            train_pipeline(ml_model)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="user"))
+
+    def test_batch_predict_shares_features(self):
+        module = sys.modules["gtrends.services.pipelines.inference_pipeline"]
+        with mock.patch.object(
+            module, "build_x_latest", side_effect=module.build_x_latest
+        ) as build_x_latest:
+            predictions = batch_inference_pipeline(self.ml_models)
+        self.assertEqual(build_x_latest.call_count, 1)
+
+        prediction_cache.get_cache().clear()
+        for ml_model in self.ml_models:
+            self.assertEqual(
+                predictions[ml_model.id], inference_pipeline(ml_model)
+            )
+            self.assertEqual(set(predictions[ml_model.id]), {"a", "b"})
+
+    def test_batch_predict_endpoint(self):
+        ids = [ml_model.id for ml_model in self.ml_models]
+        response = self.client.post(
+            "/gtrends/model/batch-predict/", {"ids": ids}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), set(ids))
+
+        response = self.client.post(
+            "/gtrends/model/batch-predict/", {"ids": [0]}, format="json"
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_predict_empty_timeseries(self):
+        models.TimeSeries.objects.filter(name="f").update(current_version=None)
+        with self.assertRaisesMessage(ValueError, "Timeseries f has no data."):
+            inference_pipeline(self.ml_models[0])
+
+        response = self.client.get(
+            f"/gtrends/model/{self.ml_models[0].id}/predict/"
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data, "Timeseries f has no data.")
+        response = self.client.post(
+            "/gtrends/model/batch-predict/",
+            {"ids": [ml_model.id for ml_model in self.ml_models]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_feature_ahead_of_targets(self):
+        config = models.DataConfig.objects.create(name="ahead")
+        models.DataTargets.objects.create(
+            config=config, timeseries=models.TimeSeries.objects.get(name="a")
+        )
+        # Ten values more recent than the last value of the target.
+        models.DataFeatures.objects.create(
+            config=config,
+            timeseries=create_timeseries("g", periods=70, seed=100),
+        )
+        ml_model = create_ml_model(
+            config,
+            create_preprocess_config("ahead", feature_lags=[0, 3]),
+            name="ahead",
+        )
+        train_pipeline(ml_model)
+        module = sys.modules["gtrends.services.pipelines.inference_pipeline"]
+        build_x_latest, built = module.build_x_latest, []
+
+        def spy(*args):
+            built.append(build_x_latest(*args))
+            return built[-1]
+
+        with mock.patch.object(module, "build_x_latest", side_effect=spy):
+            inference_pipeline(ml_model)
+
+        # The same as the latest row built from the full history.
+        data, _ = load_data(config.targets.all(), config.features.all())
+        x = Preprocessor(**ml_model.preprocess_config.params).build_x(data)
+        x = x.groupby(level="ts_name").tail(1)
+        self.assertFalse(x.isnull().any().any())
+        pd.testing.assert_frame_equal(built[0], x)
+
+
+class ReadReplicaTest(TransactionTestCase):
+    """Two local SQLite databases, the replica being registered on the fly."""
+
+    @classmethod
+    def setUpClass(cls):
+        replica_dir = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, replica_dir)
+        connections.settings["replica"] = {
+            **connections["default"].settings_dict,
+            "NAME": os.path.join(replica_dir, "replica.sqlite3"),
+        }
+        cls.addClassCleanup(cls.remove_replica)
+        call_command("migrate", database="replica", verbosity=0)
+        # Only known by the test runner once registered.
+        cls.databases = {"default", "replica"}
+        super().setUpClass()
+
+    @classmethod
+    def remove_replica(cls):
+        connections["replica"].close()
+        del connections.settings["replica"]
+        delattr(connections._connections, "replica")
+
+    def setUp(self):
+        self.timeseries = create_timeseries("a")
+        # Replicated, with values telling the databases apart.
+        with transaction.atomic(using="replica"):
+            for model in [models.TimeSeries, models.TSVersion, models.TSValue]:
+                model.objects.using("replica").bulk_create(model.objects.all())
+        models.TSValue.objects.using("replica").update(value=-1)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="user"))
+
+    def test_router(self):
+        self.assertEqual(router.db_for_read(models.TimeSeries), "default")
+        with replica_reads():
+            self.assertEqual(router.db_for_read(models.TimeSeries), "replica")
+            self.assertEqual(router.db_for_write(models.TimeSeries), "default")
+
+    def test_read_only_actions(self):
+        url = f"/gtrends/timeseries/{self.timeseries.id}/latest-values/"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({record["value"] for record in response.data}, {-1})
+
+        # Streamed after the view returned.
+        response = self.client.get(url, {"output": "csv"})
+        rows = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual({row.split(",")[1] for row in rows[1:]}, {"-1.0"})
+
+        # Other actions read from the default database.
+        models.TimeSeries.objects.using("replica").all().delete()
+        response = self.client.get(f"/gtrends/timeseries/{self.timeseries.id}/")
+        self.assertEqual(response.status_code, 200)
+
+
+class UpdateTimeseriesTest(TestCase):
+    def setUp(self):
+        self.timeseries = create_timeseries("a")
+
+    def downloaded(self, periods=62):
+        df = make_series("a", periods=periods).droplevel("ts_name")
+        df.index = df.index.tz_localize(None)
+        return df
+
+    def stored(self):
+        version = self.timeseries.tsversion_set.last()
+        return list(version.tsvalue_set.order_by("time").values_list("value"))
+
+    def test_append_new_values(self):
+        new_data = self.downloaded()
+        self.assertEqual(
+            update_timeseries(self.timeseries, new_data, batch_size=1),
+            (False, 2),
+        )
+        self.assertEqual(self.stored(), list(new_data.itertuples(index=False)))
+        self.assertEqual(
+            update_timeseries(self.timeseries, new_data), (False, 0)
+        )
+
+    def test_changed_values_create_new_version(self):
+        new_data = self.downloaded()
+        new_data.iloc[10, 0] += 1
+        self.assertEqual(
+            update_timeseries(self.timeseries, new_data), (True, 62)
+        )
+        self.assertEqual(self.stored(), list(new_data.itertuples(index=False)))
+        self.assertTrue(self.timeseries.tsversion_set.first().expired)
+        self.timeseries.refresh_from_db()
+        self.assertEqual(
+            self.timeseries.current_version,
+            self.timeseries.tsversion_set.order_by("created_at").last(),
+        )
+
+    def test_missing_values_create_new_version(self):
+        new_data = self.downloaded().iloc[1:]
+        self.assertEqual(
+            update_timeseries(self.timeseries, new_data), (True, 61)
+        )
+
+
+class BenchmarkLookupsTest(TestCase):
+    def test_rolled_back(self):
+        out = StringIO()
+        call_command(
+            "benchmark_lookups",
+            timeseries=2,
+            versions=2,
+            values=5,
+            repeat=1,
+            stdout=out,
+        )
+        self.assertIn("ordered values scan", out.getvalue())
+        self.assertFalse(models.TimeSeries.objects.exists())
+        # The indexes are back.
+        plan = models.TSValue.objects.filter(version_id=1).order_by("time")
+        self.assertNotIn("TEMP B-TREE", plan.explain())
+
+
+class BenchmarkTest(TestCase):
+    def test_run_and_compare(self):
+        scales = {"tiny": benchmarks.Scale(n_targets=2, periods=60, n_lags=2)}
+        results = benchmarks.run_suite(scales, repeat=1)
+        self.assertFalse(models.TimeSeries.objects.exists())
+        self.assertFalse(models.MLModel.objects.exists())
+
+        stages = results["results"]["tiny"]
+        self.assertIn("build_x_y", stages)
+        self.assertIn("api: predict", stages)
+        self.assertGreater(stages["ingest"]["queries"], 0)
+        self.assertGreater(stages["build_x_y"]["peak_memory"], 0)
+
+        self.assertFalse(
+            any(
+                row["regressed"] for row in benchmarks.compare(results, results)
+            )
+        )
+        baseline = json.loads(json.dumps(results))
+        baseline["results"]["tiny"]["train"]["queries"] -= 1
+        baseline["results"]["tiny"]["predict"]["seconds"] /= 10
+        regressed = {
+            (row["stage"], row["metric"])
+            for row in benchmarks.compare(baseline, results, min_seconds=0)
+            if row["regressed"]
+        }
+        self.assertEqual(
+            regressed, {("train", "queries"), ("predict", "seconds")}
+        )
+
+    def test_command_compare(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        baseline = os.path.join(directory, "baseline.json")
+        with mock.patch(
+            "gtrends.management.commands.benchmark.SCALES",
+            {"small": benchmarks.Scale(n_targets=2, periods=60, n_lags=2)},
+        ):
+            call_command(
+                "benchmark",
+                scales=["small"],
+                repeat=1,
+                output=baseline,
+                stdout=StringIO(),
+            )
+            with open(baseline) as f:
+                results = json.load(f)
+            results["results"]["small"]["ingest"]["queries"] = 0
+            with open(baseline, "w") as f:
+                json.dump(results, f)
+            with self.assertRaises(CommandError):
+                call_command(
+                    "benchmark",
+                    scales=["small"],
+                    repeat=1,
+                    compare=baseline,
+                    stdout=StringIO(),
+                    stderr=StringIO(),
+                )
+
+
+class ChunkStorageTest(TestCase):
+    def setUp(self):
+        self.config = create_data_config(["a", "b"], ["f"])
+        self.expected = load_data(
+            self.config.targets.all(), self.config.features.all()
+        )
+        call_command(
+            "convert_timeseries_storage",
+            "CHUNKS",
+            batch_size=25,
+            stdout=StringIO(),
+        )
+
+    def test_convert(self):
+        self.assertFalse(models.TSValue.objects.exists())
+        self.assertEqual(models.TSChunk.objects.count(), 3 * 3)
+        data = load_data(self.config.targets.all(), self.config.features.all())
+        self.assertEqual(data[1], self.expected[1])
+        for key, series in self.expected[0].items():
+            for name, df in series.items():
+                pd.testing.assert_frame_equal(data[0][key][name], df)
+
+    def test_convert_back(self):
+        call_command("convert_timeseries_storage", "ROWS", stdout=StringIO())
+        self.assertFalse(models.TSChunk.objects.exists())
+        data = load_data(self.config.targets.all(), self.config.features.all())
+        for key, series in self.expected[0].items():
+            for name, df in series.items():
+                pd.testing.assert_frame_equal(data[0][key][name], df)
+
+    def test_read_tail(self):
+        data, _ = load_data(
+            self.config.targets.all(), self.config.features.all(), last_n=30
+        )
+        for key, series in self.expected[0].items():
+            for name, df in series.items():
+                pd.testing.assert_frame_equal(data[key][name], df.iloc[-30:])
+
+    def test_zero_copy_read(self):
+        version = models.TSVersion.objects.get(timeseries__name="a")
+        version.tschunk_set.exclude(
+            id=version.tschunk_set.order_by("-end_time").first().id
+        ).delete()
+        _, values = storage.read_values([version.id])[version.id]
+        self.assertFalse(values.flags.owndata)
+
+    def test_update(self):
+        timeseries = models.TimeSeries.objects.get(name="a")
+        new_data = make_series("a", periods=62).droplevel("ts_name")
+        self.assertEqual(update_timeseries(timeseries, new_data), (False, 2))
+        data, _ = load_data(self.config.targets.all(), [])
+        self.assertEqual(
+            data["targets"]["a"]["value"].tolist(),
+            new_data["value"].tolist(),
+        )
+
+
+class ValuesEndpointTest(TestCase):
+    def setUp(self):
+        self.timeseries = create_timeseries("a")
+        self.version = self.timeseries.tsversion_set.get()
+        self.url = (
+            f"/gtrends/timeseries/{self.timeseries.id}"
+            f"/versions/{self.version.id}/values/"
+        )
+        self.expected = make_series("a")["value"].droplevel("ts_name")
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="user"))
+
+    def get_values(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return pd.Series(
+            [record["value"] for record in response.json()],
+            index=pd.DatetimeIndex(
+                [record["time"] for record in response.json()]
+            ),
+        )
+
+    def test_json(self):
+        for url in [
+            self.url,
+            f"/gtrends/timeseries/{self.timeseries.id}/latest-values/",
+        ]:
+            values = self.get_values(url)
+            self.assertEqual(values.tolist(), self.expected.tolist())
+            self.assertTrue((values.index == self.expected.index).all())
+
+    def test_time_range(self):
+        start, end = self.expected.index[10], self.expected.index[20]
+        values = self.get_values(
+            self.url, {"start": start.isoformat(), "end": end.isoformat()}
+        )
+        self.assertEqual(values.tolist(), self.expected[10:20].tolist())
+
+    def test_pagination(self):
+        records, url = [], f"{self.url}?limit=25"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data["results"]), 25)
+            records += response.data["results"]
+            url = response.data["next"]
+        self.assertEqual(
+            [record["value"] for record in records], self.expected.tolist()
+        )
+
+        response = self.client.get(self.url, {"limit": 0})
+        self.assertEqual(response.status_code, 400)
+
+    def test_streaming(self):
+        response = self.client.get(self.url, {"output": "ndjson"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(
+            [json.loads(line)["value"] for line in lines],
+            self.expected.tolist(),
+        )
+
+        response = self.client.get(self.url, {"output": "csv"})
+        df = pd.read_csv(
+            StringIO(b"".join(response.streaming_content).decode()),
+            parse_dates=["time"],
+        )
+        self.assertEqual(df["value"].tolist(), self.expected.tolist())
+        self.assertTrue((df["time"] == self.expected.index).all())
+
+        response = self.client.get(self.url, {"output": "packed"})
+        times, values = decode_packed(b"".join(response.streaming_content))
+        self.assertEqual(values.tolist(), self.expected.tolist())
+        self.assertTrue((times == self.expected.index).all())
+
+    def test_chunked_versions(self):
+        call_command("convert_timeseries_storage", "CHUNKS", stdout=StringIO())
+        self.version.refresh_from_db()
+        # Chunks overlapping each other, as when a later update fills gaps.
+        times, values = storage.read_values([self.version.id])[self.version.id]
+        self.version.tschunk_set.all().delete()
+        for offset in [1, 0]:
+            storage.write_values(
+                self.version, times[offset::2], values[offset::2], 7
+            )
+
+        batches = list(storage.iter_values(self.version))
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(
+            np.concatenate([values for _, values in batches]).tolist(),
+            self.expected.tolist(),
+        )
+
+        records, url = [], f"{self.url}?limit=9"
+        while url:
+            response = self.client.get(url)
+            records += response.data["results"]
+            url = response.data["next"]
+        self.assertEqual(
+            [record["value"] for record in records], self.expected.tolist()
+        )
+
+
+class DataSourceTest(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings = override_settings(DATASOURCE_LOCAL_DIR=directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.path = f"{directory}/a.csv"
+        self.write_csv(make_series("a"))
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="user"))
+
+    def write_csv(self, df):
+        df["value"].droplevel("ts_name").tz_localize(None).to_csv(self.path)
+
+    def stored(self, timeseries):
+        version = timeseries.current_version
+        return list(version.tsvalue_set.order_by("time").values_list("value"))
+
+    def test_local_file_source(self):
+        response = self.client.post(
+            "/gtrends/timeseries/", {"name": "a", "source": "LOCAL_FILE"}
+        )
+        self.assertEqual(response.status_code, 201)
+        timeseries = models.TimeSeries.objects.get(name="a")
+        self.assertEqual(len(self.stored(timeseries)), 60)
+
+        response = self.client.post(
+            "/gtrends/timeseries/", {"name": "b", "source": "UNKNOWN"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(DATASOURCE_SINCE_OVERLAP=5)
+    def test_download_since(self):
+        timeseries = models.TimeSeries.objects.create(
+            name="a", source="LOCAL_FILE"
+        )
+        update_timeseries(timeseries)
+
+        self.write_csv(make_series("a", periods=62))
+        with mock.patch.object(
+            LocalFileSource,
+            "download",
+            autospec=True,
+            side_effect=LocalFileSource.download,
+        ) as download:
+            self.assertEqual(update_timeseries(timeseries), (False, 2))
+        since = download.call_args.args[1]
+        self.assertEqual(since, make_series("a").index[-5][0])
+
+        # Changed values in the downloaded window: full history download.
+        df = make_series("a", periods=62)
+        df.iloc[-3, 0] += 1
+        self.write_csv(df)
+        self.assertEqual(update_timeseries(timeseries), (True, 62))
+        self.assertEqual(
+            self.stored(timeseries), list(df.itertuples(index=False))
+        )
+
+    def test_session_reuse(self):
+        class SessionSource(StubSource):
+            @classmethod
+            def create_session(cls):
+                return object()
+
+        session = SessionSource.get_session()
+        self.assertIs(SessionSource.get_session(), session)
+        self.assertIsNone(StubSource.get_session())
+
+    @override_settings(DATASOURCE_CACHE_ALIAS="default")
+    def test_response_cache(self):
+        fetch = mock.Mock(return_value=make_series("a"))
+        request = {"kw_list": ["a"], "timeframe": "today 5-y"}
+        pd.testing.assert_frame_equal(
+            StubSource.cached(request, fetch), make_series("a")
+        )
+        StubSource.cached(request, fetch)
+        self.assertEqual(fetch.call_count, 1)
+        StubSource.cached({**request, "kw_list": ["b"]}, fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+
+@override_settings(DATASOURCE_RATE_LIMIT=1000, DATASOURCE_MAX_WORKERS=3)
+class UpdateAllTimeseriesTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(DATASOURCE_MAP, {"STUB": StubSource})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in ["a", "b", "c"]:
+            create_timeseries(name, source="STUB")
+
+    def test_update_all_timeseries(self):
+        updated, failed = update_all_timeseries()
+        self.assertEqual(updated, {name: (False, 2) for name in "abc"})
+        self.assertEqual(failed, {})
+        for name in "abc":
+            self.assertEqual(
+                models.TSValue.objects.filter(
+                    version__timeseries__name=name
+                ).count(),
+                62,
+            )
+
+    def test_failed_download_does_not_block_others(self):
+        models.TimeSeries.objects.create(name="broken", source="STUB")
+        updated, failed = update_all_timeseries()
+        self.assertEqual(set(updated), {"a", "b", "c"})
+        self.assertEqual(set(failed), {"broken"})
+        self.assertFalse(
+            models.TSVersion.objects.filter(timeseries__name="broken").exists()
+        )
+
+
+class FakeTrendReq:
+    """Stand-in for pytrends' TrendReq, serving `make_series` volumes.
+
+    Like Google Trends, the terms of a payload are scaled together, so that
+    their maximum is 100, and rounded.
+    """
+
+    def __init__(self):
+        self.payloads = []
+
+    def build_payload(self, kw_list, timeframe):
+        self.payloads.append(list(kw_list))
+
+    def interest_over_time(self):
+        kw_list = self.payloads[-1]
+        volumes = pd.DataFrame(
+            {
+                name: make_series(name, periods=62, seed=int(name[-1]))["value"]
+                .droplevel("ts_name")
+                .tz_localize(None)
+                # Some terms are more searched than others.
+                * (int(name.split("_")[-1]) % 4 + 1)
+                for name in kw_list
+            }
+        )
+        data = (volumes / volumes.to_numpy().max() * 100).round()
+        data["isPartial"] = False
+        data.iloc[-1, -1] = True
+        return data.rename_axis("date")
+
+
+@override_settings(DATASOURCE_CACHE_ALIAS="default", DATASOURCE_RATE_LIMIT=1000)
+class GTrendSourceTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.trend_req = FakeTrendReq()
+        patcher = mock.patch.object(
+            GTrendSource, "get_session", return_value=self.trend_req
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.names = [f"term_{i}" for i in range(7)]
+        for name in self.names:
+            models.TimeSeries.objects.create(name=name, source="GOOGLE_TRENDS")
+
+    def test_batched_update(self):
+        updated, failed = update_all_timeseries()
+        self.assertEqual(failed, {})
+        self.assertEqual(updated, {name: (True, 61) for name in self.names})
+        self.assertEqual(
+            self.trend_req.payloads, [self.names[:5], self.names[5:]]
+        )
+
+        # Same batches, hence the same values: appended to the versions.
+        updated, _ = update_all_timeseries()
+        self.assertEqual(updated, {name: (False, 0) for name in self.names})
+
+    @override_settings(GTRENDS_BATCH_NORMALIZATION="per_term")
+    def test_per_term_normalization(self):
+        batch = models.TimeSeries.objects.filter(name__in=self.names[:5])
+        batched = GTrendSource.download_many(list(batch))
+        for ts in batch:
+            single = GTrendSource(ts).download()
+            self.assertEqual(batched[ts.name]["value"].max(), 100)
+            # Equal up to the rounding of the joint scale, coarser for the
+            # least searched terms (a quarter of the others here).
+            np.testing.assert_allclose(
+                batched[ts.name]["value"], single["value"], atol=5
+            )
+
+    @override_settings(GTRENDS_BATCH_NORMALIZATION="joint")
+    def test_joint_normalization(self):
+        batch = list(models.TimeSeries.objects.filter(name__in=self.names[:5]))
+        batched = GTrendSource.download_many(batch)
+        self.assertEqual(max(df["value"].max() for df in batched.values()), 100)
+        self.assertLess(batched["term_0"]["value"].max(), 100)
+
+    @override_settings(
+        GTRENDS_BATCH_NORMALIZATION="anchor", GTRENDS_ANCHOR_TERM="anchor_3"
+    )
+    def test_anchor_normalization(self):
+        updated, failed = update_all_timeseries()
+        self.assertEqual(failed, {})
+        self.assertEqual(len(updated), len(self.names))
+        self.assertEqual(
+            self.trend_req.payloads,
+            [self.names[:4] + ["anchor_3"], self.names[4:] + ["anchor_3"]],
+        )
+
+        # The values of a term do not depend on the other terms of its batch.
+        ts = models.TimeSeries.objects.get(name="term_0")
+        batched = GTrendSource.download_many(
+            list(models.TimeSeries.objects.filter(name__in=self.names[:3]))
+        )
+        pd.testing.assert_frame_equal(
+            batched["term_0"], GTrendSource(ts).download()
+        )
+
+
+class TokenBucketTest(SimpleTestCase):
+    def test_rate(self):
+        bucket = TokenBucket(rate=100, capacity=2)
+        start = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        # Two tokens are available right away, the others come every 10ms.
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+
+@override_settings(INCREMENTAL_TRAINING_ROUNDS=4, FULL_REFIT_EVERY=2)
+class IncrementalTrainingTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.ml_model = create_ml_model(
+            create_data_config(["a", "b"], ["f"]),
+            # Let the few new rows be split.
+            model_params={"n_estimators": 5, "min_child_samples": 1},
+        )
+
+    def append_values(self, periods):
+        for i, name in enumerate(["a", "b", "f"]):
+            timeseries = models.TimeSeries.objects.get(name=name)
+            new_data = make_series(
+                name, periods=periods, seed=i if name != "f" else 100
+            ).droplevel("ts_name")
+            self.assertFalse(update_timeseries(timeseries, new_data)[0])
+
+    def lineage(self, ml_model_version):
+        return ml_model_version.metadata["training"]
+
+    def test_lineage(self):
+        first = train_pipeline(self.ml_model)
+        self.assertEqual(self.lineage(first)["mode"], "full")
+        self.assertEqual(self.lineage(first)["reason"], "first version")
+
+        self.append_values(62)
+        second = train_pipeline(self.ml_model)
+        lineage = self.lineage(second)
+        self.assertEqual(lineage["mode"], "incremental")
+        self.assertEqual(lineage["parent"], first.id)
+        self.assertEqual(lineage["base"], first.id)
+        # Two new times, for each of the two targets, refit on the latest
+        # four times (horizon 1) of each target.
+        self.assertEqual(lineage["n_new_rows"], 4)
+        self.assertEqual(lineage["window"], 4)
+        self.assertEqual(lineage["n_rows"], 8)
+        self.assertEqual(
+            load_engine(second.ml_file).num_trees(),
+            load_engine(first.ml_file).num_trees() + 4,
+        )
+
+        self.append_values(64)
+        third = train_pipeline(self.ml_model)
+        self.assertEqual(self.lineage(third)["base"], first.id)
+        self.assertEqual(self.lineage(third)["n_incremental"], 2)
+
+        # FULL_REFIT_EVERY incremental trainings happened.
+        self.append_values(66)
+        fourth = train_pipeline(self.ml_model)
+        self.assertEqual(self.lineage(fourth)["reason"], "scheduled")
+
+        # Nothing new to learn.
+        fifth = train_pipeline(self.ml_model)
+        self.assertEqual(self.lineage(fifth)["reason"], "no new data")
+
+    def test_multi_horizon(self):
+        self.ml_model.preprocess_config.params["horizon"] = [1, 3]
+        self.ml_model.preprocess_config.save()
+        first = train_pipeline(self.ml_model)
+        self.append_values(62)
+        second = train_pipeline(self.ml_model)
+        lineage = self.lineage(second)
+        self.assertEqual(lineage["mode"], "incremental")
+        # Two new rows per target and horizon: the rows of horizon 3 end
+        # two times before the ones of horizon 1.
+        self.assertEqual(lineage["n_new_rows"], 8)
+        # The latest 4 * 3 rows of each target and horizon.
+        self.assertEqual(lineage["window"], 12)
+        self.assertEqual(lineage["n_rows"], 48)
+        self.assertEqual(
+            {h: pd.Timestamp(t) for h, t in lineage["last_times"].items()},
+            {
+                h: pd.Timestamp(t) + pd.Timedelta(weeks=2)
+                for h, t in self.lineage(first)["last_times"].items()
+            },
+        )
+
+    def test_window(self):
+        self.ml_model.ml_config.params["incremental_window"] = 1
+        self.ml_model.ml_config.save()
+        train_pipeline(self.ml_model)
+        self.append_values(62)
+        lineage = self.lineage(train_pipeline(self.ml_model))
+        # All the new rows, even if more than the window.
+        self.assertEqual(lineage["n_rows"], 4)
+
+        self.ml_model.ml_config.params["incremental_window"] = 10
+        self.ml_model.ml_config.save()
+        # Only "a" got new values.
+        timeseries = models.TimeSeries.objects.get(name="a")
+        new_data = make_series("a", periods=63).droplevel("ts_name")
+        self.assertFalse(update_timeseries(timeseries, new_data)[0])
+        lineage = self.lineage(train_pipeline(self.ml_model))
+        self.assertEqual(lineage["n_new_rows"], 1)
+        self.assertEqual(lineage["n_rows"], 10)
+
+        for window in [0, 1.5, "4"]:
+            serializer = MLConfigSerializer(
+                data={"params": {"incremental_window": window}}
+            )
+            self.assertFalse(serializer.is_valid())
+
+    def test_full_refit(self):
+        train_pipeline(self.ml_model)
+        self.append_values(62)
+        version = train_pipeline(self.ml_model, incremental=False)
+        self.assertEqual(self.lineage(version)["reason"], "requested")
+
+        # Changed past values create a new version of the timeseries.
+        timeseries = models.TimeSeries.objects.get(name="a")
+        new_data = make_series("a", periods=62, seed=1).droplevel("ts_name")
+        self.assertTrue(update_timeseries(timeseries, new_data)[0])
+        version = train_pipeline(self.ml_model)
+        self.assertEqual(
+            self.lineage(version)["reason"], "data versions changed"
+        )
+
+
+class TrainAllTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        data_config = create_data_config(["a", "b"], ["f"])
+        preprocess_config = create_preprocess_config()
+        self.ml_models = [
+            create_ml_model(
+                data_config,
+                preprocess_config,
+                name=f"model_{n_estimators}",
+                model_params={"n_estimators": n_estimators, "n_jobs": 2},
+            )
+            for n_estimators in [3, 6]
+        ]
+        other_config = models.DataConfig.objects.create(name="other")
+        models.DataTargets.objects.create(
+            config=other_config,
+            timeseries=models.TimeSeries.objects.get(name="a"),
+        )
+        self.ml_models.append(
+            create_ml_model(
+                other_config,
+                create_preprocess_config("other", target_lags=[0]),
+                name="other",
+            )
+        )
+
+    def test_split_cpu_budget(self):
+        self.assertEqual(split_cpu_budget(8, 2), (2, 4))
+        self.assertEqual(split_cpu_budget(8, 20), (8, 1))
+        self.assertEqual(split_cpu_budget(8, 20, processes=3), (3, 2))
+        self.assertEqual(split_cpu_budget(2, 5, processes=4), (2, 1))
+        self.assertEqual(split_cpu_budget(0, 0), (1, 1))
+
+    def test_shares_data(self):
+        module = sys.modules["gtrends.services.pipelines.train_all_pipeline"]
+        with mock.patch.object(
+            module, "load_series", side_effect=module.load_series
+        ) as load_series, mock.patch.object(
+            module, "preprocess", side_effect=module.preprocess
+        ) as preprocess, mock.patch.object(
+            module, "train", side_effect=module.train
+        ) as train:
+            trained, failed = train_all_pipeline(cpu_budget=4, processes=1)
+
+        self.assertEqual(failed, {})
+        self.assertEqual(load_series.call_count, 1)
+        self.assertEqual(preprocess.call_count, 2)
+        # The smaller n_jobs of the models is kept.
+        self.assertEqual(
+            [call.args[2]["n_jobs"] for call in train.call_args_list],
+            [2, 2, 4],
+        )
+        for ml_model in self.ml_models:
+            ml_model.refresh_from_db()
+            self.assertEqual(
+                trained[ml_model.name]["ml_model_version"],
+                ml_model.current_version_id,
+            )
+            self.assertGreater(trained[ml_model.name]["seconds"], 0)
+
+    def test_process_pool(self):
+        trained, failed = train_all_pipeline(cpu_budget=2)
+        self.assertEqual(failed, {})
+        self.assertEqual(set(trained), {m.name for m in self.ml_models})
+        predictions = inference_pipeline(self.ml_models[0])
+        self.assertEqual(set(predictions), {"a", "b"})
+
+    def test_failed_model(self):
+        self.ml_models[2].ml_config.params = {"n_estimators": -1}
+        self.ml_models[2].ml_config.save()
+        trained, failed = train_all_pipeline(processes=1)
+        self.assertEqual(set(trained), {"model_3", "model_6"})
+        self.assertEqual(set(failed), {"other"})
+
+    def test_timeseries_without_data(self):
+        empty = models.TimeSeries.objects.create(
+            name="empty", source="GOOGLE_TRENDS"
+        )
+        models.DataFeatures.objects.create(
+            config=self.ml_models[2].data_config, timeseries=empty
+        )
+        module = sys.modules["gtrends.services.pipelines.train_all_pipeline"]
+        with mock.patch.object(
+            module, "load_series", side_effect=module.load_series
+        ) as load_series:
+            trained, failed = train_all_pipeline(processes=1)
+        self.assertEqual(set(trained), {"model_3", "model_6"})
+        self.assertEqual(set(failed), {"other"})
+        self.assertIn("empty has no data", str(failed["other"]))
+        self.assertEqual(load_series.call_count, 1)
+
+
+class BacktestTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.ml_model = create_ml_model(
+            create_data_config(["a", "b"], ["f"]),
+            create_preprocess_config(horizon=2),
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="user"))
+
+    def test_split_folds(self):
+        self.assertEqual(
+            split_folds(20, horizon=2, n_folds=3, test_size=4),
+            [((0, 7), (8, 12)), ((0, 11), (12, 16)), ((0, 15), (16, 20))],
+        )
+        self.assertEqual(
+            split_folds(20, 2, 3, window="rolling", train_size=5),
+            [((0, 4), (5, 10)), ((4, 9), (10, 15)), ((9, 14), (15, 20))],
+        )
+        with self.assertRaises(ValueError):
+            split_folds(10, horizon=2, n_folds=5, test_size=2)
+
+    def test_no_leakage(self):
+        x, y = preprocess(
+            make_data(["a", "b"], ["f"]), {**self.prep_params, "horizon": 3}
+        )
+        times = x.index.get_level_values("time").unique().sort_values()
+        report = backtest(
+            x, y, {"n_estimators": 5}, 3, n_folds=4, window="rolling"
+        )
+        self.assertEqual(report["n_folds"], 4)
+        for fold in report["folds"]:
+            # The target of the last training row is known at the origin.
+            train_end = times.get_loc(pd.Timestamp(fold["train_end"]))
+            test_start = times.get_loc(pd.Timestamp(fold["test_start"]))
+            self.assertEqual(test_start - train_end, 3)
+            self.assertGreater(fold["n_train"], 0)
+            self.assertGreaterEqual(fold["rmse"], fold["mae"])
+
+    def test_process_pool(self):
+        data = make_data(["a", "b"], ["f"])
+        x, y = preprocess(data, self.prep_params)
+        inline = backtest(x, y, {"n_estimators": 5}, 2, cpu_budget=1)
+        pooled = backtest(x, y, {"n_estimators": 5}, 2, cpu_budget=2)
+        self.assertEqual(inline, pooled)
+
+    def test_pipeline(self):
+        with self.assertRaises(ValueError):
+            backtest_pipeline(self.ml_model)
+        ml_model_version = train_pipeline(self.ml_model)
+        report = backtest_pipeline(self.ml_model, n_folds=3, cpu_budget=1)
+        ml_model_version.refresh_from_db()
+        self.assertEqual(ml_model_version.metadata["backtest"], report)
+        self.assertEqual(
+            report["data"]["targets"], ml_model_version.metadata["targets"]
+        )
+
+    def test_backtest_job(self):
+        url = f"/gtrends/model/{self.ml_model.id}/backtest/"
+        self.assertEqual(self.client.get(url).status_code, 404)
+        train_pipeline(self.ml_model)
+        response = self.client.get(url, {"n_folds": 0})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(url, {"n_folds": 3, "window": "rolling"})
+        self.assertEqual(response.status_code, 202)
+        job = jobs.claim_next_job()
+        self.assertEqual(job.kind, models.JobKind.BACKTEST)
+        self.assertEqual(jobs.run_job(job.id), models.JobStatus.SUCCEEDED)
+        job.refresh_from_db()
+        self.assertEqual(job.result["n_folds"], 3)
+        self.assertEqual(job.result["window"], "rolling")
+
+    @property
+    def prep_params(self):
+        return self.ml_model.preprocess_config.params
+
+
+class MetricsTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+        self.ml_model = create_ml_model(create_data_config(["a"], ["f"]))
+        train_pipeline(self.ml_model)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="user"))
+
+    def test_stages(self):
+        self.assertEqual(metrics.STAGE_SECONDS.value(stage="train"), 1)
+        self.assertEqual(metrics.STAGE_SECONDS.value(stage="load_data"), 1)
+        with self.assertRaises(ValueError):
+            with metrics.stage("failing"):
+                raise ValueError()
+        self.assertEqual(metrics.STAGE_ERRORS.value(stage="failing"), 1)
+        self.assertEqual(metrics.STAGE_SECONDS.value(stage="failing"), 1)
+
+    def test_metrics_endpoint(self):
+        response = self.client.get(
+            f"/gtrends/model/{self.ml_model.id}/predict/"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(
+            metrics.REQUEST_QUERIES.value(view="mlmodel-predict"), 0
+        )
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        for sample in [
+            'gtrends_stage_seconds_count{stage="load_engine"} 1',
+            'gtrends_stage_seconds_count{stage="predict"} 1',
+            'gtrends_stage_seconds_bucket{stage="predict",le="+Inf"} 1',
+            'gtrends_requests_total{view="mlmodel-predict",method="GET",'
+            'status="200"} 1',
+        ]:
+            self.assertIn(sample, content)
+
+    def test_streamed_response(self):
+        timeseries = models.TimeSeries.objects.get(name="a")
+        url = f"/gtrends/timeseries/{timeseries.id}/latest-values/"
+        labels = {"view": "timeseries-latest-values"}
+        with CaptureQueriesContext(connections["default"]) as queries:
+            response = self.client.get(url, {"output": "ndjson"})
+            self.assertEqual(metrics.REQUEST_QUERIES.value(**labels), 0)
+            self.assertEqual(len(b"".join(response).splitlines()), 60)
+        # The values are queried while streaming.
+        self.assertEqual(metrics.REQUEST_QUERIES.value(**labels), len(queries))
+        self.assertEqual(
+            metrics.REQUESTS.value(method="GET", status=200, **labels), 1
+        )
+
+    def test_metrics_authentication(self):
+        client = APIClient()
+        self.assertEqual(client.get("/metrics").status_code, 403)
+        with override_settings(METRICS_PUBLIC=True):
+            response = client.get("/metrics", HTTP_ACCEPT="text/plain")
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("gtrends_stage_seconds", response.content.decode())
+
+    def test_profiling(self):
+        url = f"/gtrends/model/{self.ml_model.id}/predict/"
+        response = self.client.get(url, HTTP_X_PROFILE="cprofile")
+        self.assertEqual(response["Content-Type"], "application/json")
+
+        with override_settings(PROFILE_REQUESTS=True):
+            response = self.client.get(url, HTTP_X_PROFILE="cprofile")
+            self.assertEqual(response["X-Profiled-Status"], "200")
+            self.assertIn("batch_inference_pipeline", response.content.decode())
+            response = self.client.get(url, HTTP_X_PROFILE="other")
+            self.assertEqual(response.status_code, 400)
+
+
+class JobTest(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.ml_model = create_ml_model(create_data_config(["a"], ["f"]))
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="user"))
+
+    def test_train_job(self):
+        response = self.client.get(f"/gtrends/model/{self.ml_model.id}/train/")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data["status"], models.JobStatus.PENDING)
+
+        job = jobs.claim_next_job()
+        self.assertEqual(job.id, response.data["id"])
+        self.assertEqual(job.status, models.JobStatus.RUNNING)
+        self.assertIsNone(jobs.claim_next_job())
+        self.assertEqual(jobs.run_job(job.id), models.JobStatus.SUCCEEDED)
+
+        response = self.client.get(f"/gtrends/job/{job.id}/")
+        self.assertEqual(response.data["status"], models.JobStatus.SUCCEEDED)
+        self.assertEqual(
+            response.data["result"],
+            {
+                "ml_model_version": self.ml_model.mlmodelversion_set.get().id,
+                "mode": "full",
+            },
+        )
+
+    def test_train_all_job(self):
+        response = self.client.get("/gtrends/model/train-all/")
+        self.assertEqual(response.status_code, 202)
+        job = jobs.claim_next_job()
+        self.assertEqual(job.kind, models.JobKind.TRAIN_ALL)
+        self.assertEqual(jobs.run_job(job.id), models.JobStatus.SUCCEEDED)
+        job.refresh_from_db()
+        self.assertEqual(
+            job.result["trained"]["model"]["ml_model_version"],
+            self.ml_model.mlmodelversion_set.get().id,
+        )
+
+    def test_failed_job(self):
+        job = jobs.enqueue(models.JobKind.TRAIN, ml_model_id=0)
+        self.assertEqual(jobs.run_job(job.id), models.JobStatus.FAILED)
+        job.refresh_from_db()
+        self.assertIn("DoesNotExist", job.error)
+
+    def test_worker_restarts_broken_pool(self):
+        pools = []
+
+        class InProcessPool:
+            """Run jobs in process, a process of the first pool dying."""
+
+            def __init__(self, *args, **kwargs):
+                self.broken = not pools
+                self.n_submitted = 0
+                pools.append(self)
+
+            def submit(self, fn, *args):
+                future = Future()
+                if not self.broken:
+                    future.set_result(fn(*args))
+                elif self.n_submitted:
+                    raise BrokenProcessPool()
+                else:
+                    # The process running the first job dies.
+                    future.set_exception(BrokenProcessPool())
+                self.n_submitted += 1
+                return future
+
+            def shutdown(self):
+                pass
+
+        job_ids = [
+            jobs.enqueue(models.JobKind.TRAIN, ml_model_id=self.ml_model.id).id
+            for _ in range(3)
+        ]
+        with mock.patch(
+            "gtrends.management.commands.run_worker.ProcessPoolExecutor",
+            InProcessPool,
+        ), mock.patch.object(connections, "close_all"):
+            call_command(
+                "run_worker",
+                processes=2,
+                once=True,
+                stdout=StringIO(),
+                stderr=StringIO(),
+            )
+        self.assertEqual(len(pools), 2)
+        # The job of the dead process failed, the one that could not be
+        # submitted ran in the new pool.
+        statuses = [models.Job.objects.get(id=i).status for i in job_ids]
+        self.assertEqual(
+            statuses,
+            [
+                models.JobStatus.FAILED,
+                models.JobStatus.SUCCEEDED,
+                models.JobStatus.SUCCEEDED,
+            ],
+        )
+        self.assertIn(
+            "BrokenProcessPool", models.Job.objects.get(id=job_ids[0]).error
+        )
@@ -22,6 +22,8 @@ timeseries.register(
     parents_query_lookups="timeseries_id",
 )
 
+router.register("job", views.JobViewSet)
+
 urlpatterns = [
     path("", include(router.urls)),
 ]
@@ -1,25 +1,41 @@
+from itertools import islice
+from typing import Dict, Iterator, Optional
+
+from django.conf import settings
 from django.db import transaction
+from django.http import HttpResponse, StreamingHttpResponse
 from gtrends import models, serializers
-from gtrends.services.pipelines import inference_pipeline, train_pipeline
+from gtrends.database import in_current_context, replica_reads
+from gtrends.services import jobs, metrics, storage
+from gtrends.services.ml import engine_cache
+from gtrends.services.pipelines import (
+    batch_inference_pipeline,
+    inference_pipeline,
+)
+from gtrends.services.streaming import STREAM_FORMATS
 from gtrends.services.tasks import update_timeseries
 from pytrends.exceptions import ResponseError
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.views import APIView
 
 
 class TimeSeriesViewSet(viewsets.ModelViewSet):
-    queryset = models.TimeSeries.objects.prefetch_related("tsversion_set").all()
+    queryset = models.TimeSeries.objects.select_related("current_version").all()
     serializer_class = serializers.TimeSeriesSerializer
     http_method_names = ["get", "post", "head", "delete"]
 
     @action(detail=True, url_path="latest-values")
+    @replica_reads()
     def latest_values(self, request, pk):
-        """Get timeseries values for the last version."""
-        versions = self.queryset.get(pk=pk).tsversion_set.order_by("created_at")
-        if not versions:
-            return Response([])
-        return Response(versions.first().tsvalue_set.values("time", "value"))
+        """Get timeseries values for the last version.
+
+        Accepts the same query parameters as the version `values` action.
+        """
+        timeseries = self.queryset.get(pk=pk)
+        return _values_response(request, timeseries.current_version)
 
     @action(detail=True, url_path="update-values")
     @transaction.atomic
@@ -41,30 +57,34 @@ class TimeSeriesViewSet(viewsets.ModelViewSet):
         return Response(msg)
 
     @action(detail=False, url_path="update-all-values")
-    @transaction.atomic
     def update_all_values(self, request):
-        """Update timeseries values."""
-        try:
-            for timeseries in self.queryset:
-                update_timeseries(timeseries)
-        except ResponseError:
-            return Response(
-                "Data download failed!", status=status.HTTP_400_BAD_REQUEST
-            )
-        msg = f"Data updated, {len(self.queryset)} timeseries updated."
-        return Response(msg)
+        """Update timeseries values, in a background job."""
+        job = jobs.enqueue(models.JobKind.UPDATE_ALL_TIMESERIES)
+        return Response(
+            serializers.JobSerializer(job).data,
+            status=status.HTTP_202_ACCEPTED,
+        )
 
 
 class TSVersionViewSet(viewsets.ModelViewSet):
-    queryset = models.TSVersion.objects.prefetch_related("tsvalue_set").all()
+    queryset = models.TSVersion.objects.all()
     serializer_class = serializers.TSVersionSerializer
     http_method_names = ["get", "head"]
 
     @action(detail=True)
+    @replica_reads()
     def values(self, request, pk, **kwargs):
-        """Get timeseries values."""
-        values = self.queryset.get(pk=pk).tsvalue_set.values("time", "value")
-        return Response(values)
+        """Get timeseries values.
+
+        Query parameters:
+            start, end: Only return values with `start <= time < end`.
+            after: Only return values with `time > after`.
+            limit: Return at most `limit` values, along with the url of the
+                next page (keyset pagination on time).
+            output: "json" (default), or a streamed format: "ndjson",
+                "csv" or "packed" (see `gtrends.services.streaming`).
+        """
+        return _values_response(request, self.queryset.get(pk=pk))
 
 
 class MLConfigViewSet(viewsets.ModelViewSet):
@@ -88,11 +108,7 @@ class PreprocessingConfigViewSet(viewsets.ModelViewSet):
 class MLModelViewSet(viewsets.ModelViewSet):
     queryset = (
         models.MLModel.objects.select_related("preprocess_config", "ml_config")
-        .prefetch_related(
-            "data_config__targets",
-            "data_config__features",
-            "mlmodelversion_set",
-        )
+        .prefetch_related("data_config__targets", "data_config__features")
         .all()
     )
     serializer_class = serializers.MLModelSerializer
@@ -100,29 +116,197 @@ class MLModelViewSet(viewsets.ModelViewSet):
 
     @action(detail=True)
     def train(self, request, pk, **kwargs):
+        """Train a new model version, in a background job.
+
+        The `incremental` query parameter ("true" or "false") forces the
+        training mode, see `plan_training`.
+        """
         ml_model = self.queryset.get(pk=pk)
+        query = serializers.TrainQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+
+        job = jobs.enqueue(
+            models.JobKind.TRAIN,
+            ml_model_id=ml_model.id,
+            incremental=query.validated_data["incremental"],
+        )
+
+        return Response(
+            serializers.JobSerializer(job).data,
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+    @action(detail=True)
+    def backtest(self, request, pk, **kwargs):
+        """Backtest the model configs, in a background job.
+
+        Query parameters:
+            n_folds: Number of test blocks, 5 by default.
+            window: "expanding" (default) or "rolling" training window.
+            train_size: Number of training times of a rolling window.
+            test_size: Number of times of each test block.
+
+        The report is stored in the current version metadata, see
+        `backtest_pipeline`.
+        """
+        ml_model = self.queryset.get(pk=pk)
+        if ml_model.current_version_id is None:
+            return Response(
+                "No model has been trained yet!",
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        query = serializers.BacktestQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+
+        job = jobs.enqueue(
+            models.JobKind.BACKTEST,
+            ml_model_id=ml_model.id,
+            **query.validated_data,
+        )
+
+        return Response(
+            serializers.JobSerializer(job).data,
+            status=status.HTTP_202_ACCEPTED,
+        )
 
-        ml_model_version = train_pipeline(ml_model)
+    @action(detail=False, url_path="train-all")
+    def train_all(self, request, **kwargs):
+        """Train a new version of all the models, in a background job."""
+        job = jobs.enqueue(models.JobKind.TRAIN_ALL)
 
         return Response(
-            serializers.MLModelVersionSerializer(ml_model_version).data
+            serializers.JobSerializer(job).data,
+            status=status.HTTP_202_ACCEPTED,
         )
 
     @action(detail=True)
+    @replica_reads()
     def predict(self, request, pk, **kwargs):
         ml_model = self.queryset.get(pk=pk)
-        if ml_model.mlmodelversion_set.count() == 0:
+        if ml_model.current_version_id is None:
             return Response(
                 "No model has been trained yet!",
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        predictions = inference_pipeline(ml_model)
+        try:
+            predictions = inference_pipeline(ml_model)
+        except ValueError as e:
+            # E.g. a timeseries of the model has no data.
+            return Response(str(e), status=status.HTTP_404_NOT_FOUND)
+
+        return Response(predictions)
+
+    @action(detail=False, methods=["post"], url_path="batch-predict")
+    @replica_reads()
+    def batch_predict(self, request, **kwargs):
+        """Predict with many models at once, sharing data loading."""
+        serializer = serializers.BatchPredictSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = serializer.validated_data["ids"]
+
+        ml_models = list(self.queryset.filter(pk__in=ids))
+        unknown = set(ids) - {ml_model.id for ml_model in ml_models}
+        if unknown:
+            return Response(
+                f"Unknown models: {sorted(unknown)}",
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        untrained = [
+            ml_model.id
+            for ml_model in ml_models
+            if ml_model.current_version_id is None
+        ]
+        if untrained:
+            return Response(
+                f"No model has been trained yet: {untrained}",
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        try:
+            predictions = batch_inference_pipeline(ml_models)
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_404_NOT_FOUND)
 
         return Response(predictions)
 
+    @action(detail=False, url_path="engine-cache")
+    def engine_cache_stats(self, request, **kwargs):
+        """Get hit/miss counters of the in-process booster cache."""
+        return Response(engine_cache.stats())
+
 
 class MLModelVersionViewSet(viewsets.ModelViewSet):
     queryset = models.MLModelVersion.objects.all()
     serializer_class = serializers.MLModelVersionSerializer
     http_method_names = ["get", "head"]
+
+
+class JobViewSet(viewsets.ModelViewSet):
+    queryset = models.Job.objects.all()
+    serializer_class = serializers.JobSerializer
+    http_method_names = ["get", "head"]
+
+
+class PrometheusMetricsView(APIView):
+    """Metrics of this process, in the Prometheus text format.
+
+    Authenticated like the rest of the API, unless METRICS_PUBLIC.
+    """
+
+    def get_permissions(self):
+        if settings.METRICS_PUBLIC:
+            return []
+        return super().get_permissions()
+
+    def perform_content_negotiation(self, request, force=False):
+        # Scrapers may only accept text, errors are still sent as JSON.
+        return super().perform_content_negotiation(request, force=True)
+
+    def get(self, request):
+        return HttpResponse(
+            metrics.render(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+
+def _values_response(request, version: Optional[models.TSVersion]):
+    query = serializers.ValuesQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    params = dict(query.validated_data)
+    output, limit = params.pop("output"), params.pop("limit", None)
+
+    if version is None:
+        batches = iter([])
+    else:
+        batches = storage.iter_values(
+            version,
+            **params,
+            batch_size=storage.CHUNK_SIZE if limit is None else limit + 1,
+        )
+
+    if output in STREAM_FORMATS:
+        content_type, encode = STREAM_FORMATS[output]
+        return StreamingHttpResponse(
+            in_current_context(encode(batches)), content_type=content_type
+        )
+
+    if limit is None:
+        return Response(list(_as_records(batches)))
+
+    records = list(islice(_as_records(batches), limit + 1))
+    next_url = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_url = replace_query_param(
+            request.build_absolute_uri(),
+            "after",
+            records[-1]["time"].isoformat(),
+        )
+    return Response({"next": next_url, "results": records})
+
+
+def _as_records(batches) -> Iterator[Dict]:
+    for times, values in batches:
+        for time, value in zip(times.to_pydatetime(), values.tolist()):
+            yield {"time": time, "value": value}
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "gtrends.middleware.MetricsMiddleware",
+    "gtrends.middleware.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -77,11 +81,93 @@ WSGI_APPLICATION = "project.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    "default": {
+# Postgres if POSTGRES_HOST is set (psycopg must be installed), SQLite
+# otherwise. With POSTGRES_REPLICA_HOST (or SQLITE_REPLICA_NAME), the
+# read-only API actions query a "replica" alias, see `gtrends.database`.
+if os.environ.get("POSTGRES_HOST"):
+    _database = {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": os.environ.get("POSTGRES_DB", "gtrends"),
+        "USER": os.environ.get("POSTGRES_USER", "postgres"),
+        "PASSWORD": os.environ.get("POSTGRES_PASSWORD", ""),
+        "HOST": os.environ["POSTGRES_HOST"],
+        "PORT": os.environ.get("POSTGRES_PORT", "5432"),
+        # Server-side cursors do not work through a transaction pooler,
+        # e.g. PgBouncer with pool_mode=transaction.
+        "DISABLE_SERVER_SIDE_CURSORS": (
+            os.environ.get("POSTGRES_TRANSACTION_POOLING", "") == "1"
+        ),
+    }
+    _replica = os.environ.get("POSTGRES_REPLICA_HOST") and {
+        **_database,
+        "HOST": os.environ["POSTGRES_REPLICA_HOST"],
+    }
+else:
+    _database = {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Seconds waited for a lock before raising "database is locked".
+        "OPTIONS": {"timeout": 20},
     }
+    _replica = os.environ.get("SQLITE_REPLICA_NAME") and {
+        **_database,
+        "NAME": os.environ["SQLITE_REPLICA_NAME"],
+    }
+
+# Connections are kept open for CONN_MAX_AGE seconds (0 closes them after
+# each request), and checked before being reused.
+_connections = {
+    "CONN_MAX_AGE": int(os.environ.get("CONN_MAX_AGE", 60)),
+    "CONN_HEALTH_CHECKS": True,
+}
+DATABASES = {"default": {**_database, **_connections}}
+if _replica:
+    DATABASES["replica"] = {
+        **_replica,
+        **_connections,
+        # No test database is created on the replica.
+        "TEST": {"MIRROR": "default"},
+    }
+
+DATABASE_ROUTERS = ["gtrends.database.ReadReplicaRouter"]
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# Set PREDICTION_CACHE_DIR to share cached predictions between processes.
+PREDICTION_CACHE_DIR = os.environ.get("PREDICTION_CACHE_DIR")
+
+# Raw data source responses are cached on disk for DATASOURCE_CACHE_TTL
+# seconds, see `gtrends.services.data_sources.DataSource.cached`.
+DATASOURCE_CACHE_DIR = os.environ.get(
+    "DATASOURCE_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "gtrends-datasource-cache"),
+)
+DATASOURCE_CACHE_TTL = int(os.environ.get("DATASOURCE_CACHE_TTL", 6 * 3600))
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "predictions": (
+        {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": PREDICTION_CACHE_DIR,
+            "TIMEOUT": None,
+        }
+        if PREDICTION_CACHE_DIR
+        else {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "predictions",
+            "TIMEOUT": None,
+        }
+    ),
+    "datasource": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": DATASOURCE_CACHE_DIR,
+        "TIMEOUT": DATASOURCE_CACHE_TTL,
+    },
 }
 
 
@@ -133,3 +219,92 @@ REST_FRAMEWORK = {
         "rest_framework.permissions.IsAuthenticated",
     ],
 }
+
+
+# Forecasting
+
+# In-process cache of loaded boosters, see `gtrends.services.ml.EngineCache`.
+ENGINE_CACHE_MAX_SIZE = 32
+ENGINE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Concurrency and throttling of the downloads in `update_all_timeseries`.
+DATASOURCE_MAX_WORKERS = 4
+DATASOURCE_RATE_LIMIT = 1.0  # Requests per second.
+DATASOURCE_BURST = 4
+
+# Storage of the values of new timeseries versions: "ROWS" (one TSValue row
+# per value) or "CHUNKS" (TSChunk blobs), see `gtrends.services.storage`.
+TIMESERIES_STORAGE = os.environ.get("TIMESERIES_STORAGE", "ROWS")
+
+# Number of values inserted per query (or per chunk) by `update_timeseries`.
+TSVALUE_BATCH_SIZE = 5000
+
+# Cache alias of the predictions, see `gtrends.services.prediction_cache`.
+PREDICTION_CACHE_ALIAS = "predictions"
+
+# Maximum page size of the values endpoints, see `ValuesQuerySerializer`.
+VALUES_MAX_PAGE_SIZE = 10_000
+
+# Number of cores used by `train_all_pipeline`, split between processes
+# and LightGBM threads.
+TRAIN_CPU_BUDGET = int(os.environ.get("TRAIN_CPU_BUDGET", os.cpu_count() or 1))
+
+# Compression of the saved model files: None, "gzip", "bz2" or "lzma".
+MODEL_FILE_COMPRESSION = os.environ.get("MODEL_FILE_COMPRESSION") or None
+
+# Incremental training, see `gtrends.services.tasks.plan_training`: number
+# of boosting rounds added to the previous version, and number of
+# incremental trainings between two full refits.
+INCREMENTAL_TRAINING_ROUNDS = 20
+FULL_REFIT_EVERY = 7
+
+# Cache alias of the raw data source responses.
+DATASOURCE_CACHE_ALIAS = "datasource"
+
+# Directory of the files of the LOCAL_FILE data source, named after the
+# timeseries: "<name>.csv" or "<name>.parquet", with "time" and "value"
+# columns.
+DATASOURCE_LOCAL_DIR = os.environ.get(
+    "DATASOURCE_LOCAL_DIR", str(BASE_DIR / "data")
+)
+
+# Number of stored values downloaded again by sources fetching "since" a
+# time, to check that they did not change.
+DATASOURCE_SINCE_OVERLAP = 10
+
+# Scale of the Google Trends terms fetched together: "joint" (as returned for
+# the batch), "anchor" (scaled to the maximum of GTRENDS_ANCHOR_TERM, added to
+# every batch) or "per_term" (each term scaled to its own maximum of 100).
+# Only "anchor" keeps the values when the batches change, see
+# `GTrendSource.download_many`.
+GTRENDS_BATCH_NORMALIZATION = os.environ.get(
+    "GTRENDS_BATCH_NORMALIZATION", "joint"
+)
+GTRENDS_ANCHOR_TERM = os.environ.get("GTRENDS_ANCHOR_TERM", "")
+
+# On-disk store of the feature matrices shared by the models, see
+# `gtrends.services.feature_store`. An empty FEATURE_STORE_DIR disables it.
+# Next to the SQLite database by default: matrices are only valid for the
+# database they were built from.
+FEATURE_STORE_DIR = os.environ.get(
+    "FEATURE_STORE_DIR", str(BASE_DIR / "feature-store")
+)
+FEATURE_STORE_MAX_BYTES = int(
+    os.environ.get("FEATURE_STORE_MAX_BYTES", 2 * 1024**3)
+)
+
+# Requests sending an "X-Profile: cprofile" (or "pyinstrument") header get
+# their profile instead of their response, see
+# `gtrends.middleware.ProfilingMiddleware`. Keep it off in production.
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "") == "1"
+# Number of functions listed in cProfile reports.
+PROFILE_MAX_LINES = 50
+# Serve /metrics without authentication, e.g. to a Prometheus server
+# scraping from a private network.
+METRICS_PUBLIC = os.environ.get("METRICS_PUBLIC", "") == "1"
+
+# Alias of the read replica, used only if configured in DATABASES.
+DATABASE_REPLICA_ALIAS = "replica"
+# Journal mode of the SQLite databases: in "WAL" mode, readers are not
+# blocked by a write transaction.
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
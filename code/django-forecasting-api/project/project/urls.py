@@ -16,6 +16,7 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import include, path
+from gtrends.views import PrometheusMetricsView
 from rest_framework.authtoken.views import obtain_auth_token
 
 urlpatterns = [
@@ -23,4 +24,5 @@ urlpatterns = [
     path("gtrends/", include("gtrends.urls")),
     path("api-auth/", include("rest_framework.urls")),
     path("api-token-auth/", obtain_auth_token),
+    path("metrics", PrometheusMetricsView.as_view()),
 ]